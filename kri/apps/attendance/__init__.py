@@ -0,0 +1 @@
+default_app_config = 'kri.apps.attendance.apps.AttendanceConfig'
@@ -1,20 +1,67 @@
-from django.contrib import admin
-from .models import Card, CardLog
+from django.conf.urls import url
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
+from django.shortcuts import redirect, render
+from .forms import CardImportForm
+from .models import ArchivedCardLog, Card, CardLog, Occupancy
 
 
 @admin.register(Card)
 class CardAdmin(admin.ModelAdmin):
-    list_display = ('person', 'key', 'last_login', 'last_logout', 'logged_in')
+    list_display = ('person', 'key', 'last_login', 'last_logout', 'inside')
+    list_filter = ('inside',)
+    readonly_fields = ('inside_division', 'inside_university')
 
-    def logged_in(self, obj):
-        return obj.logged_in()
+    def get_urls(self):
+        return [
+            url(r'^import/$', self.admin_site.admin_view(self.import_view),
+                name='attendance_card_import'),
+        ] + super(CardAdmin, self).get_urls()
 
-    logged_in.boolean = True
+    def import_view(self, request):
+        """Register cards from an uploaded csv"""
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+
+        errors = []
+        if request.method == 'POST':
+            form = CardImportForm(request.POST, request.FILES)
+            if form.is_valid():
+                dry_run = form.cleaned_data['dry_run']
+                cards, errors = Card.import_keys(form.cleaned_data['rows'],
+                                                 form.cleaned_data['field'], dry_run)
+                if not errors and dry_run:
+                    messages.success(request, '{0} cards are valid.'.format(len(cards)))
+                elif not errors:
+                    messages.success(request, '{0} cards registered.'.format(len(cards)))
+                    return redirect('admin:attendance_card_changelist')
+        else:
+            form = CardImportForm()
+
+        return render(request, 'admin/attendance/card/import.html', dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta,
+            title='Import cards',
+            form=form,
+            errors=errors,
+        ))
 
 
 @admin.register(CardLog)
 class CardLogAdmin(admin.ModelAdmin):
     list_display = ('name', 'admin', 'activity', 'time')
+    list_select_related = ('card__person', 'admin')
 
     def name(self, obj):
         return obj.card.person.name
+
+
+@admin.register(ArchivedCardLog)
+class ArchivedCardLogAdmin(CardLogAdmin):
+    pass
+
+
+@admin.register(Occupancy)
+class OccupancyAdmin(admin.ModelAdmin):
+    list_display = ('university', 'division', 'count')
+    list_filter = ('division',)
@@ -2,4 +2,8 @@ from django.apps import AppConfig
 
 
 class AttendanceConfig(AppConfig):
-    name = 'attendance'
+    name = 'kri.apps.attendance'
+    label = 'attendance'
+
+    def ready(self):
+        from . import signals
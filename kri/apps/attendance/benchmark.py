@@ -0,0 +1,77 @@
+"""Throughput of card transitions under concurrent scans
+
+Every thread scans the same card once per round, alternating login and logout, and the
+threads of a round start together, so each round is a race for a single transition. Used by
+the benchmark_transitions command and the concurrency tests.
+
+"""
+
+import threading
+import time
+from django.db import connection
+from django.utils import timezone
+from .models import Card
+
+
+def scan_concurrently(card_id, threads=8, rounds=20, scan=None):
+    """Scan a card from many threads at once
+
+    The first round scans the activity the card accepts, login if the card is outside and
+    logout if it is inside. A single thread scans in the calling thread, without opening
+    another database connection.
+
+    Args:
+        - card_id: id of the scanned card
+        - threads: number of threads, each with its own database connection
+        - rounds: number of scans of each thread
+        - scan: callable receiving the activity and returning whether it is granted, default
+          to Card.transition of the card
+
+    Returns:
+        Dictionary of the granted count of each round, the errors raised by the threads, the
+        elapsed seconds and the scans per second
+
+    """
+    if scan is None:
+        def scan(activity):
+            return Card.transition(card_id, activity, timezone.now())
+
+    inside = Card.objects.filter(pk=card_id).values_list('inside', flat=True).get()
+    activities = ('logout', 'login') if inside else ('login', 'logout')
+    barrier = threading.Barrier(threads)
+    lock = threading.Lock()
+    granted = [0] * rounds
+    errors = []
+
+    def run(close):
+        try:
+            for i in range(rounds):
+                if threads > 1:
+                    barrier.wait()
+                if scan(activities[i % 2]):
+                    with lock:
+                        granted[i] += 1
+        except Exception as error:
+            errors.append(error)
+            barrier.abort()
+        finally:
+            if close:
+                connection.close()
+
+    start = time.time()
+    if threads == 1:
+        run(False)
+    else:
+        workers = [threading.Thread(target=run, args=(True,)) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    elapsed = time.time() - start
+
+    return {
+        'granted': granted,
+        'errors': errors,
+        'elapsed': elapsed,
+        'rate': threads * rounds / elapsed if elapsed else 0,
+    }
@@ -0,0 +1,272 @@
+"""In-memory card directory
+
+The directory maps every Card key to the card id and the person payload shown by the gate
+and the monitor, so a scan does not need to follow card.person, person.team and
+team.university. It is loaded in bulk on first use and kept up to date by the signal
+handlers in signals.py, once the change is committed.
+
+Signals only reach the process that made the change, so every change is also written as a
+DirectoryChange in its own transaction. Each process reads the changes committed since its
+last check at most once every SYNC_INTERVAL seconds, and reloads only the entries of the
+changed card, person, team or university. A change is read again for SLACK seconds, since a
+change may be committed after a later one, and applied once.
+
+The whole directory is reloaded once it is older than MAX_AGE seconds, which is shorter than
+DirectoryChange.RETENTION, and an unknown key is always looked up in the database before it
+is reported as unknown.
+
+"""
+
+import datetime
+import threading
+import time
+from django.db import connection
+from django.utils import timezone
+from .models import Card, DirectoryChange
+
+
+def change_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, timezone.utc)
+
+
+class CardDirectory:
+    MAX_AGE = 300
+    SYNC_INTERVAL = 1
+    SLACK = 30
+
+    def __init__(self):
+        self._entries = None
+        self._keys = {}
+        self._loaded_at = 0
+        self._synced_at = 0
+        self._applied = {}
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    @staticmethod
+    def cards():
+        """Queryset of cards with every relation used by the payload"""
+        return Card.objects.select_related('person__team__university')
+
+    @staticmethod
+    def person_payload(person):
+        """Build the person payload of a card"""
+        if person.photo_thumb:
+            photo = person.photo_thumb.url
+        elif person.photo:
+            photo = person.photo.url
+        else:
+            photo = None
+
+        return {
+            'name': person.name,
+            'gender': person.gender,
+            'team': person.team.name,
+            'division': person.team.get_division_display(),
+            'role': person.get_type_display(),
+            'university': person.team.university.name,
+            'photo': photo,
+        }
+
+    @staticmethod
+    def entry(card):
+        """Build a directory entry from a card"""
+        return {
+            'id': card.id,
+            'key': card.key,
+            'person_id': card.person_id,
+            'team_id': card.person.team_id,
+            'division': card.person.team.division,
+            'university_id': card.person.team.university_id,
+            'person': CardDirectory.person_payload(card.person),
+        }
+
+    def load(self):
+        """Load every card into the directory with a single query
+
+        Returns:
+            Tuple of the entries by key and the keys by card id
+
+        """
+        started = time.time()
+        applied = dict(DirectoryChange.objects.filter(
+            time__gte=change_time(started - self.SLACK)).values_list('id', 'time'))
+
+        entries = {}
+        keys = {}
+        for card in self.cards():
+            entries[card.key] = self.entry(card)
+            keys[card.id] = card.key
+
+        with self._lock:
+            self._entries = entries
+            self._keys = keys
+            self._loaded_at = started
+            self._synced_at = started
+            self._applied = applied
+
+        return entries, keys
+
+    def sync(self):
+        """Apply the changes committed by every process since the last sync
+
+        Only one thread syncs at a time, the others keep using the current entries.
+
+        """
+        if not self._sync_lock.acquire(blocking=False):
+            return
+
+        try:
+            started = time.time()
+            since = change_time(self._synced_at - self.SLACK)
+            changes = DirectoryChange.objects.filter(time__gte=since).order_by('id')
+            for change in changes.values_list('id', 'field', 'value', 'time'):
+                self.apply(*change)
+
+            with self._lock:
+                self._synced_at = started
+                self._applied = {i: t for i, t in self._applied.items() if t >= since}
+        finally:
+            self._sync_lock.release()
+
+    def apply(self, change_id, field, value, changed_at):
+        """Reload the entries of a change, unless it is already applied"""
+        with self._lock:
+            if self._entries is None or change_id in self._applied:
+                return
+            self._applied[change_id] = changed_at
+
+        if field == 'card_id':
+            self.remove(value)
+            self.refresh(self.cards().filter(pk=value))
+        else:
+            self.refresh_related(field, value)
+
+    def clear(self):
+        """Drop every entry, the directory will be reloaded on next use"""
+        with self._lock:
+            self._entries = None
+            self._keys = {}
+
+    def is_loaded(self):
+        return self._entries is not None
+
+    def check(self):
+        """Load or sync the directory if it is due, called before a transaction using it"""
+        self._current()
+
+    def _current(self):
+        """Load or sync the directory if needed
+
+        The changes are not read inside a transaction, which would then hold its locks
+        longer, so a lookup inside a transaction uses the entries of the last sync.
+
+        Returns:
+            Tuple of the entries by key and the keys by card id
+
+        """
+        with self._lock:
+            entries, keys = self._entries, self._keys
+            loaded_at, synced_at = self._loaded_at, self._synced_at
+
+        now = time.time()
+        if entries is None or now - loaded_at > self.MAX_AGE:
+            return self.load()
+        if now - synced_at > self.SYNC_INTERVAL and not connection.in_atomic_block:
+            self.sync()
+
+        return entries, keys
+
+    def get(self, key):
+        """Get the entry of a card key
+
+        Returns:
+            The entry dictionary, or None if no card has the key
+
+        """
+        entries, _ = self._current()
+        entry = entries.get(key)
+        if entry is None:
+            self.refresh(self.cards().filter(key=key))
+            entries, _ = self._current()
+            entry = entries.get(key)
+
+        return entry
+
+    def get_by_id(self, card_id):
+        """Get the entry of a card id
+
+        Returns:
+            The entry dictionary, or None if no card has the id
+
+        """
+        entries, keys = self._current()
+        key = keys.get(card_id)
+        if key is None:
+            self.refresh(self.cards().filter(pk=card_id))
+            entries, keys = self._current()
+            key = keys.get(card_id)
+
+        return entries.get(key) if key is not None else None
+
+    def refresh(self, cards):
+        """Reload the entries of the cards in a queryset"""
+        if not self.is_loaded():
+            return
+
+        entries = [self.entry(card) for card in cards]
+        with self._lock:
+            if self._entries is None:
+                return
+            for entry in entries:
+                self._remove(entry['id'])
+                if entry['key'] in self._entries:
+                    self._remove(self._entries[entry['key']]['id'])
+                self._entries[entry['key']] = entry
+                self._keys[entry['id']] = entry['key']
+
+    def discard(self, key):
+        """Remove the entry of a key found stale, the next lookup reads the database"""
+        if not self.is_loaded():
+            return
+
+        with self._lock:
+            entry = self._entries.get(key) if self._entries is not None else None
+            if entry is not None:
+                self._remove(entry['id'])
+
+    def remove(self, card_id):
+        """Remove the entry of a card id"""
+        if not self.is_loaded():
+            return
+
+        with self._lock:
+            self._remove(card_id)
+
+    def _remove(self, card_id):
+        key = self._keys.pop(card_id, None)
+        if key is not None and self._entries is not None:
+            self._entries.pop(key, None)
+
+    def refresh_related(self, field, value):
+        """Reload the entries whose person, team or university has changed
+
+        Args:
+            - field: one of 'person_id', 'team_id' or 'university_id'
+            - value: id of the changed object
+
+        """
+        if not self.is_loaded():
+            return
+
+        with self._lock:
+            entries = list(self._entries.values()) if self._entries is not None else []
+
+        card_ids = [e['id'] for e in entries if e[field] == value]
+        if card_ids:
+            for card_id in card_ids:
+                self.remove(card_id)
+            self.refresh(self.cards().filter(pk__in=card_ids))
+
+
+directory = CardDirectory()
@@ -0,0 +1,48 @@
+import csv
+import io
+from django import forms
+
+
+class CardImportForm(forms.Form):
+    """Upload form for Card.import_keys"""
+    file = forms.FileField(help_text='CSV with a person_id or instance_id column and a '
+                                     'card_key column.')
+    dry_run = forms.BooleanField(required=False, initial=True,
+                                 help_text='Only validate the file, do not register the cards.')
+
+    def clean_file(self):
+        upload = self.cleaned_data['file']
+        try:
+            self.cleaned_data['field'], self.cleaned_data['rows'] = read_card_csv(
+                io.TextIOWrapper(upload.file, encoding='utf-8-sig'))
+        except (ValueError, UnicodeDecodeError, csv.Error) as error:
+            raise forms.ValidationError(str(error))
+
+        return upload
+
+
+def read_card_csv(text_file):
+    """Read (person, card_key) pairs from a csv file
+
+    The header must contain card_key and either person_id or instance_id.
+
+    Returns:
+        Tuple of the person field and the list of pairs
+
+    Raises:
+        - ValueError: the header is invalid
+
+    """
+    reader = csv.DictReader(text_file)
+    header = reader.fieldnames or []
+    if 'card_key' not in header:
+        raise ValueError('The file has no card_key column.')
+
+    if 'person_id' in header:
+        field = 'person_id'
+    elif 'instance_id' in header:
+        field = 'instance_id'
+    else:
+        raise ValueError('The file has no person_id or instance_id column.')
+
+    return field, [(row[field] or '', row['card_key'] or '') for row in reader]
@@ -0,0 +1,265 @@
+"""Offline tolerant gate
+
+The gate records every scan in a local append-only SQLite journal and answers right away
+from the card status it keeps locally, so the queue keeps moving while the server is slow or
+unreachable. A background thread replays the journal to attendance/batch/. Every event has
+a unique id, so retrying a batch never creates a duplicate CardLog.
+
+This module only uses the standard library, so it can run on a gate machine without the
+rest of the project. Card keys are read from standard input, one per line:
+
+    python -m kri.apps.attendance.gate [login|logout] USERNAME PASSWORD [HOST] [JOURNAL]
+
+"""
+
+import datetime
+import http.cookiejar
+import json
+import sqlite3
+import sys
+import threading
+import urllib.parse
+import urllib.request
+import uuid
+
+
+class Journal:
+    """Local journal of scans and cache of card status"""
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS card ('
+                'key TEXT PRIMARY KEY, person TEXT, inside INTEGER NOT NULL)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS event ('
+                'seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT UNIQUE NOT NULL, '
+                'card_key TEXT NOT NULL, activity TEXT NOT NULL, time TEXT NOT NULL, '
+                'result TEXT NOT NULL, synced INTEGER NOT NULL DEFAULT 0)')
+
+    def load_cards(self, cards):
+        """Replace the card cache with the cards listed by the server
+
+        The status of cards with events not yet replayed is kept, since the server does not
+        know about those events yet. Cards no longer listed are removed, so their scans are
+        unknown.
+
+        """
+        with self.lock, self.connection:
+            pending = set(row[0] for row in self.connection.execute(
+                'SELECT DISTINCT card_key FROM event WHERE synced = 0'))
+            keys = set(card['key'] for card in cards)
+            self.connection.executemany('DELETE FROM card WHERE key = ?', [
+                row for row in self.connection.execute('SELECT key FROM card').fetchall()
+                if row[0] not in keys])
+            for card in cards:
+                if card['key'] in pending:
+                    self.connection.execute(
+                        'UPDATE card SET person = ? WHERE key = ?',
+                        (json.dumps(card['person']), card['key']))
+                else:
+                    self.connection.execute(
+                        'INSERT OR REPLACE INTO card (key, person, inside) VALUES (?, ?, ?)',
+                        (card['key'], json.dumps(card['person']), int(card['inside'])))
+
+    def scan(self, card_key, activity):
+        """Record a scan and decide it from the local card status
+
+        Returns:
+            Tuple of the result ('granted', 'denied' or 'unknown') and the person payload
+
+        """
+        assert activity in ['login', 'logout']
+
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                'SELECT person, inside FROM card WHERE key = ?', (card_key,)).fetchone()
+            if row is None:
+                result, person = 'unknown', None
+            else:
+                person = json.loads(row[0])
+                inside = activity == 'login'
+                if bool(row[1]) != inside:
+                    result = 'granted'
+                    self.connection.execute(
+                        'UPDATE card SET inside = ? WHERE key = ?', (int(inside), card_key))
+                else:
+                    result = 'denied'
+
+            self.connection.execute(
+                'INSERT INTO event (id, card_key, activity, time, result) VALUES (?, ?, ?, ?, ?)',
+                (str(uuid.uuid4()), card_key, activity,
+                 datetime.datetime.now(datetime.timezone.utc).isoformat(), result))
+
+        return result, person
+
+    def pending(self, limit):
+        """Get the oldest events not yet replayed to the server"""
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT id, card_key, activity, time FROM event WHERE synced = 0 '
+                'ORDER BY seq LIMIT ?', (limit,)).fetchall()
+
+        return [{'id': r[0], 'card_key': r[1], 'activity': r[2], 'time': r[3]} for r in rows]
+
+    def mark_synced(self, results):
+        """Store the results returned by the server for the replayed events"""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'UPDATE event SET synced = 1, result = ? WHERE id = ?',
+                [(r['result'], r['id']) for r in results])
+
+
+class Client:
+    """Staff session to the attendance server"""
+
+    def __init__(self, host, username, password, timeout=5):
+        self.host = host.rstrip('/')
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookies))
+        self.authenticated = False
+
+    def csrf_token(self):
+        for cookie in self.cookies:
+            if cookie.name == 'csrftoken':
+                return cookie.value
+
+        return ''
+
+    def login(self):
+        """Log in through the admin login form"""
+        url = self.host + '/ksk/login/'
+        self.opener.open(url, timeout=self.timeout).read()
+        data = urllib.parse.urlencode({
+            'username': self.username,
+            'password': self.password,
+            'csrfmiddlewaretoken': self.csrf_token(),
+            'next': '/ksk/',
+        }).encode('utf-8')
+        request = urllib.request.Request(url, data, headers={'Referer': url})
+        self.opener.open(request, timeout=self.timeout).read()
+        self.authenticated = True
+
+    def request(self, path, payload=None):
+        """Send a request and decode the JSON response"""
+        if not self.authenticated:
+            self.login()
+
+        headers = {'Referer': self.host + '/', 'X-CSRFToken': self.csrf_token()}
+        data = None
+        if payload is not None:
+            data = json.dumps(payload).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+
+        request = urllib.request.Request(self.host + path, data, headers=headers)
+        response = self.opener.open(request, timeout=self.timeout)
+
+        return json.loads(response.read().decode('utf-8'))
+
+    def cards(self):
+        return self.request('/attendance/cards/')['cards']
+
+    def batch(self, events):
+        return self.request('/attendance/batch/', {'events': events})
+
+
+class Gate:
+    """Scan from the journal and replay it to the server in the background"""
+    BATCH_SIZE = 200
+    SYNC_INTERVAL = 2
+    REFRESH_INTERVAL = 300
+
+    def __init__(self, journal, client):
+        self.journal = journal
+        self.client = client
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def scan(self, card_key, activity):
+        return self.journal.scan(card_key, activity)
+
+    def refresh(self):
+        """Reload the card cache from the server"""
+        self.journal.load_cards(self.client.cards())
+
+    def sync(self):
+        """Replay every pending event to the server
+
+        Returns:
+            Number of events replayed
+
+        Raises:
+            Any error from the client. The events stay in the journal and are replayed again
+            on the next call.
+
+        """
+        count = 0
+        while True:
+            events = self.journal.pending(self.BATCH_SIZE)
+            if not events:
+                return count
+
+            response = self.client.batch(events)
+            if response.get('status') != 'success':
+                raise RuntimeError(response.get('message'))
+
+            self.journal.mark_synced(response['results'])
+            count += len(events)
+
+    def run(self):
+        """Sync until stopped, retrying whenever the server is unreachable"""
+        refreshed = 0
+        while not self.stopped.is_set():
+            try:
+                if refreshed <= 0:
+                    self.refresh()
+                    refreshed = self.REFRESH_INTERVAL
+                self.sync()
+            except Exception as error:
+                print('sync failed: {0}'.format(error), file=sys.stderr)
+                self.client.authenticated = False
+
+            refreshed -= self.SYNC_INTERVAL
+            self.stopped.wait(self.SYNC_INTERVAL)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def main(argv):
+    if len(argv) < 4 or argv[1] not in ('login', 'logout'):
+        print(__doc__, file=sys.stderr)
+        return 1
+
+    activity, username, password = argv[1:4]
+    host = argv[4] if len(argv) > 4 else 'https://kri2017.ugm.ac.id'
+    path = argv[5] if len(argv) > 5 else 'gate-journal.sqlite3'
+
+    gate = Gate(Journal(path), Client(host, username, password))
+    gate.start()
+
+    try:
+        for line in sys.stdin:
+            card_key = line.strip()
+            if card_key:
+                result, person = gate.scan(card_key, activity)
+                print('{0} {1}: {2}'.format(activity, result, person['name'] if person else '-'))
+    finally:
+        gate.stop()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,47 @@
+"""Move old CardLog to the archive table"""
+
+import datetime
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime, parse_date
+from kri.apps.attendance.models import ArchivedCardLog
+
+
+class Command(BaseCommand):
+    help = 'Move CardLog older than a cutoff to the archive table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--before', help='Cutoff date or datetime in ISO 8601 format')
+        parser.add_argument('--days', type=int, help='Archive logs older than this many days')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of logs moved in each transaction')
+
+    def handle(self, *args, **options):
+        if options['before']:
+            before = cutoff(options['before'])
+        elif options['days'] is not None:
+            before = timezone.now() - datetime.timedelta(days=options['days'])
+        else:
+            raise CommandError('Either --before or --days is required.')
+
+        count = ArchivedCardLog.archive(before, options['chunk_size'])
+
+        self.stdout.write('Archived {0} logs older than {1}.'.format(count, before.isoformat()))
+
+
+def cutoff(value):
+    """Parse the --before argument to an aware datetime"""
+    try:
+        before = parse_datetime(value)
+        if before is None:
+            date = parse_date(value)
+            if date is None:
+                raise ValueError
+            before = datetime.datetime.combine(date, datetime.time())
+    except ValueError:
+        raise CommandError('Invalid --before: {0}'.format(value))
+
+    if timezone.is_naive(before):
+        before = timezone.make_aware(before)
+
+    return before
@@ -0,0 +1,44 @@
+"""Measure card transitions per second under concurrent scans"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from kri.apps.attendance.benchmark import scan_concurrently
+from kri.apps.attendance.models import Card
+
+
+class Command(BaseCommand):
+    help = ('Scan a card from many threads at once and report the transitions per second. '
+            'No CardLog is written and the card status is restored at the end.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('card_key', help='Key of the scanned card')
+        parser.add_argument('--threads', type=int, default=8,
+                            help='Number of concurrent scanning threads')
+        parser.add_argument('--rounds', type=int, default=20,
+                            help='Number of scans of each thread')
+
+    def handle(self, *args, **options):
+        if options['threads'] < 1 or options['rounds'] < 1:
+            raise CommandError('--threads and --rounds must be positive.')
+
+        try:
+            card = Card.objects.get(key=options['card_key'])
+        except Card.DoesNotExist:
+            raise CommandError('Card {0} not found.'.format(options['card_key']))
+
+        result = scan_concurrently(card.id, options['threads'], options['rounds'])
+
+        # Odd rounds leave the card in the other status, which also moves its occupancy back
+        if Card.objects.get(pk=card.id).inside != card.inside:
+            Card.transition(card.id, 'login' if card.inside else 'logout', timezone.now())
+        Card.objects.filter(pk=card.id).update(last_login=card.last_login,
+                                               last_logout=card.last_logout)
+
+        for error in result['errors']:
+            self.stderr.write(repr(error))
+        if result['errors']:
+            raise CommandError('{0} threads failed.'.format(len(result['errors'])))
+
+        self.stdout.write('{0:.0f} scans/s with {1} threads, {2} granted of {3} scans.'.format(
+            result['rate'], options['threads'], sum(result['granted']),
+            options['threads'] * options['rounds']))
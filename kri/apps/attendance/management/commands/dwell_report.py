@@ -0,0 +1,38 @@
+"""Write the dwell time report"""
+
+from django.core.management.base import BaseCommand, CommandError
+from kri.apps.attendance import reports
+from kri.apps.attendance.views import parse_time
+
+
+class Command(BaseCommand):
+    help = 'Write first in, last out and time inside per person or team for each day'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=('csv', 'json'), default='csv')
+        parser.add_argument('--group', choices=('person', 'team'), default='person')
+        parser.add_argument('--start', help='Only logs at or after this ISO 8601 time')
+        parser.add_argument('--end', help='Only logs before this ISO 8601 time')
+        parser.add_argument('--output', help='Output file, default to standard output')
+
+    def handle(self, *args, **options):
+        try:
+            start = parse_time(options['start'])
+            end = parse_time(options['end'])
+        except ValueError as error:
+            raise CommandError(error)
+
+        if options['group'] == 'team':
+            rows, fields = reports.team_dwell_times(start, end), reports.TEAM_DWELL_FIELDS
+        else:
+            rows, fields = reports.dwell_times(start, end), reports.DWELL_FIELDS
+
+        render = reports.json_lines if options['format'] == 'json' else reports.csv_lines
+
+        if options['output']:
+            with open(options['output'], 'w', newline='') as output:
+                for line in render(rows, fields):
+                    output.write(line)
+        else:
+            for line in render(rows, fields):
+                self.stdout.write(line, ending='')
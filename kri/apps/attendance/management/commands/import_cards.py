@@ -0,0 +1,33 @@
+"""Register cards from a csv file"""
+
+from django.core.management.base import BaseCommand, CommandError
+from kri.apps.attendance.forms import read_card_csv
+from kri.apps.attendance.models import Card
+
+
+class Command(BaseCommand):
+    help = 'Register cards from a csv with a person_id or instance_id column and a card_key column'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV file to import')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only validate the file, do not register the cards')
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['path'], encoding='utf-8-sig', newline='') as text_file:
+                field, rows = read_card_csv(text_file)
+        except (OSError, ValueError) as error:
+            raise CommandError(error)
+
+        cards, errors = Card.import_keys(rows, field, options['dry_run'])
+
+        for error in errors:
+            self.stderr.write(error)
+
+        if errors:
+            raise CommandError('{0} errors found, no card registered.'.format(len(errors)))
+        elif options['dry_run']:
+            self.stdout.write('{0} cards are valid.'.format(len(cards)))
+        else:
+            self.stdout.write('{0} cards registered.'.format(len(cards)))
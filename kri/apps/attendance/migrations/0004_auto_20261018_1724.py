@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.6 on 2026-10-18 10:24
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def compute_inside(apps, schema_editor):
+    """Set the inside status from the login and logout time, then count the occupancy"""
+    Card = apps.get_model('attendance', 'Card')
+    Occupancy = apps.get_model('attendance', 'Occupancy')
+
+    Card.objects.filter(last_login__isnull=False, last_logout__isnull=True).update(inside=True)
+    Card.objects.filter(last_login__gt=models.F('last_logout')).update(inside=True)
+
+    counts = (Card.objects.filter(inside=True)
+              .values('person__team__division', 'person__team__university')
+              .annotate(count=models.Count('id')))
+    Occupancy.objects.bulk_create([
+        Occupancy(division=c['person__team__division'],
+                  university_id=c['person__team__university'], count=c['count'])
+        for c in counts
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('participant', '0007_auto_20170506_0037'),
+        ('attendance', '0003_auto_20261018_1720'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Occupancy',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('division', models.CharField(choices=[('krai', 'KRAI'), ('krsbi_beroda', 'KRSBI Beroda'), ('krsti', 'KRSTI'), ('krpai', 'KRPAI'), ('pers', 'PERS')], max_length=12)),
+                ('count', models.IntegerField(default=0)),
+                ('university', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='participant.University')),
+            ],
+            options={
+                'verbose_name_plural': 'Occupancies',
+            },
+        ),
+        migrations.AddField(
+            model_name='card',
+            name='inside',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterUniqueTogether(
+            name='occupancy',
+            unique_together=set([('division', 'university')]),
+        ),
+        migrations.RunPython(compute_inside, migrations.RunPython.noop),
+    ]
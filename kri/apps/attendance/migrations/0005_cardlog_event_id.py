@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.6 on 2026-10-18 10:25
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attendance', '0004_auto_20261018_1724'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cardlog',
+            name='event_id',
+            field=models.CharField(blank=True, max_length=36, null=True, unique=True),
+        ),
+    ]
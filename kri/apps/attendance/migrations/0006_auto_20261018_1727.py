@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.6 on 2026-10-18 10:27
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('attendance', '0005_cardlog_event_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedCardLog',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('activity', models.CharField(choices=[('login_granted', 'Log In Granted'), ('login_denied', 'Log In Denied'), ('logout_granted', 'Log Out Granted'), ('logout_denied', 'Log Out Denied')], max_length=15)),
+                ('time', models.DateTimeField()),
+                ('event_id', models.CharField(blank=True, max_length=36, null=True)),
+                ('admin', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                ('card', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='attendance.Card')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='cardlog',
+            index_together=set([('card', 'time'), ('admin', 'time')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='archivedcardlog',
+            index_together=set([('card', 'time'), ('admin', 'time')]),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.6 on 2026-10-18 11:05
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('attendance', '0006_auto_20261018_1727'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='archivedcardlog',
+            index_together=set([('time', 'id'), ('admin', 'time'), ('card', 'time')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='cardlog',
+            index_together=set([('time', 'id'), ('admin', 'time'), ('card', 'time')]),
+        ),
+    ]
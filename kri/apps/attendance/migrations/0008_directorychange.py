@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.6 on 2026-10-18 11:22
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attendance', '0007_history_time_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirectoryChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.CharField(choices=[('card_id', 'Card'), ('person_id', 'Person'), ('team_id', 'Team'), ('university_id', 'University')], max_length=13)),
+                ('value', models.IntegerField()),
+                ('time', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.6 on 2026-10-18 11:32
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def store_inside_bucket(apps, schema_editor):
+    """Store the division and university of the cards inside, then count the occupancy again"""
+    Card = apps.get_model('attendance', 'Card')
+    Occupancy = apps.get_model('attendance', 'Occupancy')
+
+    for card in Card.objects.filter(inside=True).select_related('person__team'):
+        card.inside_division = card.person.team.division
+        card.inside_university_id = card.person.team.university_id
+        card.save(update_fields=['inside_division', 'inside_university'])
+
+    counts = (Card.objects.filter(inside=True)
+              .values('inside_division', 'inside_university')
+              .annotate(count=models.Count('id')))
+    Occupancy.objects.all().delete()
+    Occupancy.objects.bulk_create([
+        Occupancy(division=c['inside_division'], university_id=c['inside_university'],
+                  count=c['count'])
+        for c in counts
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('participant', '0009_completeness'),
+        ('attendance', '0008_directorychange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='card',
+            name='inside_division',
+            field=models.CharField(blank=True, choices=[('krai', 'KRAI'), ('krsbi_beroda', 'KRSBI Beroda'), ('krsti', 'KRSTI'), ('krpai', 'KRPAI'), ('pers', 'PERS')], max_length=12),
+        ),
+        migrations.AddField(
+            model_name='card',
+            name='inside_university',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='participant.University'),
+        ),
+        migrations.RunPython(store_inside_bucket, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.6 on 2026-10-18 11:34
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attendance', '0009_card_inside_bucket'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='archivedcardlog',
+            name='event_id',
+            field=models.CharField(blank=True, db_index=True, max_length=36, null=True),
+        ),
+    ]
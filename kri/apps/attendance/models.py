@@ -1,8 +1,11 @@
-from django.db import models
+import datetime
+import heapq
+import itertools
+from django.db import models, transaction, IntegrityError
 from django.core.exceptions import PermissionDenied
 from django.utils import timezone
 from django.contrib.auth.models import User
-from kri.apps.participant.models import Person
+from kri.apps.participant.models import University, Team, Person
 
 
 class Card(models.Model):
@@ -11,43 +14,151 @@ class Card(models.Model):
     register_time = models.DateTimeField(auto_now_add=True)
     last_login = models.DateTimeField(null=True, blank=True)
     last_logout = models.DateTimeField(null=True, blank=True)
+    inside = models.BooleanField(default=False)
+    inside_division = models.CharField(max_length=12, choices=Team.TEAM_DIVISION, blank=True)
+    inside_university = models.ForeignKey(University, null=True, blank=True,
+                                          on_delete=models.SET_NULL, related_name='+')
 
-    def login(self):
+    def login(self, time=None):
         """Log the card in
 
         Any card can only be logged in if it's status is logged out. Attempt to login while
         it's logged in will be ignored.
 
+        Args:
+            - time: time of the login, defaults to now
+
         Returns:
             True if login is success, otherwise False
 
         """
-        if not self.logged_in():
-            self.last_login = timezone.now()
-            self.save()
-
+        time = time or timezone.now()
+        if Card.transition(self.pk, 'login', time):
+            self.last_login = time
+            self.inside = True
             return True
 
         return False
 
-    def logout(self):
+    def logout(self, time=None):
         """Log the card out
 
         Any card can only be logged out if it's status is logged in. Attempt to logout while
         it's logged out will be ignored.
 
+        Args:
+            - time: time of the logout, defaults to now
+
         Returns:
             True if logout is success, otherwise False
 
         """
-        if self.logged_in():
-            self.last_logout = timezone.now()
-            self.save()
-
+        time = time or timezone.now()
+        if Card.transition(self.pk, 'logout', time):
+            self.last_logout = time
+            self.inside = False
             return True
 
         return False
 
+    @staticmethod
+    def transition(card_id, activity, time, key=None):
+        """Log a card in or out with a single conditional UPDATE
+
+        The card status is checked by the UPDATE statement itself, so two gates scanning the
+        same card at once can never both be granted. Only the changed columns are written. The
+        Occupancy counters are updated in the same transaction when the transition is granted.
+
+        A login stores the division and university counting the card, and the logout takes
+        the card off the same counter, even if its team was moved in between.
+
+        Args:
+            - key: if given, the card must still have this key
+
+        Returns:
+            True if the transition is granted, otherwise False
+
+        """
+        from .directory import directory
+
+        assert activity in ['login', 'logout']
+
+        inside = activity == 'login'
+        cards = Card.objects.filter(pk=card_id, inside=not inside)
+        if key is not None:
+            cards = cards.filter(key=key)
+
+        values = {'inside': inside, 'last_' + activity: time}
+        if inside:
+            entry = directory.get_by_id(card_id)
+            values['inside_division'] = entry['division'] if entry else ''
+            values['inside_university_id'] = entry['university_id'] if entry else None
+
+        with transaction.atomic():
+            updated = cards.update(**values)
+
+            if updated == 1 and inside:
+                Occupancy.record(values['inside_division'], values['inside_university_id'], 1)
+            elif updated == 1:
+                division, university_id = Card.objects.filter(pk=card_id).values_list(
+                    'inside_division', 'inside_university_id').get()
+                Occupancy.record(division, university_id, -1)
+
+        return updated == 1
+
+    @staticmethod
+    def current_id(card_key):
+        """Get the id of the card of a key, checked in the database
+
+        A card deleted or given another key in another process may leave a stale entry in
+        the card directory until it is reloaded. A stale entry is dropped and the key is
+        looked up again.
+
+        Returns:
+            The card id, or None if no card has the key
+
+        """
+        from .directory import directory
+
+        entry = directory.get(card_key)
+        if entry is not None and not Card.objects.filter(pk=entry['id'], key=card_key).exists():
+            directory.discard(card_key)
+            entry = directory.get(card_key)
+
+        return entry['id'] if entry is not None else None
+
+    @staticmethod
+    def transition_key(card_key, activity, time):
+        """Log the card of a key in or out, see transition
+
+        The card is found in the card directory. When the UPDATE matches no row, the card is
+        checked in the database, so a stale entry is neither granted nor logged.
+
+        Returns:
+            Tuple of the card id and whether the transition is granted
+
+        Raises:
+            - Card.DoesNotExist: no card has the key
+
+        """
+        from .directory import directory
+
+        entry = directory.get(card_key)
+        if entry is None:
+            raise Card.DoesNotExist('Card matching query does not exist.')
+
+        if Card.transition(entry['id'], activity, time, card_key):
+            return entry['id'], True
+
+        card_id = Card.current_id(card_key)
+        if card_id is None:
+            raise Card.DoesNotExist('Card matching query does not exist.')
+
+        if card_id != entry['id'] and Card.transition(card_id, activity, time, card_key):
+            return card_id, True
+
+        return card_id, False
+
     def logged_in(self):
         """Check card status
 
@@ -55,11 +166,58 @@ class Card(models.Model):
             Whether the card's status is logged in or logged out.
 
         """
-        if self.last_login is not None:
-            if self.last_logout is None or self.last_login > self.last_logout:
-                return True
+        return self.inside
 
-        return False
+    @staticmethod
+    def reconcile(card_id, time):
+        """Recompute the card status after a log older than its last transition is inserted
+
+        Each log from time onwards is granted or denied again in order of time, starting
+        from the status left by the last granted log before time. The card's last_login,
+        last_logout, inside status and the Occupancy counter are then updated to match.
+
+        Must be called inside a transaction.
+
+        """
+        from .directory import directory
+
+        card = Card.objects.select_for_update().get(pk=card_id)
+        logs = CardLog.objects.filter(card_id=card_id)
+
+        previous = logs.filter(time__lt=time, activity__endswith='_granted').order_by(
+            '-time', '-id').first()
+        inside = previous is not None and previous.activity == 'login_granted'
+
+        for log in logs.filter(time__gte=time).order_by('time', 'id'):
+            activity = log.activity.split('_')[0]
+            if (activity == 'login') != inside:
+                inside = not inside
+                result = activity + '_granted'
+            else:
+                result = activity + '_denied'
+
+            if log.activity != result:
+                log.activity = result
+                log.save(update_fields=['activity'])
+
+        last = logs.values('activity').filter(activity__endswith='_granted').annotate(
+            last=models.Max('time'))
+        last = {l['activity']: l['last'] for l in last}
+        card.last_login = last.get('login_granted')
+        card.last_logout = last.get('logout_granted')
+
+        if card.inside != inside:
+            if inside:
+                entry = directory.get_by_id(card_id)
+                card.inside_division = entry['division'] if entry else ''
+                card.inside_university_id = entry['university_id'] if entry else None
+
+            Occupancy.record(card.inside_division, card.inside_university_id,
+                             1 if inside else -1)
+            card.inside = inside
+
+        card.save(update_fields=['last_login', 'last_logout', 'inside', 'inside_division',
+                                 'inside_university'])
 
     @staticmethod
     def register(person_id, key):
@@ -68,6 +226,80 @@ class Card(models.Model):
 
         return Card.objects.create(person=person, key=key)
 
+    @staticmethod
+    def import_keys(rows, field='person_id', dry_run=False):
+        """Register many cards at once
+
+        Every row is validated in memory against one query for the persons and one query for
+        the registered cards. The cards are only created, with a single bulk insert in one
+        transaction, when no row has an error.
+
+        Args:
+            - rows: list of (person, card_key) pairs, where person is a Person id or
+              instance_id depending on field
+            - field: 'person_id' or 'instance_id'
+            - dry_run: validate only, do not create the cards
+
+        Returns:
+            Tuple of the list of valid cards and the list of error messages. The cards are
+            saved if the list of errors is empty and dry_run is False.
+
+        """
+        assert field in ['person_id', 'instance_id']
+
+        rows = [(str(person).strip(), str(key).strip()) for person, key in rows]
+        values = set(person for person, _ in rows)
+        keys = set(key for _, key in rows)
+
+        if field == 'person_id':
+            ids = [int(v) for v in values if v.isdigit()]
+            persons = {str(p.id): [p] for p in Person.objects.filter(pk__in=ids)}
+        else:
+            persons = {}
+            for person in Person.objects.filter(instance_id__in=values):
+                persons.setdefault(person.instance_id, []).append(person)
+
+        registered_keys = set(Card.objects.filter(key__in=keys).values_list('key', flat=True))
+        person_ids = [p.id for matches in persons.values() for p in matches]
+        registered_persons = set(Card.objects.filter(person_id__in=person_ids).values_list(
+            'person_id', flat=True))
+
+        cards = []
+        errors = []
+        seen_keys = {}
+        seen_persons = {}
+        for line, (value, key) in enumerate(rows, 1):
+            matches = persons.get(value, [])
+            if not key:
+                errors.append('Row {0}: card key is empty.'.format(line))
+            elif not matches:
+                errors.append('Row {0}: no person with {1} {2}.'.format(line, field, value))
+            elif len(matches) > 1:
+                errors.append('Row {0}: {1} {2} matches {3} persons.'.format(
+                    line, field, value, len(matches)))
+            elif key in seen_keys:
+                errors.append('Row {0}: card key {1} is duplicated on row {2}.'.format(
+                    line, key, seen_keys[key]))
+            elif matches[0].id in seen_persons:
+                errors.append('Row {0}: {1} is duplicated on row {2}.'.format(
+                    line, matches[0].name, seen_persons[matches[0].id]))
+            elif key in registered_keys:
+                errors.append('Row {0}: card key {1} is already registered.'.format(line, key))
+            elif matches[0].id in registered_persons:
+                errors.append('Row {0}: {1} already has a card.'.format(line, matches[0].name))
+            else:
+                cards.append(Card(person=matches[0], key=key))
+
+            seen_keys.setdefault(key, line)
+            if len(matches) == 1:
+                seen_persons.setdefault(matches[0].id, line)
+
+        if not errors and not dry_run:
+            with transaction.atomic():
+                Card.objects.bulk_create(cards)
+
+        return cards, errors
+
 
 class CardLog(models.Model):
     ACTIVITY = (
@@ -80,7 +312,11 @@ class CardLog(models.Model):
     card = models.ForeignKey(Card, on_delete=models.CASCADE)
     admin = models.ForeignKey(User, on_delete=models.CASCADE)
     activity = models.CharField(max_length=15, choices=ACTIVITY)
-    time = models.DateTimeField(auto_now_add=True)
+    time = models.DateTimeField(default=timezone.now)
+    event_id = models.CharField(max_length=36, unique=True, null=True, blank=True)
+
+    class Meta:
+        index_together = [('admin', 'time'), ('card', 'time'), ('time', 'id')]
 
     @staticmethod
     def login(card_key, admin):
@@ -106,28 +342,167 @@ class CardLog(models.Model):
     def create_log(card_key, activity, admin):
         """Create an activity log
 
+        The card transition and the log are written in the same transaction.
+
         Returns:
             The CardLog object
 
+        Raises:
+            - Card.DoesNotExist: no card has the key
+            - PermissionDenied: admin has no permission to add CardLog
+
         """
         assert activity in ['login', 'logout']
 
+        if not admin.has_perm('attendance.add_cardlog'):
+            raise PermissionDenied
+
+        from .directory import directory
+        from .notifier import notifier
+
+        directory.check()
+        time = timezone.now()
+        with transaction.atomic():
+            card_id, granted = Card.transition_key(card_key, activity, time)
+            log_activity = activity + ('_granted' if granted else '_denied')
+            notifier.notify()
+
+            return CardLog.objects.create(card_id=card_id, admin=admin,
+                                          activity=log_activity, time=time)
+
+    @staticmethod
+    def create_logs(events, admin):
+        """Create activity logs for a batch of card events
+
+        The events are applied in the given order inside a single transaction. Cards are
+        looked up in the card directory and the logs are written with bulk inserts.
+
+        An event may carry a unique event id. An event whose id is already logged, or
+        archived, is not applied again and returns the result it got the first time, so a
+        gate can safely retry a batch. When a concurrent batch logs one of the event ids
+        first, the whole batch is rolled back and applied again.
+
+        An event older than the card's latest log is inserted at its place in the card history
+        and the card status is reconciled with Card.reconcile.
+
+        Args:
+            - events: list of (card_key, activity, time) or (card_key, activity, time,
+              event_id) tuples. time may be None to use the current time.
+            - admin: the user who sent the events
+
+        Returns:
+            List of result for each event: 'granted', 'denied' or 'unknown'
+
+        Raises:
+            - PermissionDenied: admin has no permission to add CardLog
+            - AssertionError: an activity is neither login nor logout
+
+        """
+        events = [tuple(event) + (None,) * (4 - len(event)) for event in events]
+        for _, activity, _, _ in events:
+            assert activity in ['login', 'logout']
+
         if not admin.has_perm('attendance.add_cardlog'):
             raise PermissionDenied
 
         try:
-            card = Card.objects.get(key=card_key)
-        except Card.DoesNotExist:
-            raise
-        else:
-            if getattr(card, activity)():
-                log_activity = activity + '_granted'
-            else:
-                log_activity = activity + '_denied'
+            return CardLog._apply_logs(events, admin)
+        except IntegrityError:
+            return CardLog._apply_logs(events, admin)
+
+    @staticmethod
+    def _apply_logs(events, admin):
+        """Apply a batch of card events in a single transaction, see create_logs"""
+        from .directory import directory
+        from .notifier import notifier
+
+        directory.check()
+        logged = CardLog.logged_activities(
+            [event_id for _, _, _, event_id in events if event_id])
+
+        results = []
+        logs = []
+        with transaction.atomic():
+            for card_key, activity, time, event_id in events:
+                if event_id in logged:
+                    results.append(logged[event_id].split('_')[1])
+                    continue
+
+                entry = directory.get(card_key)
+                if entry is None:
+                    results.append('unknown')
+                    continue
+
+                if time is not None and CardLog.is_stale(entry['id'], time, logs):
+                    card_id = Card.current_id(card_key)
+                    if card_id is None:
+                        results.append('unknown')
+                        continue
+
+                    CardLog.objects.bulk_create(logs)
+                    logs = []
+                    log = CardLog.objects.create(card_id=card_id, admin=admin,
+                                                 activity=activity + '_denied', time=time,
+                                                 event_id=event_id)
+                    Card.reconcile(card_id, time)
+                    log.refresh_from_db(fields=['activity'])
+                    result = log.activity.split('_')[1]
+                else:
+                    time = time or timezone.now()
+                    try:
+                        card_id, granted = Card.transition_key(card_key, activity, time)
+                    except Card.DoesNotExist:
+                        results.append('unknown')
+                        continue
+
+                    result = 'granted' if granted else 'denied'
+                    logs.append(CardLog(card_id=card_id, admin=admin,
+                                        activity=activity + '_' + result, time=time,
+                                        event_id=event_id))
+
+                results.append(result)
+                if event_id:
+                    logged[event_id] = activity + '_' + result
+
+            CardLog.objects.bulk_create(logs)
+            notifier.notify()
+
+        return results
+
+    @staticmethod
+    def logged_activities(event_ids):
+        """Get the activity logged for each event id, in the live table or the archive
+
+        The live table is read first, so a log archived in between is found in the archive.
+
+        Returns:
+            Dictionary of the activity of each logged event id
+
+        """
+        if not event_ids:
+            return {}
 
-            return CardLog.objects.create(card=card, admin=admin, activity=log_activity)
+        logged = dict(CardLog.objects.filter(event_id__in=event_ids).values_list(
+            'event_id', 'activity'))
+        logged.update(ArchivedCardLog.objects.filter(event_id__in=event_ids).values_list(
+            'event_id', 'activity'))
 
-        return None
+        return logged
+
+    @staticmethod
+    def is_stale(card_id, time, pending=()):
+        """Check if the card has a log later than time
+
+        Args:
+            - card_id: id of the card
+            - time: time of the new log
+            - pending: logs not yet inserted to the database
+
+        """
+        if any(log.card_id == card_id and log.time > time for log in pending):
+            return True
+
+        return CardLog.objects.filter(card_id=card_id, time__gt=time).exists()
 
     @staticmethod
     def last_by_admin(admin):
@@ -136,3 +511,189 @@ class CardLog(models.Model):
             return CardLog.objects.filter(admin=admin).order_by('-time')[0]
         except IndexError:
             return None
+
+    @staticmethod
+    def history(card=None, admin=None, start=None, end=None, limit=None):
+        """Iterate logs from both CardLog and ArchivedCardLog ordered by time
+
+        Args:
+            - card: only logs of this card
+            - admin: only logs created by this admin
+            - start: only logs at or after this time
+            - end: only logs before this time
+            - limit: maximum number of logs, applied by each query before the merge
+
+        Yields:
+            Dictionary of id, card key, admin username, activity and time of each log
+
+        """
+        def logs(model):
+            queryset = model.objects.order_by('time', 'id')
+            if card is not None:
+                queryset = queryset.filter(card=card)
+            if admin is not None:
+                queryset = queryset.filter(admin=admin)
+            if start is not None:
+                queryset = queryset.filter(time__gte=start)
+            if end is not None:
+                queryset = queryset.filter(time__lt=end)
+
+            values = queryset.values('id', 'card__key', 'admin__username', 'activity', 'time')
+            if limit is not None:
+                values = values[:limit]
+            return ((log['time'], log['id'], log) for log in values.iterator())
+
+        merged = heapq.merge(logs(ArchivedCardLog), logs(CardLog))
+        for _, _, log in itertools.islice(merged, limit):
+            yield log
+
+
+class ArchivedCardLog(models.Model):
+    """CardLog moved out of the live table by the archive_cardlog command"""
+    id = models.IntegerField(primary_key=True)
+    card = models.ForeignKey(Card, on_delete=models.CASCADE)
+    admin = models.ForeignKey(User, on_delete=models.CASCADE)
+    activity = models.CharField(max_length=15, choices=CardLog.ACTIVITY)
+    time = models.DateTimeField()
+    event_id = models.CharField(max_length=36, null=True, blank=True, db_index=True)
+
+    class Meta:
+        index_together = [('admin', 'time'), ('card', 'time'), ('time', 'id')]
+
+    @staticmethod
+    def archive(before, chunk_size=1000):
+        """Move every CardLog older than a time to the archive
+
+        The logs are moved in chunks, each in its own transaction, so the live table is never
+        locked for long.
+
+        Returns:
+            Number of logs archived
+
+        """
+        count = 0
+        while True:
+            with transaction.atomic():
+                logs = list(CardLog.objects.select_for_update().filter(time__lt=before)
+                            .order_by('id')[:chunk_size])
+                if not logs:
+                    return count
+
+                ArchivedCardLog.objects.bulk_create([
+                    ArchivedCardLog(id=log.id, card_id=log.card_id, admin_id=log.admin_id,
+                                    activity=log.activity, time=log.time, event_id=log.event_id)
+                    for log in logs
+                ])
+                CardLog.objects.filter(id__in=[log.id for log in logs]).delete()
+
+            count += len(logs)
+
+
+class Occupancy(models.Model):
+    """Number of cards inside the venue for each division and university
+
+    The counters are updated together with every granted login and logout, so reading the
+    occupancy never needs to scan the cards. A card is counted in the division and university
+    of its team at login, which is stored on the card until its logout.
+
+    """
+    division = models.CharField(max_length=12, choices=Team.TEAM_DIVISION)
+    university = models.ForeignKey(University, on_delete=models.CASCADE)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('division', 'university')
+        verbose_name_plural = 'Occupancies'
+
+    @staticmethod
+    def record(division, university_id, delta):
+        """Add delta to the counter of a division and university"""
+        if university_id is None:
+            return
+
+        counter = Occupancy.objects.filter(division=division, university_id=university_id)
+        if counter.update(count=models.F('count') + delta) == 0:
+            try:
+                with transaction.atomic():
+                    Occupancy.objects.create(division=division, university_id=university_id,
+                                             count=delta)
+            except IntegrityError:
+                counter.update(count=models.F('count') + delta)
+
+    @staticmethod
+    def rebuild():
+        """Recount every counter from the cards inside the venue"""
+        counts = (Card.objects.filter(inside=True, inside_university__isnull=False)
+                  .values('inside_division', 'inside_university')
+                  .annotate(count=models.Count('id')))
+
+        with transaction.atomic():
+            Occupancy.objects.all().delete()
+            Occupancy.objects.bulk_create([
+                Occupancy(division=c['inside_division'], university_id=c['inside_university'],
+                          count=c['count'])
+                for c in counts
+            ])
+
+    @staticmethod
+    def summary():
+        """Get the occupancy of the venue
+
+        Returns:
+            Dictionary of the total, the count per division and the count per division of
+            each university
+
+        """
+        counters = Occupancy.objects.select_related('university').order_by(
+            'division', 'university__name')
+
+        divisions = {}
+        universities = []
+        for counter in counters:
+            division = counter.get_division_display()
+            divisions[division] = divisions.get(division, 0) + counter.count
+            universities.append({
+                'university': counter.university.name,
+                'division': division,
+                'count': counter.count,
+            })
+
+        return {
+            'total': sum(divisions.values()),
+            'divisions': divisions,
+            'universities': universities,
+        }
+
+
+class DirectoryChange(models.Model):
+    """Change of a card, person, team or university, read by the card directory of every process
+
+    A change is written in the transaction of the change itself, so it is only seen once the
+    change is committed. Changes older than RETENTION seconds are deleted.
+
+    """
+    FIELDS = (
+        ('card_id', 'Card'),
+        ('person_id', 'Person'),
+        ('team_id', 'Team'),
+        ('university_id', 'University'),
+    )
+    RETENTION = 60 * 60
+
+    field = models.CharField(max_length=13, choices=FIELDS)
+    value = models.IntegerField()
+    time = models.DateTimeField(default=timezone.now, db_index=True)
+
+    @staticmethod
+    def record(field, value):
+        """Record a change and delete the expired ones
+
+        Returns:
+            The DirectoryChange object
+
+        """
+        change = DirectoryChange.objects.create(field=field, value=value)
+        expired = change.time - datetime.timedelta(seconds=DirectoryChange.RETENTION)
+        DirectoryChange.objects.filter(time__lt=expired).delete()
+
+        return change
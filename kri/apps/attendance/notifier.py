@@ -0,0 +1,97 @@
+"""Wake the event streams when new CardLog are committed
+
+A stream waits on the notifier instead of reading the database on a timer. Every
+transaction creating logs calls notify, which wakes the streams of this process once the
+transaction is committed.
+
+On PostgreSQL notify also sends a NOTIFY on CHANNEL, which the server delivers at commit, and
+each process listens on CHANNEL from a thread with its own connection, so logs created by
+the other processes wake its streams too. On the other databases only the logs of this
+process wake its streams, the others are sent when the stream reconnects.
+
+"""
+
+import select
+import threading
+import time
+from django.db import connection, transaction
+
+CHANNEL = 'attendance_cardlog'
+
+
+class LogNotifier:
+    LISTEN_TIMEOUT = 60
+    RETRY_DELAY = 5
+
+    def __init__(self):
+        self.generation = 0
+        self._condition = threading.Condition()
+        self._listener = None
+
+    def notify(self):
+        """Wake the streams once the current transaction is committed"""
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('NOTIFY {0}'.format(CHANNEL))
+
+        transaction.on_commit(self.wake)
+
+    def wake(self):
+        """Wake every waiting stream"""
+        with self._condition:
+            self.generation += 1
+            self._condition.notify_all()
+
+    def wait(self, generation, timeout):
+        """Wait for a wake after the given generation
+
+        The generation must be read before checking for new logs, so a wake between the
+        check and the wait is not lost.
+
+        Returns:
+            True if woken, False on timeout
+
+        """
+        self.listen()
+
+        with self._condition:
+            return self._condition.wait_for(lambda: self.generation != generation, timeout)
+
+    def listen(self):
+        """Start the listening thread of this process on PostgreSQL"""
+        if connection.vendor != 'postgresql' or self._listener is not None:
+            return
+
+        with self._condition:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen,
+                                                  args=(connection.get_connection_params(),),
+                                                  daemon=True)
+                self._listener.start()
+
+    def _listen(self, params):
+        import psycopg2
+        import psycopg2.extensions
+
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**params)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute('LISTEN {0}'.format(CHANNEL))
+
+                while True:
+                    if select.select([conn], [], [], self.LISTEN_TIMEOUT)[0]:
+                        conn.poll()
+                        if conn.notifies:
+                            del conn.notifies[:]
+                            self.wake()
+            except psycopg2.Error:
+                # The streams still see the new logs when they reconnect
+                time.sleep(self.RETRY_DELAY)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+notifier = LogNotifier()
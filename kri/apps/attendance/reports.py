@@ -0,0 +1,186 @@
+"""Attendance reports
+
+The reports are computed in a single pass over the granted logs ordered by card and time.
+The logs are read in keyset chunks of REPORT_CHUNK rows, so only one chunk per log table is
+held in memory, whatever the database driver does with the result of a query.
+
+"""
+
+import csv
+import heapq
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils import timezone
+from .directory import directory
+from .models import ArchivedCardLog, CardLog
+
+DWELL_FIELDS = ('date', 'person_id', 'name', 'team', 'division', 'university', 'first_in',
+                'last_out', 'seconds_inside', 'sessions', 'unclosed')
+TEAM_DWELL_FIELDS = ('date', 'team', 'division', 'university', 'persons', 'first_in',
+                     'last_out', 'seconds_inside', 'unclosed')
+REPORT_CHUNK = 2000
+
+
+def granted_logs(start=None, end=None, chunk=REPORT_CHUNK):
+    """Iterate (card_id, time, activity) of the granted live and archived logs
+
+    The logs are ordered by card and time. Each table is read `chunk` rows at a time, the next
+    chunk starting after the (card_id, time, id) of the last row of the previous one.
+
+    """
+    def logs(model):
+        queryset = model.objects.filter(activity__endswith='_granted').order_by(
+            'card', 'time', 'id')
+        if start is not None:
+            queryset = queryset.filter(time__gte=start)
+        if end is not None:
+            queryset = queryset.filter(time__lt=end)
+        queryset = queryset.values_list('card_id', 'time', 'id', 'activity')
+
+        rows = list(queryset[:chunk])
+        while rows:
+            for card_id, time, _, activity in rows:
+                yield card_id, time, activity
+            if len(rows) < chunk:
+                break
+
+            card_id, time, log_id, _ = rows[-1]
+            rows = list(queryset.filter(
+                Q(card_id__gt=card_id) |
+                Q(card_id=card_id, time__gt=time) |
+                Q(card_id=card_id, time=time, id__gt=log_id))[:chunk])
+
+    return heapq.merge(logs(ArchivedCardLog), logs(CardLog))
+
+
+def dwell_times(start=None, end=None):
+    """Compute the attendance of each person on each day
+
+    Each login_granted is paired with the next logout_granted of the same card. A session
+    spanning midnight is counted on the day it ends. A login without a following logout is an
+    unclosed session, it is counted in `unclosed` but not in `seconds_inside`.
+
+    Args:
+        - start, end: only use logs in this time range
+
+    Yields:
+        Dictionary with the fields in DWELL_FIELDS, ordered by card and date
+
+    """
+    row = None
+    session_start = None
+
+    for card_id, time, activity in granted_logs(start, end):
+        date = timezone.localtime(time).date()
+
+        if row is None or row['card_id'] != card_id or row['date'] != date:
+            if row is not None and session_start is not None and row['card_id'] != card_id:
+                row['unclosed'] += 1
+                session_start = None
+
+            if row is not None:
+                yield finish_row(row)
+
+            row = {
+                'card_id': card_id, 'date': date, 'first_in': None, 'last_out': None,
+                'seconds_inside': 0, 'sessions': 0, 'unclosed': 0,
+            }
+
+        if activity == 'login_granted':
+            if session_start is not None:
+                row['unclosed'] += 1
+            session_start = time
+            row['sessions'] += 1
+            if row['first_in'] is None:
+                row['first_in'] = time
+        else:
+            if session_start is not None:
+                row['seconds_inside'] += int((time - session_start).total_seconds())
+                session_start = None
+            row['last_out'] = time
+
+    if row is not None:
+        if session_start is not None:
+            row['unclosed'] += 1
+        yield finish_row(row)
+
+
+def finish_row(row):
+    """Add the person fields to a dwell time row"""
+    entry = directory.get_by_id(row.pop('card_id'))
+    person = entry['person'] if entry else {}
+
+    row['person_id'] = entry['person_id'] if entry else None
+    row['name'] = person.get('name')
+    row['team'] = person.get('team')
+    row['division'] = person.get('division')
+    row['university'] = person.get('university')
+
+    return row
+
+
+def team_dwell_times(start=None, end=None):
+    """Compute the attendance of each team on each day
+
+    Only one row per team and day is kept in memory, which does not depend on the number of
+    logs.
+
+    Yields:
+        Dictionary with the fields in TEAM_DWELL_FIELDS, ordered by date and team
+
+    """
+    teams = {}
+    for row in dwell_times(start, end):
+        key = (row['date'], row['university'], row['team'])
+        team = teams.get(key)
+        if team is None:
+            team = teams[key] = {
+                'date': row['date'], 'team': row['team'], 'division': row['division'],
+                'university': row['university'], 'persons': 0, 'first_in': None,
+                'last_out': None, 'seconds_inside': 0, 'unclosed': 0,
+            }
+
+        team['persons'] += 1
+        team['seconds_inside'] += row['seconds_inside']
+        team['unclosed'] += row['unclosed']
+        if row['first_in'] and (team['first_in'] is None or row['first_in'] < team['first_in']):
+            team['first_in'] = row['first_in']
+        if row['last_out'] and (team['last_out'] is None or row['last_out'] > team['last_out']):
+            team['last_out'] = row['last_out']
+
+    for key in sorted(teams, key=lambda k: tuple(str(v) for v in k)):
+        yield teams[key]
+
+
+class Echo:
+    """File-like object that returns the written value, used to stream csv"""
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows, fields):
+    """Render rows as csv lines"""
+    writer = csv.DictWriter(Echo(), fields)
+    yield writer.writerow(dict(zip(fields, fields)))
+    for row in rows:
+        yield writer.writerow({k: format_value(row[k]) for k in fields})
+
+
+def json_lines(rows, fields):
+    """Render rows as a JSON array, one row per line"""
+    yield '['
+    separator = '\n'
+    for row in rows:
+        yield separator + json.dumps({k: row[k] for k in fields}, cls=DjangoJSONEncoder)
+        separator = ',\n'
+    yield '\n]\n'
+
+
+def format_value(value):
+    if hasattr(value, 'isoformat'):
+        if hasattr(value, 'tzinfo'):
+            value = timezone.localtime(value)
+        return value.isoformat()
+
+    return value
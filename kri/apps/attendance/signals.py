@@ -0,0 +1,45 @@
+"""Signal handlers keeping the card directory up to date
+
+Each change is recorded as a DirectoryChange in the transaction of the change, and applied
+to the directory of this process once it is committed, so a rolled back change never reaches
+any directory. The other processes read the recorded change, see directory.py.
+
+"""
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from kri.apps.participant.models import University, Team, Person
+from .directory import directory
+from .models import Card, DirectoryChange
+
+
+def record(field, value):
+    """Record a change, then apply it to this process's directory after the commit"""
+    change = DirectoryChange.record(field, value)
+    transaction.on_commit(
+        lambda: directory.apply(change.id, change.field, change.value, change.time))
+
+
+@receiver(post_save, sender=Card)
+@receiver(post_delete, sender=Card)
+def card_changed(sender, instance, **kwargs):
+    record('card_id', instance.pk)
+
+
+@receiver(post_save, sender=Person)
+@receiver(post_delete, sender=Person)
+def person_changed(sender, instance, **kwargs):
+    record('person_id', instance.pk)
+
+
+@receiver(post_save, sender=Team)
+@receiver(post_delete, sender=Team)
+def team_changed(sender, instance, **kwargs):
+    record('team_id', instance.pk)
+
+
+@receiver(post_save, sender=University)
+@receiver(post_delete, sender=University)
+def university_changed(sender, instance, **kwargs):
+    record('university_id', instance.pk)
@@ -1,12 +1,29 @@
+import datetime
+import io
 import json
-from django.test import TestCase, Client, RequestFactory
+import os
+import tempfile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.cache import cache
+from django.db import connection, transaction, IntegrityError
+from django.test import TestCase, TransactionTestCase, Client, RequestFactory, skipUnlessDBFeature
 from django.contrib.auth.models import User
+from django.utils import timezone
+from kri.apps.participant.models import Person
 from kri.apps.participant.tests import TeamTestCase, PersonTestCase
-from .models import Card, CardLog
-from .views import fetch_log, login, logout
+from .benchmark import scan_concurrently
+from .directory import CardDirectory, directory
+from .gate import Gate, Journal
+from .reports import dwell_times, granted_logs, team_dwell_times
+from .models import ArchivedCardLog, Card, CardLog, Occupancy
+from .notifier import notifier
+from .views import (STREAM_TIMEOUT, batch, cards, dwell_report, event_stream, fetch_log, history,
+                    limit_streams, login, logout, occupancy, stream)
 
 class CardTestCase(TestCase):
     def setUp(self):
+        directory.clear()
         team = TeamTestCase.mock_team('SPY', 'krai')
         person = PersonTestCase.mock_person('John Doe', team, 'core_member')
         self.card = Card.register(person.id, 'key')
@@ -46,8 +63,688 @@ class CardTestCase(TestCase):
         self.assertEqual(self.card.logged_in(), False)
 
 
+@skipUnlessDBFeature('test_db_allows_multiple_connections')
+class CardConcurrencyTestCase(TransactionTestCase):
+    THREADS = 8
+    ROUNDS = 20
+
+    def setUp(self):
+        directory.clear()
+        team = TeamTestCase.mock_team('SPY', 'krai')
+        person = PersonTestCase.mock_person('John Doe', team, 'core_member')
+        self.card = Card.register(person.id, 'key')
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        directory.load()
+
+    def test_no_double_grant(self):
+        """Concurrent scans of the same card grant each transition exactly once"""
+        def scan(activity):
+            log = CardLog.create_log(self.card.key, activity, self.admin)
+            return log.activity == activity + '_granted'
+
+        result = scan_concurrently(self.card.id, self.THREADS, self.ROUNDS, scan)
+
+        self.assertEqual(result['errors'], [])
+        self.assertEqual(result['granted'], [1] * self.ROUNDS)
+        self.assertEqual(CardLog.objects.filter(activity__endswith='_granted').count(),
+                         self.ROUNDS)
+        self.assertEqual(CardLog.objects.count(), self.ROUNDS * self.THREADS)
+        self.assertEqual(Occupancy.objects.get().count, 0)
+        self.card.refresh_from_db()
+        self.assertFalse(self.card.inside)
+
+    def test_concurrent_batches(self):
+        """Concurrent batches with the same event id log it once and return its result"""
+        def scan(activity):
+            return CardLog.create_logs([(self.card.key, activity, None, 'event-1')],
+                                       self.admin) == ['granted']
+
+        result = scan_concurrently(self.card.id, self.THREADS, 1, scan)
+
+        self.assertEqual(result['errors'], [])
+        self.assertEqual(result['granted'], [self.THREADS])
+        self.assertEqual(CardLog.objects.count(), 1)
+
+    def test_benchmark(self):
+        """Report the transitions per second of concurrent scans"""
+        stdout = io.StringIO()
+        call_command('benchmark_transitions', 'key', threads=self.THREADS, rounds=self.ROUNDS,
+                     stdout=stdout)
+
+        self.assertIn('{0} granted of {1} scans'.format(self.ROUNDS, self.ROUNDS * self.THREADS),
+                      stdout.getvalue())
+
+
+class CardTransitionTestCase(TestCase):
+    def setUp(self):
+        directory.clear()
+        team = TeamTestCase.mock_team('SPY', 'krai')
+        person = PersonTestCase.mock_person('John Doe', team, 'core_member')
+        self.card = Card.register(person.id, 'key')
+
+    def test_transition(self):
+        """Grant a transition once and deny it while the card keeps its status"""
+        self.assertTrue(Card.transition(self.card.id, 'login', timezone.now()))
+        self.assertFalse(Card.transition(self.card.id, 'login', timezone.now()))
+        self.assertTrue(Card.transition(self.card.id, 'logout', timezone.now()))
+        self.assertEqual(Occupancy.objects.get().count, 0)
+
+    def test_transition_other_key(self):
+        """Deny the transition of a card given another key"""
+        self.assertFalse(Card.transition(self.card.id, 'login', timezone.now(), key='other'))
+        self.card.refresh_from_db()
+        self.assertFalse(self.card.inside)
+
+    def test_scan_sequentially(self):
+        """Grant every scan of a single thread"""
+        result = scan_concurrently(self.card.id, threads=1, rounds=4)
+
+        self.assertEqual(result['errors'], [])
+        self.assertEqual(result['granted'], [1] * 4)
+        self.assertGreater(result['rate'], 0)
+
+    def test_benchmark(self):
+        """Restore the card status and write no log"""
+        Card.objects.filter(pk=self.card.id).update(inside=True)
+        stdout = io.StringIO()
+        call_command('benchmark_transitions', 'key', threads=1, rounds=3, stdout=stdout)
+
+        self.assertIn('scans/s with 1 threads, 3 granted of 3 scans', stdout.getvalue())
+        self.card.refresh_from_db()
+        self.assertTrue(self.card.inside)
+        self.assertFalse(CardLog.objects.exists())
+
+    def test_benchmark_unknown_card(self):
+        """Reject an unknown card key"""
+        with self.assertRaises(CommandError):
+            call_command('benchmark_transitions', 'unknown', stdout=io.StringIO())
+
+
+class CardDirectoryTestCase(TransactionTestCase):
+    def setUp(self):
+        directory.clear()
+        team = TeamTestCase.mock_team('SPY', 'krai')
+        self.person = PersonTestCase.mock_person('John Doe', team, 'core_member')
+        self.card = Card.register(self.person.id, 'key')
+        directory.load()
+
+    def test_lookup_without_query(self):
+        """A loaded directory answers lookups without querying the database"""
+        with self.assertNumQueries(0):
+            entry = directory.get(self.card.key)
+            entry_by_id = directory.get_by_id(self.card.id)
+
+        self.assertEqual(entry['id'], self.card.id)
+        self.assertEqual(entry_by_id, entry)
+        self.assertEqual(entry['person']['name'], 'John Doe')
+        self.assertEqual(entry['person']['division'], 'KRAI')
+        self.assertEqual(entry['person']['role'], 'Tim Inti')
+
+    def test_unknown_key(self):
+        """Unknown key returns None"""
+        self.assertIsNone(directory.get('invalid key'))
+
+    def test_new_card(self):
+        """A new card is added to the directory"""
+        person = PersonTestCase.mock_person('Jane Doe', self.person.team, 'core_member')
+        card = Card.register(person.id, 'new key')
+
+        with self.assertNumQueries(0):
+            self.assertEqual(directory.get('new key')['id'], card.id)
+
+    def test_person_change(self):
+        """Changing the person updates the payload"""
+        self.person.name = 'Richard Roe'
+        self.person.save()
+
+        self.assertEqual(directory.get(self.card.key)['person']['name'], 'Richard Roe')
+
+    def test_university_change(self):
+        """Changing the university updates the payload"""
+        university = self.person.team.university
+        university.name = 'Universitas Gadjah Mada'
+        university.save()
+
+        self.assertEqual(directory.get(self.card.key)['person']['university'],
+                         'Universitas Gadjah Mada')
+
+    def test_card_delete(self):
+        """Deleting a card removes it from the directory"""
+        self.card.delete()
+
+        self.assertIsNone(directory.get('key'))
+
+    def test_rollback(self):
+        """A rolled back change does not reach the directory"""
+        try:
+            with transaction.atomic():
+                self.person.name = 'Richard Roe'
+                self.person.save()
+                raise IntegrityError
+        except IntegrityError:
+            pass
+
+        self.assertEqual(directory.get(self.card.key)['person']['name'], 'John Doe')
+
+    def test_change_in_other_process(self):
+        """A change committed by another process is applied without a full reload"""
+        other = CardDirectory()
+        other.SYNC_INTERVAL = 60
+        other.load()
+        loaded_at = other._loaded_at
+
+        self.person.name = 'Richard Roe'
+        self.person.save()
+        self.assertEqual(other.get(self.card.key)['person']['name'], 'John Doe')
+
+        other.sync()
+
+        self.assertEqual(other.get(self.card.key)['person']['name'], 'Richard Roe')
+        self.assertEqual(other._loaded_at, loaded_at)
+        with self.assertNumQueries(1):
+            other.sync()
+
+    def test_cleared_during_lookup(self):
+        """A cleared directory is reloaded by the next lookup"""
+        directory.clear()
+
+        self.assertEqual(directory.get_by_id(self.card.id)['key'], 'key')
+
+    def test_stale_key(self):
+        """A card given another key by another process is not granted with its old key"""
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        Card.objects.filter(pk=self.card.pk).update(key='new key')
+
+        with self.assertRaises(Card.DoesNotExist):
+            CardLog.create_log('key', 'login', admin)
+        self.assertEqual(CardLog.create_log('new key', 'login', admin).activity,
+                         'login_granted')
+        self.assertIsNone(directory.get('key'))
+
+
+class LogNotifierTestCase(TransactionTestCase):
+    def setUp(self):
+        directory.clear()
+        team = TeamTestCase.mock_team('SPY', 'krai')
+        person = PersonTestCase.mock_person('John Doe', team, 'core_member')
+        self.card = Card.register(person.id, 'key')
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+
+    def test_wake_on_commit(self):
+        """Wake the streams once a new log is committed"""
+        generation = notifier.generation
+        CardLog.login(self.card.key, self.admin)
+
+        self.assertTrue(notifier.wait(generation, 0))
+
+    def test_no_wake_on_rollback(self):
+        """Do not wake the streams for a rolled back log"""
+        generation = notifier.generation
+        try:
+            with transaction.atomic():
+                CardLog.login(self.card.key, self.admin)
+                raise IntegrityError
+        except IntegrityError:
+            pass
+
+        self.assertFalse(notifier.wait(generation, 0))
+        self.assertFalse(CardLog.objects.exists())
+
+
+class CardImportTestCase(TestCase):
+    def setUp(self):
+        directory.clear()
+        team = TeamTestCase.mock_team('SPY', 'krai')
+        self.persons = [PersonTestCase.mock_person(name, team, 'core_member')
+                        for name in ('John Doe', 'Jane Doe', 'Richard Roe')]
+
+    def test_import(self):
+        """Register cards from person ids"""
+        # persons, registered keys, registered persons and the transaction with one insert
+        with self.assertNumQueries(6):
+            cards, errors = Card.import_keys([(p.id, 'key-' + p.name) for p in self.persons])
+
+        self.assertEqual(errors, [])
+        self.assertEqual(Card.objects.count(), 3)
+        self.assertEqual(Card.objects.get(key='key-Jane Doe').person, self.persons[1])
+
+    def test_import_instance_id(self):
+        """Instance id matching many persons is reported"""
+        cards, errors = Card.import_keys([('instanceid', 'key')], 'instance_id')
+
+        self.assertEqual(errors, ['Row 1: instance_id instanceid matches 3 persons.'])
+        self.assertEqual(Card.objects.count(), 0)
+
+    def test_import_conflicts(self):
+        """Duplicates and conflicts are reported and nothing is registered"""
+        Card.register(self.persons[2].id, 'registered')
+
+        cards, errors = Card.import_keys([
+            (self.persons[0].id, 'key-1'),
+            (self.persons[1].id, 'key-1'),
+            (self.persons[0].id, 'key-2'),
+            (self.persons[1].id, 'registered'),
+            (self.persons[2].id, 'key-3'),
+            (0, 'key-4'),
+        ])
+
+        self.assertEqual(len(errors), 5)
+        self.assertTrue(errors[0].startswith('Row 2: card key key-1 is duplicated'))
+        self.assertTrue(errors[1].startswith('Row 3: John Doe is duplicated'))
+        self.assertEqual(Card.objects.count(), 1)
+
+    def test_dry_run(self):
+        """Dry run only validates"""
+        cards, errors = Card.import_keys([(self.persons[0].id, 'key')], dry_run=True)
+
+        self.assertEqual((len(cards), errors), (1, []))
+        self.assertEqual(Card.objects.count(), 0)
+
+    def test_command(self):
+        """Import from a csv file"""
+        path = os.path.join(tempfile.mkdtemp(), 'cards.csv')
+        with open(path, 'w') as text_file:
+            text_file.write('person_id,card_key\n')
+            for person in self.persons:
+                text_file.write('{0},key-{0}\n'.format(person.id))
+
+        call_command('import_cards', path, stdout=open(os.devnull, 'w'))
+
+        self.assertEqual(Card.objects.count(), 3)
+
+    def test_admin_upload(self):
+        """Import from the admin upload form"""
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        client = Client()
+        client.login(username='admin', password='password')
+        upload = io.BytesIO('person_id,card_key\n{0},key\n'.format(
+            self.persons[0].id).encode('utf-8'))
+        upload.name = 'cards.csv'
+
+        response = client.post('/ksk/attendance/card/import/', {'file': upload})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Card.objects.get().key, 'key')
+
+
+class OccupancyTestCase(TestCase):
+    def setUp(self):
+        directory.clear()
+        self.team = TeamTestCase.mock_team('SPY', 'krai')
+        self.cards = [
+            Card.register(PersonTestCase.mock_person(name, self.team, 'core_member').id, name)
+            for name in ('John Doe', 'Jane Doe')
+        ]
+
+    def count(self):
+        try:
+            return Occupancy.objects.get(division='krai', university=self.team.university).count
+        except Occupancy.DoesNotExist:
+            return 0
+
+    def test_login_logout(self):
+        """Granted login and logout change the counter"""
+        self.cards[0].login()
+        self.cards[1].login()
+        self.assertEqual(self.count(), 2)
+
+        self.cards[0].logout()
+        self.assertEqual(self.count(), 1)
+
+    def test_denied(self):
+        """Denied login and logout keep the counter"""
+        self.cards[0].login()
+        self.cards[0].login()
+        self.cards[1].logout()
+
+        self.assertEqual(self.count(), 1)
+
+    def test_rebuild(self):
+        """Rebuilding the counters counts the cards inside"""
+        self.cards[0].login()
+        Occupancy.objects.all().delete()
+        Occupancy.rebuild()
+
+        self.assertEqual(self.count(), 1)
+
+    def test_team_moved(self):
+        """Take a card off the counter it was added to after its team moved"""
+        self.cards[0].login()
+        self.team.division = 'krsti'
+        self.team.save()
+        directory.clear()
+        Occupancy.rebuild()
+        self.assertEqual(self.count(), 1)
+
+        self.cards[0].logout()
+        self.assertEqual(self.count(), 0)
+        self.assertFalse(Occupancy.objects.filter(division='krsti').exists())
+
+        self.cards[0].login()
+        self.assertEqual(Occupancy.objects.get(division='krsti').count, 1)
+
+    def test_summary(self):
+        """Summarize the occupancy"""
+        self.cards[0].login()
+        self.cards[1].login()
+
+        with self.assertNumQueries(1):
+            summary = Occupancy.summary()
+
+        self.assertEqual(summary['total'], 2)
+        self.assertEqual(summary['divisions'], {'KRAI': 2})
+        self.assertEqual(summary['universities'][0]['university'], self.team.university.name)
+
+    def test_request_occupancy(self):
+        """Requests the occupancy"""
+        self.cards[0].login()
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        request = RequestFactory().get('/attendance/occupancy/')
+        request.user = admin
+        response = occupancy(request)
+
+        data = json.loads((response.content).decode('utf-8'))
+        self.assertEqual(data['total'], 1)
+
+
+class ReplayTestCase(TestCase):
+    def setUp(self):
+        directory.clear()
+        team = TeamTestCase.mock_team('SPY', 'krai')
+        person = PersonTestCase.mock_person('John Doe', team, 'core_member')
+        self.card = Card.register(person.id, 'key')
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.start = timezone.now() - datetime.timedelta(hours=1)
+
+    def at(self, minutes):
+        return self.start + datetime.timedelta(minutes=minutes)
+
+    def test_idempotent(self):
+        """Replaying the same event twice creates a single log"""
+        events = [(self.card.key, 'login', self.at(0), 'event-1')]
+
+        self.assertEqual(CardLog.create_logs(events, self.admin), ['granted'])
+        self.assertEqual(CardLog.create_logs(events, self.admin), ['granted'])
+        self.assertEqual(CardLog.objects.count(), 1)
+
+    def test_idempotent_archived(self):
+        """Replaying an archived event creates no log"""
+        events = [(self.card.key, 'login', self.at(0), 'event-1')]
+        CardLog.create_logs(events, self.admin)
+        ArchivedCardLog.archive(timezone.now())
+
+        self.assertEqual(CardLog.create_logs(events, self.admin), ['granted'])
+        self.assertFalse(CardLog.objects.exists())
+        self.assertEqual(ArchivedCardLog.objects.count(), 1)
+
+    def test_duplicate_in_batch(self):
+        """The same event twice in a batch is applied once"""
+        event = (self.card.key, 'login', self.at(0), 'event-1')
+
+        self.assertEqual(CardLog.create_logs([event, event], self.admin), ['granted', 'granted'])
+        self.assertEqual(CardLog.objects.count(), 1)
+
+    def test_out_of_order(self):
+        """An event older than the latest log is reconciled into the card history"""
+        CardLog.create_logs([(self.card.key, 'logout', self.at(30), 'online')], self.admin)
+        self.assertEqual(CardLog.objects.get(event_id='online').activity, 'logout_denied')
+
+        results = CardLog.create_logs([(self.card.key, 'login', self.at(0), 'offline')],
+                                      self.admin)
+
+        self.assertEqual(results, ['granted'])
+        self.assertEqual(CardLog.objects.get(event_id='online').activity, 'logout_granted')
+        self.card.refresh_from_db()
+        self.assertEqual(self.card.last_login, self.at(0))
+        self.assertEqual(self.card.last_logout, self.at(30))
+        self.assertFalse(self.card.inside)
+        self.assertFalse(Occupancy.objects.filter(count__gt=0).exists())
+
+    def test_out_of_order_keeps_last_time(self):
+        """An old login never moves last_login backwards"""
+        CardLog.create_logs([
+            (self.card.key, 'login', self.at(0), 'a'),
+            (self.card.key, 'logout', self.at(10), 'b'),
+            (self.card.key, 'login', self.at(20), 'c'),
+        ], self.admin)
+
+        results = CardLog.create_logs([(self.card.key, 'login', self.at(5), 'd')], self.admin)
+
+        self.assertEqual(results, ['denied'])
+        self.card.refresh_from_db()
+        self.assertEqual(self.card.last_login, self.at(20))
+        self.assertTrue(self.card.inside)
+
+
+class ArchiveTestCase(TestCase):
+    def setUp(self):
+        directory.clear()
+        team = TeamTestCase.mock_team('SPY', 'krai')
+        person = PersonTestCase.mock_person('John Doe', team, 'core_member')
+        self.card = Card.register(person.id, 'key')
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        now = timezone.now()
+        CardLog.create_logs([
+            (self.card.key, 'login', now - datetime.timedelta(days=3)),
+            (self.card.key, 'logout', now - datetime.timedelta(days=2)),
+            (self.card.key, 'login', now - datetime.timedelta(hours=1)),
+        ], self.admin)
+
+    def test_archive(self):
+        """Logs older than the cutoff are moved to the archive in chunks"""
+        call_command('archive_cardlog', days=1, chunk_size=1, stdout=open(os.devnull, 'w'))
+
+        self.assertEqual(CardLog.objects.count(), 1)
+        self.assertEqual(ArchivedCardLog.objects.count(), 2)
+
+    def test_history(self):
+        """History includes both live and archived logs ordered by time"""
+        ArchivedCardLog.archive(timezone.now() - datetime.timedelta(days=1))
+
+        logs = list(CardLog.history(card=self.card))
+
+        self.assertEqual([log['activity'] for log in logs],
+                         ['login_granted', 'logout_granted', 'login_granted'])
+        self.assertEqual(logs[0]['card__key'], self.card.key)
+
+    def test_history_range(self):
+        """History is filtered by time range"""
+        ArchivedCardLog.archive(timezone.now() - datetime.timedelta(days=1))
+
+        logs = list(CardLog.history(start=timezone.now() - datetime.timedelta(days=2, hours=1),
+                                    end=timezone.now() - datetime.timedelta(days=1)))
+
+        self.assertEqual([log['activity'] for log in logs], ['logout_granted'])
+
+    def test_request_history(self):
+        """Requests the history of a card"""
+        ArchivedCardLog.archive(timezone.now() - datetime.timedelta(days=1))
+        request = RequestFactory().get('/attendance/history/', {'card': self.card.key,
+                                                                'limit': 2})
+        request.user = self.admin
+        response = history(request)
+
+        data = json.loads((response.content).decode('utf-8'))
+        self.assertEqual(data['status'], 'success')
+        self.assertEqual(len(data['logs']), 2)
+        self.assertEqual(data['logs'][0]['admin'], 'admin')
+
+    def test_request_history_negative_limit(self):
+        """Rejects a negative history limit"""
+        request = RequestFactory().get('/attendance/history/', {'limit': -1})
+        request.user = self.admin
+        response = history(request)
+
+        data = json.loads((response.content).decode('utf-8'))
+        self.assertEqual(data['status'], 'failed')
+
+    def test_history_limit(self):
+        """Limits each log table in the query itself"""
+        ArchivedCardLog.archive(timezone.now() - datetime.timedelta(days=1))
+        with self.assertNumQueries(2):
+            logs = list(CardLog.history(card=self.card, limit=1))
+        self.assertEqual(len(logs), 1)
+
+
+class DwellReportTestCase(TestCase):
+    def setUp(self):
+        directory.clear()
+        team = TeamTestCase.mock_team('SPY', 'krai')
+        self.cards = [
+            Card.register(PersonTestCase.mock_person(name, team, 'core_member').id, name)
+            for name in ('John Doe', 'Jane Doe')
+        ]
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.start = timezone.make_aware(datetime.datetime(2017, 5, 13, 8))
+
+    def at(self, minutes):
+        return self.start + datetime.timedelta(minutes=minutes)
+
+    def test_dwell_times(self):
+        """Pair granted login and logout of each person"""
+        CardLog.create_logs([
+            ('John Doe', 'login', self.at(0)),
+            ('Jane Doe', 'login', self.at(5)),
+            ('John Doe', 'login', self.at(10)),
+            ('John Doe', 'logout', self.at(60)),
+            ('John Doe', 'login', self.at(90)),
+            ('John Doe', 'logout', self.at(120)),
+        ], self.admin)
+
+        rows = {row['name']: row for row in dwell_times()}
+
+        self.assertEqual(rows['John Doe']['seconds_inside'], 90 * 60)
+        self.assertEqual(rows['John Doe']['sessions'], 2)
+        self.assertEqual(rows['John Doe']['first_in'], self.at(0))
+        self.assertEqual(rows['John Doe']['last_out'], self.at(120))
+        self.assertEqual(rows['John Doe']['unclosed'], 0)
+        self.assertEqual(rows['Jane Doe']['seconds_inside'], 0)
+        self.assertEqual(rows['Jane Doe']['unclosed'], 1)
+
+    def test_team_dwell_times(self):
+        """Sum the attendance of a team"""
+        CardLog.create_logs([
+            ('John Doe', 'login', self.at(0)),
+            ('Jane Doe', 'login', self.at(5)),
+            ('John Doe', 'logout', self.at(60)),
+            ('Jane Doe', 'logout', self.at(65)),
+        ], self.admin)
+
+        rows = list(team_dwell_times())
+
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['persons'], 2)
+        self.assertEqual(rows[0]['seconds_inside'], 120 * 60)
+        self.assertEqual(rows[0]['first_in'], self.at(0))
+        self.assertEqual(rows[0]['last_out'], self.at(65))
+
+    def test_granted_logs_chunks(self):
+        """Read the same logs in chunks smaller than a card's logs"""
+        CardLog.create_logs([
+            ('John Doe', 'login', self.at(0)),
+            ('Jane Doe', 'login', self.at(0)),
+            ('John Doe', 'logout', self.at(30)),
+            ('John Doe', 'login', self.at(30)),
+            ('Jane Doe', 'logout', self.at(45)),
+            ('John Doe', 'logout', self.at(60)),
+        ], self.admin)
+        ArchivedCardLog.archive(self.at(40))
+
+        logs = list(granted_logs())
+
+        self.assertEqual(len(logs), 6)
+        self.assertEqual(list(granted_logs(chunk=2)), logs)
+        self.assertEqual(logs, sorted(logs, key=lambda log: log[:2]))
+
+    def test_request_dwell_report(self):
+        """Requests the report as csv"""
+        CardLog.create_logs([
+            ('John Doe', 'login', self.at(0)),
+            ('John Doe', 'logout', self.at(60)),
+        ], self.admin)
+        request = RequestFactory().get('/attendance/report/dwell/')
+        request.user = self.admin
+        response = dwell_report(request)
+
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(lines[0].split(',')[:3], ['date', 'person_id', 'name'])
+        self.assertEqual(lines[1].split(',')[2], 'John Doe')
+        self.assertEqual(lines[1].split(',')[8], '3600')
+
+
+class GateTestCase(TestCase):
+    class LocalClient:
+        """Gate client calling the batch view directly"""
+        def __init__(self, admin):
+            self.admin = admin
+            self.fail = False
+
+        def cards(self):
+            request = RequestFactory().get('/attendance/cards/')
+            request.user = self.admin
+            return json.loads(cards(request).content.decode('utf-8'))['cards']
+
+        def batch(self, events):
+            request = RequestFactory().post('/attendance/batch/', json.dumps({'events': events}),
+                                            content_type='application/json')
+            request.user = self.admin
+            response = json.loads(batch(request).content.decode('utf-8'))
+            if self.fail:
+                raise OSError('Connection lost')
+            return response
+
+    def setUp(self):
+        directory.clear()
+        team = TeamTestCase.mock_team('SPY', 'krai')
+        person = PersonTestCase.mock_person('John Doe', team, 'core_member')
+        self.card = Card.register(person.id, 'key')
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client = GateTestCase.LocalClient(self.admin)
+        self.gate = Gate(Journal(':memory:'), self.client)
+        self.gate.refresh()
+
+    def test_scan_offline(self):
+        """Scans are answered from the local journal"""
+        self.assertEqual(self.gate.scan('key', 'login')[0], 'granted')
+        self.assertEqual(self.gate.scan('key', 'login')[0], 'denied')
+        self.assertEqual(self.gate.scan('invalid key', 'login'), ('unknown', None))
+        self.assertEqual(self.gate.scan('key', 'logout')[1]['name'], 'John Doe')
+        self.assertEqual(CardLog.objects.count(), 0)
+
+    def test_sync(self):
+        """Pending scans are replayed to the server"""
+        self.gate.scan('key', 'login')
+        self.gate.scan('key', 'login')
+
+        self.assertEqual(self.gate.sync(), 2)
+        self.assertEqual(self.gate.sync(), 0)
+        self.assertEqual(list(CardLog.objects.order_by('time').values_list('activity', flat=True)),
+                         ['login_granted', 'login_denied'])
+        self.assertTrue(Card.objects.get(key='key').inside)
+
+    def test_refresh_removes_card(self):
+        """Cards deleted on the server are unknown after a refresh"""
+        self.card.delete()
+        self.gate.refresh()
+
+        self.assertEqual(self.gate.scan('key', 'login'), ('unknown', None))
+
+    def test_retry_after_lost_response(self):
+        """Retrying a batch whose response was lost creates no duplicate"""
+        self.gate.scan('key', 'login')
+
+        self.client.fail = True
+        with self.assertRaises(OSError):
+            self.gate.sync()
+
+        self.client.fail = False
+        self.assertEqual(self.gate.sync(), 1)
+        self.assertEqual(CardLog.objects.count(), 1)
+
+
 class CardLogTestCase(TestCase):
     def setUp(self):
+        directory.clear()
         team = TeamTestCase.mock_team('SPY', 'krai')
         person = PersonTestCase.mock_person('John Doe', team, 'core_member')
         self.card = Card.register(person.id, 'key')
@@ -86,6 +783,21 @@ class CardLogTestCase(TestCase):
 
         self.assertEqual(log.activity, 'logout_denied')
 
+    def test_create_logs(self):
+        """Test creating logs for a batch of events"""
+        results = CardLog.create_logs([
+            (self.card.key, 'login', None),
+            (self.card.key, 'login', None),
+            ('invalid key', 'login', None),
+            (self.card.key, 'logout', None),
+        ], self.admin)
+
+        self.assertEqual(results, ['granted', 'denied', 'unknown', 'granted'])
+        self.assertEqual(list(CardLog.objects.order_by('id').values_list('activity', flat=True)),
+                         ['login_granted', 'login_denied', 'logout_granted'])
+        self.card.refresh_from_db()
+        self.assertEqual(self.card.logged_in(), False)
+
     def test_last_by_admin(self):
         """Test last_by_admin to get the latest CardLog by an admin"""
         CardLog.login(self.card.key, self.admin)
@@ -190,6 +902,54 @@ class CardLogTestCase(TestCase):
         self.assertEqual(data['message'], 'Logout denied.')
         self.assertEqual(data['status'], 'denied')
 
+    def test_request_batch(self):
+        """Requests a batch of events"""
+        factory = RequestFactory()
+        request = factory.post('/attendance/batch/', json.dumps({
+            'events': [
+                {'card_key': self.card.key, 'activity': 'login',
+                 'time': '2017-05-13T08:00:00+07:00'},
+                {'card_key': self.card.key, 'activity': 'login'},
+                {'card_key': 'invalidkey', 'activity': 'logout'},
+            ]
+        }), content_type='application/json')
+        request.user = self.admin
+        response = batch(request)
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads((response.content).decode('utf-8'))
+        self.assertEqual(data['status'], 'success')
+        self.assertEqual([r['result'] for r in data['results']],
+                         ['granted', 'denied', 'unknown'])
+        self.card.refresh_from_db()
+        self.assertEqual(self.card.last_login.isoformat(), '2017-05-13T01:00:00+00:00')
+
+    def test_request_batch_invalid_event(self):
+        """Requests a batch with an invalid activity"""
+        factory = RequestFactory()
+        request = factory.post('/attendance/batch/', json.dumps({
+            'events': [{'card_key': self.card.key, 'activity': 'enter'}]
+        }), content_type='application/json')
+        request.user = self.admin
+        response = batch(request)
+
+        data = json.loads((response.content).decode('utf-8'))
+        self.assertEqual(data['status'], 'failed')
+        self.assertEqual(CardLog.objects.count(), 0)
+
+    def test_request_batch_long_event_id(self):
+        """Requests a batch with an event id longer than the stored ids"""
+        factory = RequestFactory()
+        request = factory.post('/attendance/batch/', json.dumps({
+            'events': [{'card_key': self.card.key, 'activity': 'login', 'id': 'x' * 37}]
+        }), content_type='application/json')
+        request.user = self.admin
+        response = batch(request)
+
+        data = json.loads((response.content).decode('utf-8'))
+        self.assertEqual(data['status'], 'failed')
+        self.assertEqual(CardLog.objects.count(), 0)
+
     def test_request_log(self):
         factory = RequestFactory()
         request = factory.post('/attendance/logout/', {
@@ -219,6 +979,87 @@ class CardLogTestCase(TestCase):
         self.assertEqual(login_response.status_code, 200)
         self.assertEqual(data['status'], 'denied')
 
+    def test_event_stream(self):
+        """Stream every log after the last event id"""
+        first = CardLog.login(self.card.key, self.admin)
+        second = CardLog.logout(self.card.key, self.admin)
+
+        events = list(event_stream(last_id=0, timeout=0))
+
+        self.assertEqual(events[0], 'retry: 1000\n\n')
+        self.assertTrue(events[1].startswith('id: {0}\n'.format(first.id)))
+        self.assertTrue(events[2].startswith('id: {0}\n'.format(second.id)))
+        data = json.loads(events[2].split('data: ')[1])
+        self.assertEqual(data['status'], 'logout_granted')
+        self.assertEqual(data['person']['name'], self.card.person.name)
+
+    def test_event_stream_resume(self):
+        """Resuming the stream sends only the events after the last event id"""
+        first = CardLog.login(self.card.key, self.admin)
+        second = CardLog.logout(self.card.key, self.admin)
+
+        events = [e for e in event_stream(last_id=first.id, timeout=0) if e.startswith('id: ')]
+
+        self.assertEqual(len(events), 1)
+        self.assertTrue(events[0].startswith('id: {0}\n'.format(second.id)))
+
+    def test_event_stream_wake(self):
+        """Read the database again only when new logs are notified"""
+        stream = event_stream(last_id=0, timeout=60, keep_alive=0)
+        self.assertEqual(next(stream), 'retry: 1000\n\n')
+        self.assertEqual(next(stream), ': keep-alive\n\n')
+
+        with self.assertNumQueries(0):
+            self.assertEqual(next(stream), ': keep-alive\n\n')
+
+        log = CardLog.login(self.card.key, self.admin)
+        notifier.wake()
+        event = next(stream)
+        stream.close()
+
+        self.assertTrue(event.startswith('id: {0}\n'.format(log.id)))
+
+    def test_stream_limit(self):
+        """Streams over the limit are told to reconnect later"""
+        cache.clear()
+        open_stream = limit_streams(iter(['event']), limit=1)
+        self.assertEqual(next(open_stream), 'event')
+
+        refused = list(limit_streams(iter(['event']), limit=1))
+        open_stream.close()
+
+        self.assertEqual(refused, ['retry: {0}\n\n'.format(STREAM_TIMEOUT * 1000)])
+        self.assertEqual(list(limit_streams(iter(['event']), limit=1)), ['event'])
+
+    def test_event_stream_new_client(self):
+        """A new client only receives the logs created after it connects"""
+        CardLog.login(self.card.key, self.admin)
+
+        events = [e for e in event_stream(timeout=0) if e.startswith('id: ')]
+
+        self.assertEqual(events, [])
+
+    def test_event_stream_admin(self):
+        """Stream only the logs of an admin"""
+        other = User.objects.create_superuser('other', 'other@example.com', 'password')
+        CardLog.login(self.card.key, other)
+
+        events = [e for e in event_stream('admin', last_id=0, timeout=0)
+                  if e.startswith('id: ')]
+
+        self.assertEqual(events, [])
+
+    def test_request_stream(self):
+        """Requests the event stream with Last-Event-ID"""
+        factory = RequestFactory()
+        request = factory.get('/attendance/stream/', HTTP_LAST_EVENT_ID='10')
+        request.user = self.admin
+        response = stream(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertTrue(response.streaming)
+
     def test_request_log_no_content(self):
         factory = RequestFactory()
         request = factory.get('/attendance/fetch-log')
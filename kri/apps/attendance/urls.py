@@ -8,5 +8,11 @@ app_name = 'attendance'
 urlpatterns = [
     url(r'^login/$', views.login, name='login'),
     url(r'^logout/$', views.logout, name='logout'),
+    url(r'^batch/$', views.batch, name='batch'),
+    url(r'^cards/$', views.cards, name='cards'),
+    url(r'^stream/$', views.stream, name='stream'),
+    url(r'^history/$', views.history, name='history'),
+    url(r'^report/dwell/$', views.dwell_report, name='dwell-report'),
+    url(r'^occupancy/$', views.occupancy, name='occupancy'),
     url(r'^monitor/$', views.monitor, name='monitor')
 ]
@@ -1,58 +1,29 @@
-from django.http import HttpResponse, JsonResponse, Http404
+import json
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse, Http404
 from django.contrib.auth import authenticate
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.models import User
 from django.shortcuts import render
 from django.core.exceptions import PermissionDenied
-from .models import Card, CardLog
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from . import reports
+from .directory import directory
+from .models import Card, CardLog, Occupancy
+from .notifier import notifier
 
 
 def logger(request, activity):
     if request.user.is_staff:
         card_key = request.POST['card_key']
+
         try:
             cardlog = CardLog.create_log(card_key, activity, request.user)
-
-            try:
-                photo = cardlog.card.person.photo.url
-            except ValueError:
-                photo = None
-
-            if cardlog.activity == (activity + '_granted'):
-                return JsonResponse({
-                    'activity': activity,
-                    'status': 'success',
-                    'message': activity.capitalize() + ' granted.',
-                    'person': {
-                        'name': cardlog.card.person.name,
-                        'gender': cardlog.card.person.gender,
-                        'team': cardlog.card.person.team.name,
-                        'division': cardlog.card.person.team.get_division_display(),
-                        'role': cardlog.card.person.get_type_display(),
-                        'university': cardlog.card.person.team.university.name,
-                        'photo': photo
-                    }
-                })
-            elif cardlog.activity == (activity + '_denied'):
-                return JsonResponse({
-                    'activity': activity,
-                    'status': 'denied',
-                    'message': activity.capitalize() + ' denied.',
-                    'person': {
-                        'name': cardlog.card.person.name,
-                        'gender': cardlog.card.person.gender,
-                        'team': cardlog.card.person.team.name,
-                        'division': cardlog.card.person.team.get_division_display(),
-                        'role': cardlog.card.person.get_type_display(),
-                        'university': cardlog.card.person.team.university.name,
-                        'photo': photo
-                    }
-                })
-            else:
-                return JsonResponse({
-                    'activity': activity,
-                    'status': 'failed',
-                    'message': activity.capitalize() + ' rejected.'
-                })
         except Card.DoesNotExist:
             return JsonResponse({
                 'activity': activity,
@@ -60,10 +31,26 @@ def logger(request, activity):
                 'message': 'Card not recognized.'
             })
 
+        entry = directory.get_by_id(cardlog.card_id)
+
+        if cardlog.activity == (activity + '_granted'):
+            status = 'success'
+            message = activity.capitalize() + ' granted.'
+        elif cardlog.activity == (activity + '_denied'):
+            status = 'denied'
+            message = activity.capitalize() + ' denied.'
+        else:
+            return JsonResponse({
+                'activity': activity,
+                'status': 'failed',
+                'message': activity.capitalize() + ' rejected.'
+            })
+
         return JsonResponse({
             'activity': activity,
-            'status': 'failed',
-            'message': activity.capitalize() + ' failed.'
+            'status': status,
+            'message': message,
+            'person': entry['person']
         })
     else:
         return JsonResponse({
@@ -81,29 +68,310 @@ def logout(request):
     return logger(request, 'logout')
 
 
+def batch(request):
+    """Apply a batch of card events sent by a gate
+
+    The request body is a JSON object with an `events` list. Each event has a `card_key`,
+    an `activity` (login or logout), an optional ISO 8601 `time` of the scan and an optional
+    unique `id`. An event whose id is already logged is not applied twice. The events are
+    applied in order and the response lists the result of each event.
+
+    """
+    if not request.user.is_staff:
+        return JsonResponse({
+            'status': 'failed',
+            'message': 'Authentication failed.'
+        })
+
+    try:
+        events = [parse_event(e) for e in json.loads(request.body.decode('utf-8'))['events']]
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({
+            'status': 'failed',
+            'message': 'Invalid events.'
+        })
+
+    results = CardLog.create_logs(events, request.user)
+
+    return JsonResponse({
+        'status': 'success',
+        'results': [{'id': e[3], 'card_key': e[0], 'activity': e[1], 'result': r}
+                    for e, r in zip(events, results)]
+    })
+
+
+def parse_event(event):
+    """Convert an event from batch request to (card_key, activity, time, event_id) tuple
+
+    Raises:
+        - ValueError: the activity, time or id is invalid
+
+    """
+    if event['activity'] not in ('login', 'logout'):
+        raise ValueError('Invalid activity.')
+
+    time = parse_time(event.get('time'))
+
+    event_id = event.get('id')
+    if event_id is not None:
+        event_id = str(event_id)
+        if len(event_id) > 36:
+            raise ValueError('Invalid id.')
+
+    return (str(event['card_key']), event['activity'], time, event_id)
+
+
 @login_required
 def fetch_log(request):
     log = CardLog.last_by_admin(request.user)
 
     if log is not None:
+        entry = directory.get_by_id(log.card_id)
+        if entry is not None:
+            return JsonResponse({
+                'status': log.activity,
+                'time': log.time,
+                'person': entry['person']
+            })
+
+    return HttpResponse(status=204)
+
+
+def cards(request):
+    """List every card with its person and status for the gates' local cache"""
+    if not request.user.is_staff:
+        raise PermissionDenied
+
+    inside = dict(Card.objects.values_list('key', 'inside'))
+    entries = [directory.get(key) for key in inside]
+
+    return JsonResponse({
+        'cards': [{'key': e['key'], 'inside': inside[e['key']], 'person': e['person']}
+                  for e in entries if e is not None]
+    })
+
+
+def parse_time(value):
+    """Parse an optional ISO 8601 time to an aware datetime
+
+    Raises:
+        - ValueError: the time is invalid
+
+    """
+    if value is None:
+        return None
+
+    time = parse_datetime(value)
+    if time is None:
+        raise ValueError('Invalid time.')
+    if timezone.is_naive(time):
+        time = timezone.make_aware(time)
+
+    return time
+
+
+def occupancy(request):
+    """Number of cards inside the venue per division and university"""
+    if not request.user.is_staff:
+        raise PermissionDenied
+
+    return JsonResponse(Occupancy.summary())
+
+
+HISTORY_LIMIT = 1000
+
+
+def history(request):
+    """List the logs of a card or an admin from both live and archived logs
+
+    Query parameters (all optional):
+        - card: card key
+        - admin: admin username
+        - start, end: ISO 8601 time range
+        - limit: maximum number of logs, default to HISTORY_LIMIT
+
+    """
+    if not request.user.is_staff:
+        raise PermissionDenied
+
+    try:
+        filters = {
+            'start': parse_time(request.GET.get('start')),
+            'end': parse_time(request.GET.get('end')),
+        }
+        limit = min(int(request.GET.get('limit', HISTORY_LIMIT)), HISTORY_LIMIT)
+        if limit < 0:
+            raise ValueError('Invalid limit.')
+    except ValueError:
+        return JsonResponse({'status': 'failed', 'message': 'Invalid parameters.'})
+
+    if request.GET.get('card'):
+        filters['card'] = Card.objects.filter(key=request.GET['card']).first()
+        if filters['card'] is None:
+            return JsonResponse({'status': 'failed', 'message': 'Card not recognized.'})
+
+    if request.GET.get('admin'):
+        filters['admin'] = User.objects.filter(username=request.GET['admin']).first()
+        if filters['admin'] is None:
+            return JsonResponse({'status': 'failed', 'message': 'Admin not recognized.'})
+
+    return JsonResponse({
+        'status': 'success',
+        'logs': [{
+            'id': log['id'],
+            'card_key': log['card__key'],
+            'admin': log['admin__username'],
+            'activity': log['activity'],
+            'time': log['time'],
+        } for log in CardLog.history(limit=limit, **filters)]
+    })
+
+
+def dwell_report(request):
+    """Stream the dwell time report as csv or JSON
+
+    Query parameters (all optional):
+        - format: csv (default) or json
+        - group: person (default) or team
+        - start, end: ISO 8601 time range
+
+    """
+    if not request.user.is_staff:
+        raise PermissionDenied
+
+    try:
+        start = parse_time(request.GET.get('start'))
+        end = parse_time(request.GET.get('end'))
+    except ValueError:
+        return JsonResponse({'status': 'failed', 'message': 'Invalid parameters.'})
+
+    if request.GET.get('group') == 'team':
+        rows, fields = reports.team_dwell_times(start, end), reports.TEAM_DWELL_FIELDS
+    else:
+        rows, fields = reports.dwell_times(start, end), reports.DWELL_FIELDS
+
+    if request.GET.get('format') == 'json':
+        response = StreamingHttpResponse(reports.json_lines(rows, fields),
+                                         content_type='application/json')
+    else:
+        response = StreamingHttpResponse(reports.csv_lines(rows, fields), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="dwell-time.csv"'
+
+    return response
+
+
+STREAM_TIMEOUT = 30
+STREAM_KEEP_ALIVE = 10
+STREAM_LIMIT = 100
+STREAMS_KEY = 'attendance:streams'
+
+
+def stream(request):
+    """Stream new CardLog as Server-Sent Events
+
+    The stream can be filtered to a single gate with the `admin` query parameter containing
+    the admin's username. Each event id is the CardLog id, so a client reconnecting with the
+    Last-Event-ID header continues after the last event it received, see event_stream.
+
+    Each open stream holds a worker for STREAM_TIMEOUT seconds, then the browser reconnects
+    by itself. At most ATTENDANCE_STREAM_LIMIT streams, default to STREAM_LIMIT, are open at
+    once, counted in the default cache, so the monitors can not take every worker from the
+    gates. The limit only holds across processes when the cache is shared by every process.
+
+    """
+    if not request.user.is_staff:
+        raise PermissionDenied
+
+    last_id = request.META.get('HTTP_LAST_EVENT_ID', request.GET.get('last_event_id'))
+    try:
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        last_id = None
+
+    response = StreamingHttpResponse(
+        limit_streams(event_stream(request.GET.get('admin'), last_id),
+                      getattr(settings, 'ATTENDANCE_STREAM_LIMIT', STREAM_LIMIT)),
+        content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+
+    return response
+
+
+def limit_streams(events, limit=STREAM_LIMIT):
+    """Generate the events unless limit streams are already open
+
+    A refused client is told to reconnect after STREAM_TIMEOUT seconds.
+
+    """
+    cache.add(STREAMS_KEY, 0, STREAM_TIMEOUT * 10)
+    try:
+        count = cache.incr(STREAMS_KEY)
+    except ValueError:
+        count = 1
+
+    try:
+        if count > limit:
+            yield 'retry: {0}\n\n'.format(STREAM_TIMEOUT * 1000)
+            return
+
+        for event in events:
+            yield event
+    finally:
         try:
-            photo = log.card.person.photo.url
+            cache.decr(STREAMS_KEY)
         except ValueError:
-            photo = None
+            pass
 
-        return JsonResponse({
-            'status': log.activity,
-            'time': log.time,
-            'person': {
-                'name': log.card.person.name,
-                'team': log.card.person.team.name,
-                'division': log.card.person.team.get_division_display(),
-                'university': log.card.person.team.university.name,
-                'photo': photo,
-            }
-        })
 
-    return HttpResponse(status=204)
+def event_stream(admin=None, last_id=None, timeout=STREAM_TIMEOUT, keep_alive=STREAM_KEEP_ALIVE):
+    """Generate Server-Sent Events for every CardLog created after last_id
+
+    The database is read once when the stream opens, then only when the notifier reports
+    committed logs, see notifier.py. Only ids greater than last_id are sent, so no event is
+    sent twice. Ids are assigned when a log is inserted, so a log committed after a log with
+    a higher id was sent is not streamed.
+
+    Args:
+        - admin: username of the admin to filter, or None for every admin
+        - last_id: id of the last CardLog received. None starts after the latest CardLog.
+        - timeout: seconds before the stream ends
+        - keep_alive: seconds between comments sent while no log is created
+
+    """
+    logs = CardLog.objects.all()
+    if admin:
+        logs = logs.filter(admin__username=admin)
+
+    if last_id is None:
+        last_id = CardLog.objects.aggregate(Max('id'))['id__max'] or 0
+
+    yield 'retry: 1000\n\n'
+
+    deadline = time.time() + timeout
+    woken = True
+    while True:
+        if woken:
+            generation = notifier.generation
+            for log in logs.filter(id__gt=last_id).order_by('id'):
+                last_id = log.id
+                entry = directory.get_by_id(log.card_id)
+                data = json.dumps({
+                    'status': log.activity,
+                    'time': log.time,
+                    'admin': log.admin_id,
+                    'person': entry['person'] if entry else None,
+                }, cls=DjangoJSONEncoder)
+
+                yield 'id: {0}\ndata: {1}\n\n'.format(log.id, data)
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+
+        woken = notifier.wait(generation, min(remaining, keep_alive))
+        if not woken:
+            yield ': keep-alive\n\n'
 
 
 def monitor(request):
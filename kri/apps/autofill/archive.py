@@ -0,0 +1,101 @@
+"""Zip archive of ID cards
+
+The archive is produced as a sequence of chunks while the cards are rendered, so it can be
+streamed in a response without a temporary directory and without holding the whole archive
+in memory.
+
+"""
+
+import csv
+import io
+import zipfile
+from .autofill import card_data
+from .layout import layouts
+
+REPORT_NAME = 'report.csv'
+
+
+class ZipStream:
+    """Write-only file object keeping what has been written until it is popped"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        """Get and forget everything written since the last call"""
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def card_kind(person):
+    """Layout of the ID card of a person"""
+    return 'pers' if person.type == 'pers' else 'team'
+
+
+def zip_cards(persons):
+    """Render the ID cards of persons into a zip archive
+
+    Team cards need a photo, persons without one are skipped and listed with the reason in
+    report.csv at the end of the archive. Every PERS person of a university shares one card.
+
+    Args:
+        - persons: Person queryset
+
+    Yields:
+        Chunks of the zip archive
+
+    """
+    stream = ZipStream()
+    archive = zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED)
+    written = set()
+    skipped = []
+
+    persons = persons.select_related('team__university').order_by(
+        'team__university__name', 'team__division', 'type', 'id')
+    for person in persons.iterator():
+        kind = card_kind(person)
+        if kind == 'team' and not person.photo:
+            skipped.append((person, 'no photo'))
+            continue
+
+        data = card_data(person)
+        name = layouts[kind].output_name(data)
+        if name in written:
+            continue
+
+        try:
+            card = layouts[kind].render(None, data)
+        except IOError:
+            skipped.append((person, 'photo file not found'))
+            continue
+
+        buffer = io.BytesIO()
+        card.img.save(buffer, 'PNG')
+        archive.writestr(name, buffer.getvalue())
+        written.add(name)
+
+        yield stream.pop()
+
+    report = io.StringIO()
+    writer = csv.writer(report)
+    writer.writerow(['person_id', 'name', 'team', 'university', 'reason'])
+    for person, reason in skipped:
+        writer.writerow([person.id, person.name, person.team.name, person.team.university.name,
+                         reason])
+    archive.writestr(REPORT_NAME, report.getvalue())
+    archive.close()
+
+    yield stream.pop()
@@ -1,21 +1,242 @@
+import functools
 import os
+import threading
+from collections import OrderedDict
 from PIL import Image, ImageDraw, ImageFont
 
+FONT_DIR = '/usr/share/fonts/truetype/dejavu'
+FONT = os.path.join(FONT_DIR, 'DejaVuSans.ttf')
+FONT_BOLD = os.path.join(FONT_DIR, 'DejaVuSans-Bold.ttf')
+
+
+class ResourceCache:
+    """Bounded cache of decoded base images and fonts
+
+    Images are keyed by path and fonts by path and size. The least recently used entries are
+    dropped once the estimated size of the cache exceeds max_bytes. The cache is per process,
+    so each batch worker decodes a template once.
+
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def image(self, path):
+        """Get a decoded image, it must be copied before being drawn on"""
+        def load():
+            img = Image.open(path)
+            img.load()
+            return img, img.width * img.height * len(img.getbands())
+
+        return self._get(('image', path), load)
+
+    def font(self, path, size):
+        """Get a TrueType font"""
+        def load():
+            return ImageFont.truetype(path, size), os.path.getsize(path)
+
+        return self._get(('font', path, size), load)
+
+    def _get(self, key, load):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+        value, size = load()
+        with self._lock:
+            self.misses += 1
+            if key not in self._entries:
+                self._entries[key] = (value, size)
+                self.size += size
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= evicted
+
+        return value
+
+    def stats(self):
+        """Number of entries, estimated size in bytes, hits and misses"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+cache = ResourceCache()
+
+
+@functools.lru_cache(maxsize=8192)
+def text_width(font_path, size, text):
+    """Width of a single line of text, measured once for each font, size and text"""
+    return cache.font(font_path, size).getsize(text)[0]
+
+
+def wrap_text(text, font_path, size, width):
+    """Break text into lines no wider than width, breaking only between words"""
+    lines = []
+    for word in text.split():
+        if lines and text_width(font_path, size, lines[-1] + ' ' + word) <= width:
+            lines[-1] += ' ' + word
+        else:
+            lines.append(word)
+
+    return lines
+
+
+def fit_text(text, font_path, size, width, min_size, max_lines=2):
+    """Find the largest font size at which text fits in width
+
+    The sizes from min_size to size are searched with a binary search, first for a single
+    line, then for text wrapped on up to max_lines lines.
+
+    Returns:
+        Tuple of the font size and the lines. If the text does not fit even at min_size, the
+        lines at min_size are returned.
+
+    """
+    def fits(candidate, lines):
+        return len(lines) <= max_lines and all(
+            text_width(font_path, candidate, line) <= width for line in lines)
+
+    for split in (lambda candidate: [text],
+                  lambda candidate: wrap_text(text, font_path, candidate, width)):
+        if not fits(min_size, split(min_size)):
+            continue
+
+        low, high = min_size, size
+        while low < high:
+            middle = (low + high + 1) // 2
+            if fits(middle, split(middle)):
+                low = middle
+            else:
+                high = middle - 1
+
+        return low, split(low)
+
+    return min_size, wrap_text(text, font_path, min_size, width)
+
+
+def draw_text_center(draw, canvas_width, text, y_pos, color, font_path, size, margin=24,
+                     min_size=14, line_spacing=1.2):
+    """Draw text centered horizontally
+
+    Text wider than the canvas minus margin on each side is drawn with a smaller font, and
+    wrapped on two lines centered around y_pos if shrinking to min_size is not enough.
+
+    """
+    width = canvas_width - 2 * margin
+    lines = [text]
+    if text_width(font_path, size, text) > width:
+        size, lines = fit_text(text, font_path, size, width, min(min_size, size))
+
+    font = cache.font(font_path, size)
+    line_height = int(size * line_spacing)
+    y_pos -= (len(lines) - 1) * line_height // 2
+    for line in lines:
+        line_width = text_width(font_path, size, line)
+        draw.text(((canvas_width - line_width) / 2, y_pos), line, color, font=font)
+        y_pos += line_height
+
+
+def crop_photo(image_path, size):
+    """Scale a photo to cover size and crop its center"""
+    photo = Image.open(image_path)
+    width, height = photo.size
+    new_width, new_height = size
+
+    ratio = height / width
+    if ratio > new_height / new_width:
+        thumbnail_size = (new_width, height)
+    else:
+        thumbnail_size = (width, new_height)
+
+    photo.thumbnail(thumbnail_size)
+    width, height = photo.size
+
+    left = (width - new_width) / 2
+    top = (height - new_height) / 2
+    right = (width + new_width) / 2
+    bottom = (height + new_height) / 2
+
+    return photo.crop((left, top, right, bottom))
+
+
+def card_data(person):
+    """Extract the values drawn on a person's card
+
+    The card can then be rendered without touching the database, for example in another
+    process.
+
+    """
+    return {
+        'id': person.id,
+        'name': person.name,
+        'team': person.team.name,
+        'division': person.team.get_division_display(),
+        'division_key': person.team.division,
+        'role': person.get_type_display(),
+        'university': person.team.university.name,
+        'abbreviation': person.team.university.abbreviation,
+        'photo': photo_path(person),
+    }
+
+
+def photo_path(person):
+    """Path of the photo drawn on a card, the card variant if it has been generated"""
+    if person.photo_card:
+        return person.photo_card.path
+    if person.photo:
+        return person.photo.path
+
+    return None
+
 
 class AutoFill:
     WIDTH, HEIGHT = (1000, 1000)
+    TEXT_MARGIN = 24
+    MIN_FONT_SIZE = 14
+    LINE_SPACING = 1.2
 
     def __init__(self, base_image):
-        self.img = Image.open(base_image)
-        self.font = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf', 24)
+        self.load_template(base_image)
+        self.set_font(FONT, 24)
+
+    def load_template(self, base_image):
+        """Start the card from a copy of the template"""
+        self.img = cache.image(base_image).copy()
         self.draw = ImageDraw.Draw(self.img)
 
     def set_font(self, font, size):
-        self.font = ImageFont.truetype(font, size)
+        self.font_path = font
+        self.font_size = size
+        self.font = cache.font(font, size)
 
     def add_text_center(self, text, y_pos, color='#FFA726'):
-        width, _ = self.draw.textsize(text, font=self.font)
-        self.draw.text(((self.WIDTH - width) / 2, y_pos), text, color, font=self.font)
+        """Draw text centered horizontally, shrunk or wrapped to fit, see draw_text_center"""
+        draw_text_center(self.draw, self.WIDTH, text, y_pos, color, self.font_path,
+                         self.font_size, self.TEXT_MARGIN, self.MIN_FONT_SIZE,
+                         self.LINE_SPACING)
+
+    def paste_photo(self, image_path, box):
+        """Add photo cropped to fill box, a tuple of left, top, width and height"""
+        self.img.paste(crop_photo(image_path, box[2:]), box[:2])
 
     def show(self):
         """Display image"""
@@ -31,28 +252,7 @@ class TeamIDCard(AutoFill):
 
     def add_photo(self, image_path):
         """Add photo to canvas"""
-        photo = Image.open(image_path)
-        width, height = photo.size
-
-        ratio = height / width
-        if ratio > 1.33:
-            thumbnail_size = (170, height)
-        else:
-            thumbnail_size = (width, 228)
-
-        photo.thumbnail(thumbnail_size)
-        width, height = photo.size
-
-        new_width = 170
-        new_height = 228
-
-        left = (width - new_width) / 2
-        top = (height - new_height) / 2
-        right = (width + new_width) / 2
-        bottom = (height + new_height) / 2
-
-        cropped = photo.crop((left, top, right, bottom))
-        self.img.paste(cropped, (230, 159))
+        self.paste_photo(image_path, (230, 159, 170, 228))
 
     def add_name(self, name):
         """Add participant name to canvas"""
@@ -73,15 +273,7 @@ class TeamIDCard(AutoFill):
     @staticmethod
     def fill(base_image, persons, output_path):
         """Fill team members ID card"""
-        for p in persons:
-            card = TeamIDCard(base_image)
-            card.add_photo(p.photo.path)
-            card.add_name(p.name)
-            card.add_team(p.team.name, p.team.get_division_display(), p.get_type_display())
-            card.add_university(p.team.university.name)
-            out = os.path.join(output_path, p.team.university.abbreviation + '-' +
-                               p.team.division + '-' + str(p.id) + '.png')
-            card.save(out)
+        fill_layout('team', base_image, persons, output_path)
 
 
 class PersIDCard(AutoFill):
@@ -89,7 +281,7 @@ class PersIDCard(AutoFill):
 
     def __init__(self, base_image):
         super(PersIDCard, self).__init__(base_image)
-        self.set_font('/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf', 36)
+        self.set_font(FONT_BOLD, 36)
 
     def add_agency(self, name):
         """Add agency name to canvas"""
@@ -98,8 +290,23 @@ class PersIDCard(AutoFill):
     @staticmethod
     def fill(base_image, persons, output_path):
         """Fill pers ID card"""
-        for p in persons:
-            card = PersIDCard(base_image)
-            card.add_agency(p.team.university.abbreviation)
-            out = os.path.join(output_path, 'PERS-' + p.team.university.abbreviation + '.png')
-            card.save(out)
+        fill_layout('pers', base_image, persons, output_path)
+
+
+def fill_layout(name, base_image, persons, output_path):
+    """Render the cards of persons with a layout, one after another
+
+    Args:
+        - persons: queryset or list of Person, a queryset also fetches the teams in the same
+          query
+
+    """
+    from .layout import layouts
+
+    if hasattr(persons, 'select_related'):
+        persons = persons.select_related('team__university')
+
+    layout = layouts[name]
+    for p in persons:
+        data = card_data(p)
+        layout.render(base_image, data).save(os.path.join(output_path, layout.output_name(data)))
@@ -0,0 +1,142 @@
+"""Batch rendering of ID cards
+
+The persons are fetched once with their team and university, converted to plain values with
+card_data and rendered by a pool of worker processes. Jobs are handed to the pool in windows,
+so only a bounded number of cards is pending at any time no matter how large the queryset is.
+
+Every card is written to a temporary file and renamed when complete, so a card that exists in
+the output directory is always whole. The hash of the inputs of every written card is kept in
+the manifest of the output directory, see manifest.py. Only the cards whose inputs have
+changed are rendered again, so a batch restarted after a crash or run again after a few
+corrections skips the cards that are still current.
+
+"""
+
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+from .autofill import cache, card_data
+from .layout import layouts
+from .manifest import Manifest
+
+
+def render_card(job):
+    """Render a single card in a worker process
+
+    Args:
+        - job: tuple of layout name, base image path, card data and output path
+
+    Returns:
+        The output path
+
+    """
+    kind, base_image, data, out = job
+    card = layouts[kind].render(base_image, data)
+
+    temp = out + '.part'
+    card.img.save(temp, 'PNG')
+    os.replace(temp, out)
+
+    return out
+
+
+def print_progress(done, total, skipped, elapsed):
+    """Default progress report, written to stderr"""
+    rate = done / elapsed if elapsed else 0
+    sys.stderr.write('\r{0}/{1} cards rendered, {2} skipped, {3:.1f} cards/s'.format(
+        done, total, skipped, rate))
+
+
+def render_batch(base_image, persons, output_path, kind='team', processes=None, window=256,
+                 progress=print_progress, prune=False):
+    """Render the ID cards of many persons with a pool of processes
+
+    Args:
+        - base_image: path of the card template, None to use the template of the layout
+        - persons: Person queryset
+        - output_path: directory of the rendered cards
+        - kind: name of the card layout, see layout.py
+        - processes: number of worker processes, default to the number of CPU
+        - window: maximum number of jobs handed to the pool at once
+        - progress: callable receiving (done, total, skipped, elapsed seconds) after each
+          card, or None
+        - prune: remove the cards in the manifest that are not in persons, only use it when
+          persons is the whole roster
+
+    Returns:
+        Dictionary of the rendered and skipped counts, the removed files, elapsed seconds,
+        cards per second and the template cache statistics of this process
+
+    """
+    layout = layouts[kind]
+    persons = persons.select_related('team__university')
+    total = persons.count()
+    stats = {'rendered': 0, 'skipped': 0, 'removed': []}
+    manifest = Manifest(output_path, base_image, kind)
+    outputs = set()
+    digests = {}
+
+    def jobs():
+        for person in persons.iterator():
+            data = card_data(person)
+            name = layout.output_name(data)
+            out = os.path.join(output_path, name)
+            if name in outputs:
+                stats['skipped'] += 1
+                continue
+
+            outputs.add(name)
+            digest = manifest.card_hash(layout, data)
+            if manifest.is_current(name, digest, out):
+                stats['skipped'] += 1
+                continue
+
+            digests[out] = (name, digest)
+            yield (kind, base_image, data, out)
+
+    # Decode the template before forking, so the workers inherit it from the cache
+    cache.image(base_image or layout.template)
+
+    start = time.time()
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = jobs()
+        while True:
+            chunk = list(itertools.islice(pending, window))
+            if not chunk:
+                break
+
+            chunksize = max(1, len(chunk) // ((processes or os.cpu_count() or 1) * 4))
+            for out in pool.imap_unordered(render_card, chunk, chunksize):
+                manifest.update(*digests.pop(out))
+                stats['rendered'] += 1
+                if progress is not None:
+                    progress(stats['rendered'], total, stats['skipped'], time.time() - start)
+
+            manifest.save()
+
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    if prune:
+        for name in list(manifest.cards):
+            if name not in outputs:
+                out = os.path.join(output_path, name)
+                if os.path.exists(out):
+                    os.remove(out)
+                manifest.remove(name)
+                stats['removed'].append(name)
+
+    manifest.save()
+
+    stats['elapsed'] = time.time() - start
+    stats['rate'] = stats['rendered'] / stats['elapsed'] if stats['elapsed'] else 0
+    stats['cache'] = cache.stats()
+
+    return stats
@@ -0,0 +1,213 @@
+"""Benchmark of the ID card rendering
+
+Synthetic persons, photos and a base template are generated in a temporary directory, so the
+benchmark needs neither the database nor the real templates. Every combination of batch size
+and number of workers is rendered and reported as JSON:
+
+    python -m kri.apps.autofill.benchmark --sizes 100,1000 --workers 1,2,4 --output bench.json
+
+For each run the report has the cards per second, the mean time per card spent in each stage
+(template copy, photo, text and PNG encoding) and the peak RSS of the parent and of the
+workers in KiB.
+
+"""
+
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import PIL
+from PIL import Image
+from .autofill import cache, text_width
+from .layout import layouts
+
+STAGES = ('setup', 'photo', 'text', 'encode')
+DIVISIONS = (('krai', 'KRAI'), ('krsbi_beroda', 'KRSBI Beroda'), ('krsti', 'KRSTI'),
+             ('krpai', 'KRPAI'))
+ROLES = ('Tim Inti', 'Mekanik', 'Dosen Pembimbing')
+WORDS = ('Adi', 'Budi', 'Citra', 'Dewi', 'Eko', 'Fajar', 'Gita', 'Hadi', 'Indah', 'Joko',
+         'Kartika', 'Lestari', 'Muhammad', 'Nugroho', 'Putri', 'Rahmawati', 'Setiawan',
+         'Wijayakusuma')
+
+
+def make_template(path, size=(638, 1011)):
+    """Write a base template with the size and mode of the real canvases"""
+    Image.new('RGBA', size, (20, 20, 20, 255)).save(path)
+
+
+def make_photos(directory, count, size):
+    """Write photos of the given size, as uploaded from a phone"""
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, 'photo-{0}.jpg'.format(i))
+        Image.effect_noise(size, 64 + i).convert('RGB').save(path, 'JPEG', quality=90)
+        paths.append(path)
+
+    return paths
+
+
+def make_persons(count, photos, seed=0):
+    """Generate card data as returned by card_data"""
+    rng = random.Random(seed)
+    universities = ['Universitas ' + ' '.join(rng.sample(WORDS, rng.randint(1, 6)))
+                    for _ in range(max(1, count // 20))]
+
+    persons = []
+    for i in range(count):
+        division = rng.choice(DIVISIONS)
+        university = rng.choice(universities)
+        persons.append({
+            'id': i,
+            'name': ' '.join(rng.sample(WORDS, rng.randint(2, 5))),
+            'team': 'Tim ' + rng.choice(WORDS),
+            'division': division[1],
+            'division_key': division[0],
+            'role': rng.choice(ROLES),
+            'university': university,
+            'abbreviation': ''.join(w[0] for w in university.split()).upper(),
+            'photo': photos[i % len(photos)],
+        })
+
+    return persons
+
+
+def render_timed(job):
+    """Render a card and measure each stage
+
+    Returns:
+        Dictionary of the seconds spent in each stage and the peak RSS of this process
+
+    """
+    kind, base_image, data = job
+    timings = {'photo': 0, 'text': 0}
+
+    start = time.perf_counter()
+    card = layouts[kind].render(base_image, data, timings)
+    timings['setup'] = time.perf_counter() - start - timings['photo'] - timings['text']
+
+    start = time.perf_counter()
+    card.img.save(io.BytesIO(), 'PNG')
+    timings['encode'] = time.perf_counter() - start
+    timings['rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return timings
+
+
+def run(kind, base_image, persons, workers):
+    """Render every person with a pool of workers and summarize the timings"""
+    jobs = [(kind, base_image, data) for data in persons]
+    totals = dict.fromkeys(STAGES, 0)
+    worker_rss = 0
+
+    start = time.perf_counter()
+    pool = multiprocessing.Pool(workers)
+    started = time.perf_counter()
+    try:
+        chunksize = max(1, len(jobs) // (workers * 4))
+        for timings in pool.imap_unordered(render_timed, jobs, chunksize):
+            for stage in STAGES:
+                totals[stage] += timings[stage]
+            worker_rss = max(worker_rss, timings['rss'])
+        rendered = time.perf_counter()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    seconds = rendered - started
+    return {
+        'kind': kind,
+        'cards': len(jobs),
+        'workers': workers,
+        'pool_startup_seconds': round(started - start, 4),
+        'seconds': round(seconds, 4),
+        'cards_per_second': round(len(jobs) / seconds, 2) if seconds else None,
+        'stage_ms_per_card': {
+            stage: round(totals[stage] * 1000 / len(jobs), 3) for stage in STAGES},
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_worker_rss_kb': worker_rss,
+    }
+
+
+def benchmark(sizes, workers, kinds=('team',), photo_size=(1200, 1600), photo_count=8,
+              seed=0, template=None):
+    """Run every combination of kind, batch size and number of workers
+
+    A plain template is generated unless the path of a template is given.
+
+    Returns:
+        Dictionary of the environment and the list of runs
+
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        base_image = template
+        if base_image is None:
+            base_image = os.path.join(directory, 'template.png')
+            make_template(base_image)
+        photos = make_photos(directory, photo_count, photo_size)
+
+        runs = []
+        for kind in kinds:
+            for size in sizes:
+                persons = make_persons(size, photos, seed)
+                for count in workers:
+                    cache.clear()
+                    text_width.cache_clear()
+                    layouts.clear()
+                    runs.append(run(kind, base_image, persons, count))
+    finally:
+        shutil.rmtree(directory)
+
+    return {
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'photo_size': list(photo_size),
+        'seed': seed,
+        'runs': runs,
+    }
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the ID card rendering')
+    parser.add_argument('--sizes', type=int_list, default=[100],
+                        help='Comma separated batch sizes')
+    parser.add_argument('--workers', type=int_list, default=[1, os.cpu_count() or 1],
+                        help='Comma separated numbers of worker processes')
+    parser.add_argument('--kinds', default='team', help='Comma separated card layouts')
+    parser.add_argument('--photo-size', default='1200x1600', help='Size of the synthetic photos')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--template', help='Use this template instead of a generated one')
+    parser.add_argument('--output', help='Write the JSON report to a file instead of stdout')
+    args = parser.parse_args(argv[1:])
+
+    photo_size = tuple(int(v) for v in args.photo_size.split('x'))
+    report = benchmark(args.sizes, sorted(set(args.workers)), args.kinds.split(','), photo_size,
+                       seed=args.seed, template=args.template)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
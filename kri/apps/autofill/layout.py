@@ -0,0 +1,218 @@
+"""Declarative card layouts
+
+A layout is a JSON file in the layouts directory describing a kind of card:
+
+    {
+        "template": "../canvas-team.png",
+        "output": "{abbreviation}-{division_key}-{id}.png",
+        "font": {"path": "DejaVuSans.ttf", "size": 24, "color": "#FFA726"},
+        "items": [
+            {"photo": "photo", "box": [230, 159, 170, 228]},
+            {"text": "{name!t}", "y": 460}
+        ]
+    }
+
+The template path is relative to the layout file and font paths are relative to FONT_DIR.
+Text items are format strings of the values returned by card_data, centered horizontally at
+y. They use the layout font unless they have their own "font", "size" or "color". The !t and
+!u conversions change a value to title and upper case. Photo items paste the photo of a
+field cropped to box, a list of left, top, width and height, and are left out when the field
+is empty.
+
+A layout is compiled once per process into a list of draw operations with its template and
+fonts already loaded, and the same operations are applied to every card. A new kind of card
+only needs a new layout file.
+
+"""
+
+import hashlib
+import json
+import os
+import string
+import threading
+import time
+from .autofill import AutoFill, FONT_DIR, cache, crop_photo, draw_text_center
+
+LAYOUT_DIR = os.path.join(os.path.dirname(__file__), 'layouts')
+
+
+class CardFormatter(string.Formatter):
+    """Formatter with the !t (title case) and !u (upper case) conversions"""
+
+    def convert_field(self, value, conversion):
+        if value is None:
+            return ''
+        if conversion == 't':
+            return str(value).title()
+        if conversion == 'u':
+            return str(value).upper()
+
+        return super(CardFormatter, self).convert_field(value, conversion)
+
+
+formatter = CardFormatter()
+
+
+class Layout:
+    """Compiled card layout
+
+    Args:
+        - path: path of the layout file
+
+    Raises:
+        - ValueError: the layout file is invalid
+
+    """
+
+    TEXT_MARGIN = AutoFill.TEXT_MARGIN
+    MIN_FONT_SIZE = AutoFill.MIN_FONT_SIZE
+
+    def __init__(self, path):
+        with open(path) as f:
+            content = f.read()
+        try:
+            spec = json.loads(content)
+        except ValueError as error:
+            raise ValueError('{0}: {1}'.format(path, error))
+
+        directory = os.path.dirname(path)
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.template = os.path.normpath(os.path.join(directory, spec['template']))
+        self.output = spec['output']
+        self.WIDTH, self.HEIGHT = cache.image(self.template).size
+
+        default_font = spec.get('font', {})
+        fonts = set()
+        fields = set(self.parse_fields(self.output))
+        photo_fields = set()
+        self.items = []
+        self.operations = []
+
+        for item in spec['items']:
+            if 'photo' in item:
+                fields.add(item['photo'])
+                photo_fields.add(item['photo'])
+                self.items.append(('photo', item['photo'], tuple(item['box'])))
+                self.operations.append(('photo', self.photo_operation(item['photo'],
+                                                                      tuple(item['box']))))
+            elif 'text' in item:
+                font = os.path.join(FONT_DIR, item.get('font', default_font.get('path')))
+                size = item.get('size', default_font.get('size', 24))
+                color = item.get('color', default_font.get('color', '#000000'))
+                cache.font(font, size)
+                fonts.add(font)
+                fields.update(self.parse_fields(item['text']))
+                self.items.append(('text', item['text'], item['y'], color, font, size))
+                self.operations.append(('text', self.text_operation(item['text'], item['y'],
+                                                                    color, font, size)))
+            else:
+                raise ValueError('{0}: unknown item {1}'.format(path, item))
+
+        self.FIELDS = tuple(sorted(fields))
+        self.PHOTO_FIELDS = tuple(sorted(photo_fields))
+
+        digest = hashlib.sha1(content.encode('utf-8'))
+        for font in sorted(fonts):
+            with open(font, 'rb') as f:
+                digest.update(f.read())
+        self.digest = digest.hexdigest()
+
+    @staticmethod
+    def parse_fields(format_string):
+        return [field for _, field, _, _ in formatter.parse(format_string) if field]
+
+    def text_operation(self, text, y_pos, color, font, size):
+        def draw_text(card, data):
+            draw_text_center(card.draw, self.WIDTH, formatter.vformat(text, (), data), y_pos,
+                             color, font, size, self.TEXT_MARGIN, self.MIN_FONT_SIZE)
+
+        return draw_text
+
+    @staticmethod
+    def photo_operation(field, box):
+        def draw_photo(card, data):
+            if data[field]:
+                card.img.paste(crop_photo(data[field], box[2:]), box[:2])
+
+        return draw_photo
+
+    def render(self, base_image, data, timings=None):
+        """Render a card from the values returned by card_data
+
+        Args:
+            - base_image: path of the card template, None to use the layout template
+            - data: values of the card
+            - timings: dictionary receiving the seconds spent in each kind of operation
+
+        Returns:
+            AutoFill of the card
+
+        """
+        card = AutoFill(base_image or self.template)
+        card.WIDTH, card.HEIGHT = self.WIDTH, self.HEIGHT
+
+        if timings is None:
+            for _, operation in self.operations:
+                operation(card, data)
+        else:
+            for kind, operation in self.operations:
+                start = time.perf_counter()
+                operation(card, data)
+                timings[kind] = timings.get(kind, 0) + time.perf_counter() - start
+
+        return card
+
+    def draw(self, card, data):
+        """Draw a card through the AutoFill methods, for cards that are not images
+
+        Args:
+            - card: AutoFill of the card, its WIDTH must be the layout width
+            - data: values of the card
+
+        """
+        for item in self.items:
+            if item[0] == 'photo':
+                if data[item[1]]:
+                    card.paste_photo(data[item[1]], item[2])
+            else:
+                _, text, y_pos, color, font, size = item
+                card.set_font(font, size)
+                card.add_text_center(formatter.vformat(text, (), data), y_pos, color)
+
+    def output_name(self, data):
+        """File name of a card"""
+        return formatter.vformat(self.output, (), data)
+
+
+class LayoutRegistry:
+    """Layouts of the layouts directory by name, compiled on first use"""
+
+    def __init__(self, directory=LAYOUT_DIR):
+        self.directory = directory
+        self._layouts = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            layout = self._layouts.get(name)
+            if layout is None:
+                path = os.path.join(self.directory, name + '.json')
+                if not os.path.exists(path):
+                    raise KeyError(name)
+                layout = self._layouts[name] = Layout(path)
+
+        return layout
+
+    def __contains__(self, name):
+        return os.path.exists(os.path.join(self.directory, name + '.json'))
+
+    def names(self):
+        return sorted(os.path.splitext(f)[0] for f in os.listdir(self.directory)
+                      if f.endswith('.json'))
+
+    def clear(self):
+        with self._lock:
+            self._layouts.clear()
+
+
+layouts = LayoutRegistry()
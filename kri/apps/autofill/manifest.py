@@ -0,0 +1,94 @@
+"""Manifest of rendered ID cards
+
+The manifest is a JSON file in the output directory mapping every card file to a hash of
+everything drawn on it: the card values, the photo content, the template, the layout and
+the fonts. A card whose hash has not changed since the last run does not need to be rendered
+again.
+
+Photo hashes are stored with the size and modification time of the photo, so unchanged
+photos are not read again on the next run.
+
+"""
+
+import hashlib
+import json
+import os
+from .layout import layouts
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def file_hash(path):
+    """SHA-1 of a file content"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+class Manifest:
+    VERSION = 1
+
+    def __init__(self, output_path, base_image, kind):
+        self.path = os.path.join(output_path, MANIFEST_NAME)
+        self.cards = {}
+        self.photos = {}
+
+        try:
+            with open(self.path) as f:
+                content = json.load(f)
+            if content.get('version') == self.VERSION:
+                self.cards = content['cards']
+                self.photos = content['photos']
+        except (IOError, ValueError):
+            pass
+
+        layout = layouts[kind]
+        self.template = hashlib.sha1(json.dumps(
+            [kind, file_hash(base_image or layout.template), layout.digest]).encode(
+                'utf-8')).hexdigest()
+
+    def photo_hash(self, path):
+        """Hash of a photo, reusing the stored hash if the file has not changed"""
+        if not path:
+            return ''
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return ''
+
+        stored = self.photos.get(path)
+        if stored and stored[0] == stat.st_size and stored[1] == stat.st_mtime:
+            return stored[2]
+
+        digest = file_hash(path)
+        self.photos[path] = [stat.st_size, stat.st_mtime, digest]
+
+        return digest
+
+    def card_hash(self, layout, data):
+        """Hash of every input of a card"""
+        values = [self.template, [data[field] for field in layout.FIELDS]]
+        for field in layout.PHOTO_FIELDS:
+            values.append(self.photo_hash(data[field]))
+
+        return hashlib.sha1(json.dumps(values).encode('utf-8')).hexdigest()
+
+    def is_current(self, name, digest, out):
+        """Check if a card file was rendered from the same inputs"""
+        return self.cards.get(name) == digest and os.path.exists(out)
+
+    def update(self, name, digest):
+        self.cards[name] = digest
+
+    def remove(self, name):
+        self.cards.pop(name, None)
+
+    def save(self):
+        """Write the manifest, replacing the previous one at once"""
+        with open(self.path + '.part', 'w') as f:
+            json.dump({'version': self.VERSION, 'cards': self.cards, 'photos': self.photos}, f)
+        os.replace(self.path + '.part', self.path)
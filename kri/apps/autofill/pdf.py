@@ -0,0 +1,333 @@
+"""PDF backend of AutoFill
+
+PdfAutoFill has the same drawing methods as AutoFill, but records them as PDF operations
+instead of drawing on a bitmap. Cards are collected in a PdfDocument, one page per card,
+written to the file as soon as they are added. In a document, every template image and every
+font is embedded once and shared by the pages. Text is drawn with the embedded TrueType font,
+so it stays sharp at any printing resolution, and only the photos are bitmaps. The drawing
+calls are also kept, so show can replay them on a bitmap AutoFill as a raster preview.
+
+The fonts are embedded with the WinAnsi encoding, characters outside it are drawn as '?'.
+
+"""
+
+import io
+import os
+import zlib
+from PIL import Image, ImageColor
+from .autofill import AutoFill, PersIDCard, TeamIDCard, cache, card_data, crop_photo, fit_text, \
+    text_width
+from .layout import layouts
+
+DPI = 300
+SCALE = 72 / DPI
+JPEG_QUALITY = 92
+ENCODING = 'cp1252'
+
+
+class PdfFile:
+    """Low level PDF writer
+
+    Objects are written as soon as they are complete, only their offsets are kept until the
+    cross-reference table is written. Object 1 is the catalog and object 2 the page tree.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path + '.part', 'wb')
+        self.position = 0
+        self.offsets = {}
+        self.pages = []
+        self.next_id = 3
+        self._write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def _write(self, data):
+        self.file.write(data)
+        self.position += len(data)
+
+    def reserve(self):
+        """Allocate the number of an object written later"""
+        number = self.next_id
+        self.next_id += 1
+        return number
+
+    def write_object(self, number, dictionary, stream=None):
+        self.offsets[number] = self.position
+        self._write('{0} 0 obj\n{1}'.format(number, dictionary).encode('ascii'))
+        if stream is not None:
+            self._write(b'\nstream\n' + stream + b'\nendstream')
+        self._write(b'\nendobj\n')
+
+    def add_object(self, dictionary, stream=None):
+        number = self.reserve()
+        self.write_object(number, dictionary, stream)
+        return number
+
+    def add_page(self, width, height, resources, content):
+        """Add a page of the given size in points
+
+        Args:
+            - resources: resource dictionary of the page
+            - content: uncompressed content stream
+
+        """
+        content = zlib.compress(content)
+        content_id = self.add_object(
+            '<< /Length {0} /Filter /FlateDecode >>'.format(len(content)), content)
+        self.pages.append(self.add_object(
+            '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {0:.2f} {1:.2f}] '
+            '/Resources {2} /Contents {3} 0 R >>'.format(width, height, resources, content_id)))
+
+    def close(self):
+        """Write the page tree and cross-reference table, then move the file in place"""
+        self.write_object(2, '<< /Type /Pages /Kids [{0}] /Count {1} >>'.format(
+            ' '.join('{0} 0 R'.format(p) for p in self.pages), len(self.pages)))
+        self.write_object(1, '<< /Type /Catalog /Pages 2 0 R >>')
+
+        xref = self.position
+        lines = ['xref', '0 {0}'.format(self.next_id), '0000000000 65535 f ']
+        lines += ['{0:010d} 00000 n '.format(self.offsets[n]) for n in range(1, self.next_id)]
+        self._write(('\n'.join(lines) + '\ntrailer\n<< /Size {0} /Root 1 0 R >>\n'
+                     'startxref\n{1}\n%%EOF\n').format(self.next_id, xref).encode('ascii'))
+
+        self.file.close()
+        os.replace(self.path + '.part', self.path)
+
+
+def image_object(pdf, image):
+    """Embed an RGB image, returns its object number"""
+    data = zlib.compress(image.tobytes())
+    return pdf.add_object(
+        '<< /Type /XObject /Subtype /Image /Width {0} /Height {1} /ColorSpace /DeviceRGB '
+        '/BitsPerComponent 8 /Filter /FlateDecode /Length {2} >>'.format(
+            image.width, image.height, len(data)), data)
+
+
+def jpeg_object(pdf, width, height, data):
+    """Embed a JPEG image, returns its object number"""
+    return pdf.add_object(
+        '<< /Type /XObject /Subtype /Image /Width {0} /Height {1} /ColorSpace /DeviceRGB '
+        '/BitsPerComponent 8 /Filter /DCTDecode /Length {2} >>'.format(width, height, len(data)),
+        data)
+
+
+def font_object(pdf, path):
+    """Embed a TrueType font with the WinAnsi encoding, returns its object number"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    compressed = zlib.compress(data)
+    file_id = pdf.add_object('<< /Length {0} /Length1 {1} /Filter /FlateDecode >>'.format(
+        len(compressed), len(data)), compressed)
+
+    font = cache.font(path, 1000)
+    ascent, descent = font.getmetrics()
+    widths = []
+    for code in range(32, 256):
+        try:
+            char = bytes([code]).decode(ENCODING)
+        except UnicodeDecodeError:
+            widths.append(0)
+        else:
+            widths.append(font.getsize(char)[0])
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    descriptor_id = pdf.add_object(
+        '<< /Type /FontDescriptor /FontName /{0} /Flags 32 /FontBBox [0 {2} 1000 {1}] '
+        '/ItalicAngle 0 /Ascent {1} /Descent {2} /CapHeight {1} /StemV 80 '
+        '/FontFile2 {3} 0 R >>'.format(name, ascent, -descent, file_id))
+
+    return pdf.add_object(
+        '<< /Type /Font /Subtype /TrueType /BaseFont /{0} /FirstChar 32 /LastChar 255 '
+        '/Widths [{1}] /Encoding /WinAnsiEncoding /FontDescriptor {2} 0 R >>'.format(
+            name, ' '.join(str(w) for w in widths), descriptor_id))
+
+
+def pdf_string(text):
+    """Encode text as a PDF literal string"""
+    data = text.encode(ENCODING, 'replace')
+    return b'(' + data.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)') + \
+        b')'
+
+
+class PdfAutoFill(AutoFill):
+    """AutoFill recording PDF operations, added as a page of a PdfDocument"""
+
+    def load_template(self, base_image):
+        self.template = base_image
+        self.operations = []
+        self.photos = []
+        self.fonts = set()
+        self.calls = []
+
+    def add_text_center(self, text, y_pos, color='#FFA726'):
+        """Draw text centered horizontally, shrunk or wrapped like AutoFill.add_text_center"""
+        self.calls.append((self.font_path, self.font_size, 'add_text_center',
+                           (text, y_pos, color)))
+        width = self.WIDTH - 2 * self.TEXT_MARGIN
+        size, lines = self.font_size, [text]
+        if text_width(self.font_path, size, text) > width:
+            size, lines = fit_text(text, self.font_path, size, width,
+                                   min(self.MIN_FONT_SIZE, size))
+
+        ascent = cache.font(self.font_path, size).getmetrics()[0]
+        line_height = int(size * self.LINE_SPACING)
+        y_pos -= (len(lines) - 1) * line_height // 2
+        red, green, blue = ImageColor.getrgb(color)[:3]
+
+        self.fonts.add(self.font_path)
+        for line in lines:
+            x_pos = (self.WIDTH - text_width(self.font_path, size, line)) / 2
+            self.operations.append(('text', self.font_path, size * SCALE,
+                                    (red / 255, green / 255, blue / 255), x_pos * SCALE,
+                                    (self.HEIGHT - y_pos - ascent) * SCALE, pdf_string(line)))
+            y_pos += line_height
+
+    def paste_photo(self, image_path, box):
+        """Add photo cropped to fill box, a tuple of left, top, width and height"""
+        self.calls.append((self.font_path, self.font_size, 'paste_photo', (image_path, box)))
+        photo = crop_photo(image_path, box[2:])
+        if photo.mode != 'RGB':
+            photo = photo.convert('RGB')
+
+        buffer = io.BytesIO()
+        photo.save(buffer, 'JPEG', quality=JPEG_QUALITY)
+        self.photos.append((photo.width, photo.height, buffer.getvalue()))
+
+        left, top, width, height = box
+        self.operations.append(('photo', len(self.photos) - 1, width * SCALE, height * SCALE,
+                                left * SCALE, (self.HEIGHT - top - height) * SCALE))
+
+    def preview(self):
+        """Draw the card on a bitmap AutoFill, as it would be rendered by the bitmap backend"""
+        card = AutoFill(self.template)
+        for name in ('WIDTH', 'HEIGHT', 'TEXT_MARGIN', 'MIN_FONT_SIZE', 'LINE_SPACING'):
+            setattr(card, name, getattr(self, name))
+
+        for font_path, font_size, method, args in self.calls:
+            card.set_font(font_path, font_size)
+            getattr(card, method)(*args)
+
+        return card
+
+    def show(self):
+        """Display a raster preview of the card"""
+        self.preview().show()
+
+    def save(self, output_path):
+        """Save the card as a single page PDF"""
+        document = PdfDocument(output_path)
+        document.add(self)
+        document.close()
+
+
+class PdfTeamIDCard(PdfAutoFill, TeamIDCard):
+    @staticmethod
+    def fill(base_image, persons, output_path):
+        """Fill team members ID card in output_path/team.pdf"""
+        render_pdf(persons, os.path.join(output_path, 'team.pdf'), 'team', base_image)
+
+
+class PdfPersIDCard(PdfAutoFill, PersIDCard):
+    @staticmethod
+    def fill(base_image, persons, output_path):
+        """Fill pers ID card in output_path/pers.pdf"""
+        render_pdf(persons, os.path.join(output_path, 'pers.pdf'), 'pers', base_image)
+
+
+class PdfDocument:
+    """PDF of many cards, one page per card"""
+
+    def __init__(self, path):
+        self.pdf = PdfFile(path)
+        self.templates = {}
+        self.fonts = {}
+
+    def template(self, path):
+        if path not in self.templates:
+            image = cache.image(path)
+            if image.mode != 'RGB':
+                background = Image.new('RGB', image.size, 'white')
+                if image.mode == 'RGBA':
+                    background.paste(image, (0, 0), image)
+                else:
+                    background.paste(image.convert('RGB'))
+                image = background
+            self.templates[path] = image_object(self.pdf, image)
+
+        return self.templates[path]
+
+    def font(self, path):
+        if path not in self.fonts:
+            self.fonts[path] = font_object(self.pdf, path)
+
+        return self.fonts[path]
+
+    def add(self, card):
+        """Write a card as a new page"""
+        width, height = card.WIDTH * SCALE, card.HEIGHT * SCALE
+        template = self.template(card.template)
+        fonts = {path: self.font(path) for path in card.fonts}
+        photos = [jpeg_object(self.pdf, *photo) for photo in card.photos]
+
+        content = ['q {0:.2f} 0 0 {1:.2f} 0 0 cm /T Do Q'.format(width, height).encode('ascii')]
+        for operation in card.operations:
+            if operation[0] == 'photo':
+                _, index, w, h, x, y = operation
+                content.append('q {0:.2f} 0 0 {1:.2f} {2:.2f} {3:.2f} cm /P{4} Do Q'.format(
+                    w, h, x, y, index).encode('ascii'))
+            else:
+                _, font, size, color, x, y, text = operation
+                content.append('BT /F{0} {1:.2f} Tf {2:.3f} {3:.3f} {4:.3f} rg '
+                               '{5:.2f} {6:.2f} Td '.format(
+                                   fonts[font], size, color[0], color[1], color[2], x,
+                                   y).encode('ascii') + text + b' Tj ET')
+
+        xobjects = ' '.join(['/T {0} 0 R'.format(template)] + [
+            '/P{0} {1} 0 R'.format(index, number) for index, number in enumerate(photos)])
+        font_resources = ' '.join('/F{0} {0} 0 R'.format(number) for number in fonts.values())
+        resources = '<< /XObject << {0} >> /Font << {1} >> >>'.format(xobjects, font_resources)
+        self.pdf.add_page(width, height, resources, b'\n'.join(content))
+
+    def close(self):
+        self.pdf.close()
+
+
+def render_pdf(persons, output, kind='team', base_image=None):
+    """Render the cards of persons in a single PDF, one page per card
+
+    Args:
+        - persons: queryset or list of Person, a queryset also fetches the teams in the same
+          query
+        - output: path of the PDF
+        - kind: name of the card layout, see layout.py
+        - base_image: path of the card template, None to use the template of the layout
+
+    Returns:
+        Number of pages
+
+    """
+    layout = layouts[kind]
+    document = PdfDocument(output)
+    pages = 0
+    outputs = set()
+
+    if hasattr(persons, 'select_related'):
+        persons = persons.select_related('team__university').iterator()
+
+    for person in persons:
+        data = card_data(person)
+        name = layout.output_name(data)
+        if name in outputs:
+            continue
+        outputs.add(name)
+
+        card = PdfAutoFill(base_image or layout.template)
+        card.WIDTH, card.HEIGHT = layout.WIDTH, layout.HEIGHT
+        layout.draw(card, data)
+        document.add(card)
+        pages += 1
+
+    document.close()
+
+    return pages
@@ -0,0 +1,223 @@
+"""Print sheet imposition of ID cards
+
+Cards are placed in a grid on A4 or A3 sheets at 300 dpi, the resolution of the card
+templates, with crop marks on the sheet margin at every card edge. The sheets are written
+one by one, either as pages of a PDF or as PNG tiles, so only the current sheet is kept in
+memory. One file is written for each division or university.
+
+"""
+
+import io
+import itertools
+import multiprocessing
+import os
+from PIL import Image, ImageDraw
+from .autofill import cache, card_data
+from .layout import layouts
+from .pdf import PdfFile, jpeg_object
+
+DPI = 300
+PAPER = {
+    'A4': (2480, 3508),
+    'A3': (3508, 4961),
+}
+MARGIN = 100
+MARK_LENGTH = 40
+MARK_OFFSET = 12
+JPEG_QUALITY = 92
+
+GROUPS = {
+    'division': ('team__division', 'team__university__abbreviation', 'team__id', 'id'),
+    'university': ('team__university__abbreviation', 'team__university__id', 'team__division',
+                   'team__id', 'id'),
+}
+
+
+class Sheet:
+    """Grid of cards on a sheet of paper"""
+
+    def __init__(self, card_size, paper='A4', margin=MARGIN):
+        self.size = PAPER[paper]
+        self.card_width, self.card_height = card_size
+        self.columns = (self.size[0] - 2 * margin) // self.card_width
+        self.rows = (self.size[1] - 2 * margin) // self.card_height
+        if not self.columns or not self.rows:
+            raise ValueError('Card does not fit on ' + paper)
+
+        self.left = (self.size[0] - self.columns * self.card_width) // 2
+        self.top = (self.size[1] - self.rows * self.card_height) // 2
+        self.slots = [(self.left + c * self.card_width, self.top + r * self.card_height)
+                      for r in range(self.rows) for c in range(self.columns)]
+
+    def new_page(self):
+        """Create an empty sheet with crop marks"""
+        page = Image.new('RGB', self.size, 'white')
+        draw = ImageDraw.Draw(page)
+        right = self.left + self.columns * self.card_width
+        bottom = self.top + self.rows * self.card_height
+
+        for c in range(self.columns + 1):
+            x = self.left + c * self.card_width
+            draw.line((x, self.top - MARK_OFFSET - MARK_LENGTH, x, self.top - MARK_OFFSET),
+                      'black', 2)
+            draw.line((x, bottom + MARK_OFFSET, x, bottom + MARK_OFFSET + MARK_LENGTH),
+                      'black', 2)
+
+        for r in range(self.rows + 1):
+            y = self.top + r * self.card_height
+            draw.line((self.left - MARK_OFFSET - MARK_LENGTH, y, self.left - MARK_OFFSET, y),
+                      'black', 2)
+            draw.line((right + MARK_OFFSET, y, right + MARK_OFFSET + MARK_LENGTH, y),
+                      'black', 2)
+
+        return page
+
+    def pages(self, cards):
+        """Place cards on sheets
+
+        Args:
+            - cards: iterable of card images
+
+        Yields:
+            Every full sheet, and the last sheet even if it is not full
+
+        """
+        page = None
+        for index, card in enumerate(cards):
+            slot = index % len(self.slots)
+            if slot == 0:
+                if page is not None:
+                    yield page
+                page = self.new_page()
+
+            if card.mode == 'RGBA':
+                page.paste(card, self.slots[slot], card)
+            else:
+                page.paste(card, self.slots[slot])
+
+        if page is not None:
+            yield page
+
+
+class PdfWriter:
+    """PDF with one JPEG image per page, each page written as soon as it is added"""
+
+    def __init__(self, path, dpi=DPI):
+        self.dpi = dpi
+        self.pdf = PdfFile(path)
+        self.pages = self.pdf.pages
+
+    def add_page(self, page):
+        buffer = io.BytesIO()
+        page.save(buffer, 'JPEG', quality=JPEG_QUALITY, dpi=(self.dpi, self.dpi))
+        image_id = jpeg_object(self.pdf, page.width, page.height, buffer.getvalue())
+
+        width, height = page.width * 72 / self.dpi, page.height * 72 / self.dpi
+        content = 'q {0:.2f} 0 0 {1:.2f} 0 0 cm /Card Do Q'.format(width, height)
+        self.pdf.add_page(width, height, '<< /XObject << /Card {0} 0 R >> >>'.format(image_id),
+                          content.encode('ascii'))
+
+    def close(self):
+        self.pdf.close()
+
+
+class TileWriter:
+    """Write each sheet as a numbered PNG file"""
+
+    def __init__(self, path, dpi=DPI):
+        self.path = path
+        self.dpi = dpi
+        self.pages = []
+
+    def add_page(self, page):
+        out = '{0}-{1:03d}.png'.format(self.path, len(self.pages) + 1)
+        page.save(out + '.part', 'PNG', dpi=(self.dpi, self.dpi))
+        os.replace(out + '.part', out)
+        self.pages.append(out)
+
+    def close(self):
+        pass
+
+
+WRITERS = {
+    'pdf': ('.pdf', PdfWriter),
+    'png': ('', TileWriter),
+}
+
+
+def render_image(job):
+    """Render a card in a worker process and return its image"""
+    kind, base_image, data = job
+    return layouts[kind].render(base_image, data).img
+
+
+def group_name(data, group):
+    """Name of the output file of a card"""
+    if group == 'division':
+        return data['division_key']
+
+    return data['abbreviation']
+
+
+def impose_batch(base_image, persons, output_path, kind='team', group='division', paper='A4',
+                 output_format='pdf', processes=None, window=64):
+    """Render ID cards on print sheets, one file per division or university
+
+    Args:
+        - base_image: path of the card template, None to use the template of the layout
+        - persons: Person queryset
+        - output_path: directory of the output files
+        - kind: name of the card layout, see layout.py
+        - group: 'division' or 'university'
+        - paper: 'A4' or 'A3'
+        - output_format: 'pdf' for a multi-page PDF, 'png' for one PNG file per sheet
+        - processes: number of worker processes rendering the cards
+        - window: maximum number of cards rendered ahead of the sheet being filled
+
+    Returns:
+        Dictionary of output file name to number of pages
+
+    Raises:
+        - ValueError: the card does not fit on the paper
+
+    """
+    layout = layouts[kind]
+    extension, writer_class = WRITERS[output_format]
+    sheet = Sheet((layout.WIDTH, layout.HEIGHT), paper)
+    persons = persons.select_related('team__university').order_by(*GROUPS[group])
+    files = {}
+
+    def jobs():
+        for person in persons.iterator():
+            data = card_data(person)
+            yield group_name(data, group), (kind, base_image, data)
+
+    def cards(pool, group_jobs):
+        group_jobs = iter(group_jobs)
+        while True:
+            chunk = [job for _, job in itertools.islice(group_jobs, window)]
+            if not chunk:
+                return
+            for img in pool.imap(render_image, chunk):
+                yield img
+
+    # Decode the template before forking, so the workers inherit it from the cache
+    cache.image(base_image or layout.template)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for name, group_jobs in itertools.groupby(jobs(), lambda job: job[0]):
+            writer = writer_class(os.path.join(output_path, name + extension))
+            for page in sheet.pages(cards(pool, group_jobs)):
+                writer.add_page(page)
+            writer.close()
+            files[name + extension] = len(writer.pages)
+
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return files
@@ -0,0 +1,281 @@
+import os
+import re
+import shutil
+import tempfile
+from django.test import TestCase
+import PIL
+from PIL import Image
+from kri.apps.participant.models import Person
+from kri.apps.participant import tests as participant_tests
+from .autofill import FONT, PersIDCard, ResourceCache, TeamIDCard, fit_text, text_width, \
+    wrap_text
+from .batch import render_batch
+from .benchmark import benchmark
+from .layout import layouts
+from .pdf import PdfAutoFill, PdfFile, PdfTeamIDCard, render_pdf
+from .sheet import PAPER, Sheet
+
+
+class OutputMixin:
+    """Render into a temporary directory removed after each test"""
+    def setUp(self):
+        super(OutputMixin, self).setUp()
+        self.output = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output, ignore_errors=True)
+        super(OutputMixin, self).tearDown()
+
+    def cards(self):
+        return sorted(f for f in os.listdir(self.output) if f.endswith('.png'))
+
+
+class BatchTestCase(OutputMixin, TestCase):
+    def setUp(self):
+        super(BatchTestCase, self).setUp()
+        team = participant_tests.TeamTestCase.mock_team('SPY', 'krai')
+        self.persons = [
+            participant_tests.PersonTestCase.mock_person(name, team, 'core_member')
+            for name in ('John Doe', 'Jane Doe', 'Richard Roe')
+        ]
+
+    def render(self, **kwargs):
+        return render_batch(None, Person.objects.all(), self.output, processes=1, progress=None,
+                            **kwargs)
+
+    def test_render_batch(self):
+        """Render one card per person"""
+        stats = self.render()
+
+        self.assertEqual(stats['rendered'], 3)
+        self.assertEqual(len(self.cards()), 3)
+        self.assertTrue(os.path.exists(os.path.join(self.output, 'manifest.json')))
+
+    def test_fill_list(self):
+        """Fill the cards of a list of persons"""
+        TeamIDCard.fill(None, self.persons[:2], self.output)
+
+        self.assertEqual(len(self.cards()), 2)
+
+    def test_skip_unchanged(self):
+        """Render again only the cards whose values changed"""
+        self.render()
+        Person.objects.filter(id=self.persons[0].id).update(name='John Roe')
+        stats = self.render()
+
+        self.assertEqual(stats['rendered'], 1)
+        self.assertEqual(stats['skipped'], 2)
+
+    def test_prune(self):
+        """Remove the cards of deleted persons"""
+        self.render()
+        self.persons[0].delete()
+        stats = self.render()
+
+        self.assertEqual(stats['rendered'], 0)
+        self.assertEqual(len(stats['removed']), 0)
+        self.assertEqual(len(self.cards()), 3)
+
+        stats = self.render(prune=True)
+        self.assertEqual(len(stats['removed']), 1)
+        self.assertEqual(len(self.cards()), 2)
+
+
+class ResourceCacheTestCase(OutputMixin, TestCase):
+    def setUp(self):
+        super(ResourceCacheTestCase, self).setUp()
+        self.paths = []
+        for name in ('a.png', 'b.png'):
+            path = os.path.join(self.output, name)
+            Image.new('RGB', (10, 10), 'white').save(path)
+            self.paths.append(path)
+
+    def test_hits(self):
+        """Decode an image once"""
+        cache = ResourceCache()
+        first = cache.image(self.paths[0])
+
+        self.assertIs(cache.image(self.paths[0]), first)
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['bytes'], 10 * 10 * 3)
+
+    def test_eviction(self):
+        """Drop the least recently used image over the size limit"""
+        cache = ResourceCache(max_bytes=500)
+        cache.image(self.paths[0])
+        cache.image(self.paths[1])
+
+        self.assertEqual(cache.stats()['entries'], 1)
+        self.assertEqual(cache.stats()['bytes'], 300)
+
+        cache.image(self.paths[1])
+        cache.image(self.paths[0])
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 3)
+
+
+class BenchmarkTestCase(TestCase):
+    def test_benchmark(self):
+        """Time a single card with a single worker"""
+        result = benchmark([1], [1], photo_size=(60, 80), photo_count=1)
+
+        self.assertEqual(result['pillow'], PIL.__version__)
+        self.assertEqual(len(result['runs']), 1)
+        self.assertEqual(result['runs'][0]['cards'], 1)
+        self.assertEqual(result['runs'][0]['workers'], 1)
+
+
+class SheetTestCase(TestCase):
+    CARD = (638, 1011)
+
+    def test_slots(self):
+        """Fit more cards on A3 than on A4"""
+        a4 = Sheet(self.CARD, 'A4')
+        a3 = Sheet(self.CARD, 'A3')
+
+        self.assertEqual((a4.columns, a4.rows), (3, 3))
+        self.assertEqual((a3.columns, a3.rows), (5, 4))
+        self.assertEqual(len(a4.slots), 9)
+        self.assertEqual(len(a3.slots), 20)
+
+    def test_pages(self):
+        """Start a new sheet once every slot is taken"""
+        sheet = Sheet(self.CARD, 'A4')
+        cards = (Image.new('RGB', self.CARD, 'red') for _ in range(10))
+        pages = list(sheet.pages(cards))
+
+        self.assertEqual(len(pages), 2)
+        self.assertEqual(pages[0].size, PAPER['A4'])
+        self.assertEqual(pages[1].getpixel(sheet.slots[0]), (255, 0, 0))
+        self.assertEqual(pages[1].getpixel(sheet.slots[1]), (255, 255, 255))
+
+    def test_card_too_large(self):
+        """Reject a card larger than the paper"""
+        with self.assertRaises(ValueError):
+            Sheet((3000, 5000), 'A4')
+
+
+class TextLayoutTestCase(TestCase):
+    NAME = 'Muhammad Abdurrahman Wicaksono Prasetyo Nugroho Hadiningrat'
+    WIDTH = 638 - 2 * 24
+
+    def test_wrap_text(self):
+        """Break lines between words only"""
+        lines = wrap_text(self.NAME, FONT, 24, self.WIDTH)
+
+        self.assertGreater(len(lines), 1)
+        self.assertEqual(' '.join(lines), self.NAME)
+        for line in lines:
+            self.assertLessEqual(text_width(FONT, 24, line), self.WIDTH)
+
+    def test_fit_text(self):
+        """Shrink the longest name until it fits the box"""
+        size, lines = fit_text(self.NAME, FONT, 48, self.WIDTH, 14)
+
+        self.assertLess(size, 48)
+        self.assertLessEqual(len(lines), 2)
+        for line in lines:
+            self.assertLessEqual(text_width(FONT, size, line), self.WIDTH)
+
+    def test_fit_short_text(self):
+        """Keep the size of a text that fits"""
+        self.assertEqual(fit_text('John Doe', FONT, 24, self.WIDTH, 14), (24, ['John Doe']))
+
+
+class LayoutTestCase(OutputMixin, TestCase):
+    def setUp(self):
+        super(LayoutTestCase, self).setUp()
+        photo = os.path.join(self.output, 'photo.jpg')
+        Image.new('RGB', (300, 400), 'blue').save(photo)
+        self.data = {
+            'id': 1, 'name': 'john doe', 'team': 'spy', 'division': 'KRAI',
+            'division_key': 'krai', 'role': 'Ketua', 'university': 'universitas indonesia',
+            'abbreviation': 'UI', 'photo': photo,
+        }
+
+    def test_compiled_once(self):
+        """Compile a layout on first use only"""
+        self.assertIs(layouts['team'], layouts['team'])
+        self.assertIn('pers', layouts)
+        self.assertNotIn('unknown', layouts)
+
+    def test_team_layout(self):
+        """Draw the same pixels as TeamIDCard"""
+        layout = layouts['team']
+        card = TeamIDCard(layout.template)
+        card.add_photo(self.data['photo'])
+        card.add_name(self.data['name'])
+        card.add_team(self.data['team'], self.data['division'], self.data['role'])
+        card.add_university(self.data['university'])
+
+        rendered = layout.render(None, self.data)
+        self.assertEqual(rendered.img.tobytes(), card.img.tobytes())
+        self.assertEqual(layout.output_name(self.data), 'UI-krai-1.png')
+
+    def test_pers_layout(self):
+        """Draw the same pixels as PersIDCard"""
+        layout = layouts['pers']
+        card = PersIDCard(layout.template)
+        card.add_agency(self.data['abbreviation'])
+
+        rendered = layout.render(None, self.data)
+        self.assertEqual(rendered.img.tobytes(), card.img.tobytes())
+
+
+class PdfTestCase(OutputMixin, TestCase):
+    def test_xref(self):
+        """Point every cross-reference entry at its object"""
+        path = os.path.join(self.output, 'test.pdf')
+        pdf = PdfFile(path)
+        pdf.add_page(100, 100, '<< >>', b'0 0 m 100 100 l S')
+        pdf.add_page(200, 100, '<< >>', b'0 0 m 200 100 l S')
+        pdf.close()
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        xref = int(re.search(rb'startxref\n(\d+)\n%%EOF\n$', data).group(1))
+        self.assertTrue(data[xref:].startswith(b'xref\n'))
+
+        entries = data[xref:].split(b'trailer')[0].splitlines()[3:]
+        self.assertEqual(len(entries), pdf.next_id - 1)
+        for number, entry in enumerate(entries, 1):
+            offset = int(entry.split()[0])
+            self.assertTrue(data[offset:].startswith('{0} 0 obj'.format(number).encode()))
+
+    def test_render_pdf(self):
+        """Write one page per card"""
+        team = participant_tests.TeamTestCase.mock_team('SPY', 'krai')
+        for name in ('John Doe', 'Jane Doe'):
+            participant_tests.PersonTestCase.mock_person(name, team, 'core_member')
+        path = os.path.join(self.output, 'cards.pdf')
+
+        self.assertEqual(render_pdf(Person.objects.all(), path), 2)
+        with open(path, 'rb') as f:
+            self.assertIn(b'/Type /Pages /Kids [', f.read())
+
+    def test_fill(self):
+        """Fill a list of persons in a single PDF"""
+        team = participant_tests.TeamTestCase.mock_team('SPY', 'krai')
+        persons = [participant_tests.PersonTestCase.mock_person(name, team, 'core_member')
+                   for name in ('John Doe', 'Jane Doe')]
+        PdfTeamIDCard.fill(None, persons, self.output)
+
+        self.assertEqual(os.listdir(self.output), ['team.pdf'])
+        with open(os.path.join(self.output, 'team.pdf'), 'rb') as f:
+            self.assertEqual(f.read().count(b'/Type /Page '), 2)
+
+    def test_preview(self):
+        """Preview the same pixels as the bitmap layout"""
+        layout = layouts['team']
+        data = {
+            'id': 1, 'name': 'john doe', 'team': 'spy', 'division': 'KRAI',
+            'division_key': 'krai', 'role': 'Ketua', 'university': 'universitas indonesia',
+            'abbreviation': 'UI', 'photo': None,
+        }
+        card = PdfAutoFill(layout.template)
+        card.WIDTH, card.HEIGHT = layout.WIDTH, layout.HEIGHT
+        layout.draw(card, data)
+
+        self.assertEqual(card.preview().img.tobytes(), layout.render(None, data).img.tobytes())
@@ -0,0 +1 @@
+default_app_config = 'kri.apps.participant.apps.ParticipantConfig'
@@ -1,13 +1,30 @@
-from django.contrib import admin
+from django.conf.urls import url
+from django.contrib import admin, messages
 from django.core import urlresolvers
+from django.core.exceptions import PermissionDenied
+from django.http import StreamingHttpResponse
+from django.shortcuts import redirect, render
 from django.utils.html import format_html
 from django.utils.safestring import mark_safe
+from kri.apps.autofill.archive import zip_cards
+from . import statistics
+from .forms import RosterImportForm
 from .models import University, Manager, Team, Person, Supporter
 
+
+def id_card_response(persons):
+    """Stream a zip of the ID cards of persons"""
+    response = StreamingHttpResponse(zip_cards(persons), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="id-cards.zip"'
+
+    return response
+
+
 @admin.register(University)
 class UniversityAdmin(admin.ModelAdmin):
     list_display = ('name', 'link_to_manager', 'krai', 'krsbi_beroda', 'krsti', 'krpai',
-                    'is_complete')
+                    'complete')
+    list_filter = ('complete',)
 
     def link_to_manager(self, obj):
         """Returns a link to university's manager"""
@@ -21,6 +38,27 @@ class UniversityAdmin(admin.ModelAdmin):
     link_to_manager.short_description = 'Manager'
     link_to_manager.admin_order_field = 'user__manager__name'
 
+    def get_urls(self):
+        return [
+            url(r'^statistics/$', self.admin_site.admin_view(self.statistics_view),
+                name='participant_university_statistics'),
+        ] + super(UniversityAdmin, self).get_urls()
+
+    def statistics_view(self, request):
+        """Show the registration statistics of every division"""
+        result = statistics.statistics()
+        rows = [(row, [row['persons'][t[0]] for t in Person.PERSON_TYPE])
+                for row in result['divisions']]
+
+        return render(request, 'admin/participant/university/statistics.html', dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta,
+            title='Registration statistics',
+            statistics=result,
+            rows=rows,
+            person_types=Person.PERSON_TYPE,
+        ))
+
 
 @admin.register(Manager)
 class ManagerAdmin(admin.ModelAdmin):
@@ -59,19 +97,37 @@ class ManagerAdmin(admin.ModelAdmin):
 @admin.register(Team)
 class TeamAdmin(admin.ModelAdmin):
     list_display = ('name', 'university', 'division', 'core_member_count', 'mechanics_count',
-                    'adviser_count', 'is_complete')
-    list_filter = ('university', 'division')
+                    'adviser_count', 'complete')
+    list_filter = ('complete', 'university', 'division')
     readonly_fields = ('core_member', 'mechanics', 'adviser')
     search_fields = ('name', 'university__name', 'university__abbreviation')
+    actions = ['download_id_cards']
+
+    def download_id_cards(self, request, queryset):
+        """Download the ID cards of the selected teams' members"""
+        return id_card_response(Person.objects.filter(team__in=queryset))
+
+    download_id_cards.short_description = 'Download ID cards'
+
+    def get_queryset(self, request):
+        return super(TeamAdmin, self).get_queryset(request).with_completeness()
+
+    @staticmethod
+    def roster(obj):
+        """Roster of a team, loaded once for all of its fields"""
+        if not hasattr(obj, '_roster'):
+            obj._roster = obj.roster()
+
+        return obj._roster
 
     def core_member(self, obj):
-        return self.create_person_link(obj.core_member())
+        return self.create_person_link(self.roster(obj).members['core_member'])
 
     def mechanics(self, obj):
-        return self.create_person_link(obj.mechanics())
+        return self.create_person_link(self.roster(obj).members['mechanics'])
 
     def adviser(self, obj):
-        return self.create_person_link(obj.adviser())
+        return self.create_person_link(self.roster(obj).members['adviser'])
 
     def create_person_link(self, persons):
         text = '<br/><ol>'
@@ -87,19 +143,22 @@ class TeamAdmin(admin.ModelAdmin):
 
     def core_member_count(self, obj):
         """Returns the team's core member count"""
-        return obj.core_member().count()
+        return obj.core_member_count
 
     def mechanics_count(self, obj):
         """Returns the team's mechanics count"""
-        return obj.mechanics().count()
+        return obj.mechanics_count
 
     def adviser_count(self, obj):
         """Returns the team's adviser count"""
-        return obj.adviser().count()
+        return obj.adviser_count
 
     core_member_count.short_description = 'Core Member'
+    core_member_count.admin_order_field = 'core_member_count'
     mechanics_count.short_description = 'Mechanics'
+    mechanics_count.admin_order_field = 'mechanics_count'
     adviser_count.short_description = 'Adviser'
+    adviser_count.admin_order_field = 'adviser_count'
 
 
 @admin.register(Person)
@@ -108,6 +167,47 @@ class PersonAdmin(admin.ModelAdmin):
     list_filter = ('type', 'gender')
     search_fields = ('name', 'team__name', 'team__university__name',
                      'team__university__abbreviation')
+    actions = ['download_id_cards']
+
+    def download_id_cards(self, request, queryset):
+        """Download the ID cards of the selected persons"""
+        return id_card_response(queryset)
+
+    download_id_cards.short_description = 'Download ID cards'
+
+    def get_urls(self):
+        return [
+            url(r'^import/$', self.admin_site.admin_view(self.import_view),
+                name='participant_person_import'),
+        ] + super(PersonAdmin, self).get_urls()
+
+    def import_view(self, request):
+        """Add persons from an uploaded roster csv and zip of photos"""
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+
+        errors = []
+        if request.method == 'POST':
+            form = RosterImportForm(request.POST, request.FILES)
+            if form.is_valid():
+                dry_run = form.cleaned_data['dry_run']
+                persons, errors = Person.import_roster(form.cleaned_data['rows'],
+                                                       form.cleaned_data['photos'], dry_run)
+                if not errors and dry_run:
+                    messages.success(request, '{0} persons are valid.'.format(len(persons)))
+                elif not errors:
+                    messages.success(request, '{0} persons added.'.format(len(persons)))
+                    return redirect('admin:participant_person_changelist')
+        else:
+            form = RosterImportForm()
+
+        return render(request, 'admin/participant/person/import.html', dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta,
+            title='Import roster',
+            form=form,
+            errors=errors,
+        ))
 
     def team_name(self, obj):
         """Returns the person's team name"""
@@ -2,4 +2,8 @@ from django.apps import AppConfig
 
 
 class ParticipantConfig(AppConfig):
-    name = 'participant'
+    name = 'kri.apps.participant'
+    label = 'participant'
+
+    def ready(self):
+        from . import signals
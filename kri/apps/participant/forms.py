@@ -1,3 +1,7 @@
+import csv
+import io
+import zipfile
+from django import forms
 from django.forms import ModelForm, HiddenInput, DateInput, DateTimeField, FileInput
 from django.contrib.auth.models import User
 from .models import Team, Person, Manager, Supporter
@@ -44,3 +48,60 @@ class SupporterForm(ModelForm):
     class Meta:
         model = Supporter
         fields = ['amount']
+
+
+ROSTER_FIELDS = ('university', 'division', 'name', 'type', 'instance_id', 'birthday', 'gender',
+                 'phone', 'email')
+
+
+class RosterImportForm(forms.Form):
+    """Upload form for Person.import_roster"""
+    file = forms.FileField(help_text='CSV with the columns {0} and an optional photo '
+                                     'column.'.format(', '.join(ROSTER_FIELDS)))
+    photos = forms.FileField(required=False,
+                             help_text='Zip of the photos named in the photo column.')
+    dry_run = forms.BooleanField(required=False, initial=True,
+                                 help_text='Only validate the file, do not add the persons.')
+
+    def clean_file(self):
+        upload = self.cleaned_data['file']
+        try:
+            self.cleaned_data['rows'] = read_roster_csv(
+                io.TextIOWrapper(upload.file, encoding='utf-8-sig'))
+        except (ValueError, UnicodeDecodeError, csv.Error) as error:
+            raise forms.ValidationError(str(error))
+
+        return upload
+
+    def clean_photos(self):
+        upload = self.cleaned_data['photos']
+        if upload:
+            try:
+                return zipfile.ZipFile(upload)
+            except zipfile.BadZipFile:
+                raise forms.ValidationError('The photos are not a zip file.')
+
+        return None
+
+
+def read_roster_csv(text_file):
+    """Read the rows of a roster csv file
+
+    The header must contain every column of ROSTER_FIELDS, the photo column is optional.
+    The birthday is written as dd/mm/yyyy, like in PersonForm.
+
+    Returns:
+        List of dictionaries of the ROSTER_FIELDS and photo values
+
+    Raises:
+        - ValueError: the header is invalid
+
+    """
+    reader = csv.DictReader(text_file)
+    header = reader.fieldnames or []
+    for field in ROSTER_FIELDS:
+        if field not in header:
+            raise ValueError('The file has no {0} column.'.format(field))
+
+    return [{field: row.get(field) or '' for field in ROSTER_FIELDS + ('photo',)}
+            for row in reader]
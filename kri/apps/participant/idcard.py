@@ -0,0 +1,72 @@
+"""ID card previews
+
+A preview is rendered with the card layout of the person and kept in the default cache under
+a digest of everything drawn on the card. The digest is also the ETag of the preview, so a
+browser that already has the current card gets a 304 without any rendering.
+
+The digest is computed from the person read from the database on every request, never from
+a cached value, so a change made by another process is seen even when every process has its
+own cache. A preview is only looked up by the digest of the values it was drawn from, so a
+stale preview is never served, it just expires. The browser may also reuse a preview for
+BROWSER_MAX_AGE seconds without asking.
+
+"""
+
+import hashlib
+import io
+import json
+import os
+from django.core.cache import cache
+from kri.apps.autofill.archive import card_kind
+from kri.apps.autofill.autofill import card_data
+from kri.apps.autofill.layout import layouts
+from .models import Person
+
+CACHE_TIMEOUT = 24 * 60 * 60
+BROWSER_MAX_AGE = 60
+
+
+def png_key(digest):
+    return 'idcard:png:{0}'.format(digest)
+
+
+def file_signature(path):
+    """Size and modification time of a file, which change when it is replaced"""
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return None
+
+    return [stat.st_size, stat.st_mtime]
+
+
+def card_digest(person):
+    """Hash of the layout, template, values and photo of a person's card"""
+    layout = layouts[card_kind(person)]
+    data = card_data(person)
+    values = [layout.name, layout.digest, file_signature(layout.template),
+              [data[field] for field in layout.FIELDS]]
+    for field in layout.PHOTO_FIELDS:
+        values.append(file_signature(data[field]))
+
+    return hashlib.sha1(json.dumps(values).encode('utf-8')).hexdigest()
+
+
+def get_person(person_id):
+    return Person.objects.select_related('team__university').get(pk=person_id)
+
+
+def card_png(person, digest=None):
+    """Get the PNG of a person's card, rendered only if it is not in the cache"""
+    if digest is None:
+        digest = card_digest(person)
+
+    png = cache.get(png_key(digest))
+    if png is None:
+        card = layouts[card_kind(person)].render(None, card_data(person))
+        buffer = io.BytesIO()
+        card.img.save(buffer, 'PNG')
+        png = buffer.getvalue()
+        cache.set(png_key(digest), png, CACHE_TIMEOUT)
+
+    return png
@@ -0,0 +1,18 @@
+"""Generate the missing or outdated photo variants"""
+
+from django.core.management.base import BaseCommand
+from kri.apps.participant import photos
+from kri.apps.participant.models import Person
+
+
+class Command(BaseCommand):
+    help = 'Generate the card and thumbnail variants of every person photo'
+
+    def handle(self, *args, **options):
+        count = 0
+        for person in Person.objects.iterator():
+            if not photos.is_current(person):
+                photos.build_derivatives(person)
+                count += 1
+
+        self.stdout.write('Generated the photo variants of {0} persons.'.format(count))
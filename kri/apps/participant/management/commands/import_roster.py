@@ -0,0 +1,41 @@
+"""Add the persons of many teams from a csv file"""
+
+import zipfile
+from django.core.management.base import BaseCommand, CommandError
+from kri.apps.participant.forms import ROSTER_FIELDS, read_roster_csv
+from kri.apps.participant.models import Person
+
+
+class Command(BaseCommand):
+    help = 'Add persons from a csv with the columns {0} and an optional photo column'.format(
+        ', '.join(ROSTER_FIELDS))
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV file to import')
+        parser.add_argument('--photos', help='Zip of the photos named in the photo column')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only validate the file, do not add the persons')
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['path'], encoding='utf-8-sig', newline='') as text_file:
+                rows = read_roster_csv(text_file)
+            photos = zipfile.ZipFile(options['photos']) if options['photos'] else None
+        except (OSError, ValueError, zipfile.BadZipFile) as error:
+            raise CommandError(error)
+
+        try:
+            persons, errors = Person.import_roster(rows, photos, options['dry_run'])
+        finally:
+            if photos is not None:
+                photos.close()
+
+        for error in errors:
+            self.stderr.write(error)
+
+        if errors:
+            raise CommandError('{0} errors found, no person added.'.format(len(errors)))
+        elif options['dry_run']:
+            self.stdout.write('{0} persons are valid.'.format(len(persons)))
+        else:
+            self.stdout.write('{0} persons added.'.format(len(persons)))
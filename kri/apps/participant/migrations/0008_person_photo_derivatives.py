@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.6 on 2026-10-18 10:36
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('participant', '0007_auto_20170506_0037'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='person',
+            name='photo_card',
+            field=models.ImageField(blank=True, editable=False, upload_to=''),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='photo_thumb',
+            field=models.ImageField(blank=True, editable=False, upload_to=''),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.6 on 2026-10-18 10:46
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def count_if(**conditions):
+    return models.Sum(models.Case(models.When(then=1, **conditions), default=0,
+                                  output_field=models.IntegerField()))
+
+
+def compute_complete(apps, schema_editor):
+    """Set the complete flag of the existing teams and universities"""
+    University = apps.get_model('participant', 'University')
+    Team = apps.get_model('participant', 'Team')
+
+    teams = Team.objects.annotate(
+        core_member_count=count_if(persons__type='core_member'),
+        adviser_count=count_if(persons__type='adviser'),
+        missing_photo_count=count_if(persons__isnull=False, persons__photo=''))
+
+    university_teams = {}
+    for t in teams:
+        complete = bool(not (not t.name and t.arrival_time and t.transport) and
+                        t.core_member_count and t.adviser_count and not t.missing_photo_count)
+        if complete:
+            Team.objects.filter(id=t.id).update(complete=True)
+        university_teams.setdefault(t.university_id, []).append(complete)
+
+    for u in University.objects.all():
+        status = university_teams.get(u.id, [])
+        divisions = 1 + sum([u.krai, u.krsbi_beroda, u.krsti, u.krpai])
+        if len(status) == divisions and all(status):
+            University.objects.filter(id=u.id).update(complete=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('participant', '0008_person_photo_derivatives'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='team',
+            name='complete',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='university',
+            name='complete',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.RunPython(compute_complete, migrations.RunPython.noop),
+    ]
@@ -8,7 +8,7 @@ Each University has multiple Team and each Team has multiple Person.
 import datetime
 import hashlib
 import random
-from django.db import models, IntegrityError
+from django.db import connection, models, transaction, IntegrityError
 from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
 from django.contrib.auth.models import User
 from django.utils import timezone
@@ -22,6 +22,7 @@ class University(models.Model):
     krsbi_beroda = models.BooleanField(default=False)
     krsti = models.BooleanField(default=False)
     krpai = models.BooleanField(default=False)
+    complete = models.BooleanField(default=False, editable=False)
 
     def has_access(self, division):
         """Check if the university could participate in a division
@@ -66,12 +67,22 @@ class University(models.Model):
     def __str__(self):
         return self.name
 
-    def is_complete(self):
-        """Check if university data is complete, including team and person data"""
-        if list(self.all_access().values()).count(True) != self.teams.count():
+    def is_complete(self, teams=None):
+        """Check if university data is complete, including team and person data
+
+        Args:
+            - teams: the university's teams annotated by TeamQuerySet.with_completeness,
+              fetched in one query if None
+
+        """
+        if teams is None:
+            teams = self.teams.with_completeness()
+        teams = list(teams)
+
+        if list(self.all_access().values()).count(True) != len(teams):
             return False
 
-        for t in self.teams.all():
+        for t in teams:
             if not t.is_complete():
                 return False
 
@@ -80,6 +91,51 @@ class University(models.Model):
     is_complete.boolean = True
     is_complete.short_description = 'Complete'
 
+    @staticmethod
+    def completeness(universities):
+        """Check the completeness of universities and their teams
+
+        Two queries are made whatever the number of universities, teams and persons.
+
+        Args:
+            - universities: University queryset
+
+        Returns:
+            - dictionary of university id to completeness
+            - dictionary of team id to completeness
+
+        """
+        teams = {}
+        for team in Team.objects.filter(university__in=universities).with_completeness():
+            teams.setdefault(team.university_id, []).append(team)
+
+        university_status = {}
+        team_status = {}
+        for university in universities:
+            university_teams = teams.get(university.id, [])
+            university_status[university.id] = university.is_complete(university_teams)
+            for t in university_teams:
+                team_status[t.id] = t.is_complete()
+
+        return university_status, team_status
+
+    @staticmethod
+    def update_completeness(universities):
+        """Store the completeness of universities and their teams in the complete field
+
+        Args:
+            - universities: University queryset
+
+        """
+        university_status, team_status = University.completeness(universities)
+
+        for model, status in ((University, university_status), (Team, team_status)):
+            for complete in (True, False):
+                ids = [k for k, v in status.items() if v == complete]
+                if ids:
+                    model.objects.filter(id__in=ids).exclude(complete=complete).update(
+                        complete=complete)
+
     class Meta:
         verbose_name_plural = 'Universities'
 
@@ -101,8 +157,34 @@ class Manager(models.Model):
         return self.user.username
 
 
+def count_if(**conditions):
+    """Aggregate counting the rows matching conditions"""
+    return models.Sum(models.Case(models.When(then=1, **conditions), default=0,
+                                  output_field=models.IntegerField()))
+
+
+class TeamQuerySet(models.QuerySet):
+    def with_completeness(self):
+        """Annotate the number of persons of each type and of persons without photo
+
+        Team.is_complete uses these annotations instead of querying the persons.
+
+        """
+        return self.annotate(
+            core_member_count=count_if(persons__type='core_member'),
+            mechanics_count=count_if(persons__type='mechanics'),
+            adviser_count=count_if(persons__type='adviser'),
+            missing_photo_count=count_if(persons__isnull=False, persons__photo=''))
+
+
 class TeamManager(models.Manager):
     """Object manager for the Team model"""
+    def get_queryset(self):
+        return TeamQuerySet(self.model, using=self._db)
+
+    def with_completeness(self):
+        return self.get_queryset().with_completeness()
+
     def create(self, **kwargs):
         """Create a new Team
 
@@ -188,6 +270,7 @@ class Team(models.Model):
     division = models.CharField(max_length=12, choices=TEAM_DIVISION)
     arrival_time = models.DateTimeField(null=True)
     transport = models.CharField(max_length=100, null=True)
+    complete = models.BooleanField(default=False, editable=False)
     objects = TeamManager()
 
     def max_core_member(self):
@@ -206,42 +289,52 @@ class Team(models.Model):
         """Returns the maximum pers allowed for the team"""
         return self.MAX_PERS[self.division]
 
-    def core_member(self):
-        """Returns list of the team's core member"""
-        return self.persons.filter(type='core_member')
+    @staticmethod
+    def lock(team_id):
+        """Lock a team row until the end of the current transaction
+
+        Concurrent changes to the persons of the same team wait for each other, other teams
+        are not blocked. SQLite ignores select_for_update, so the row is written instead,
+        which takes the database write lock.
+
+        """
+        if connection.features.has_select_for_update:
+            list(Team.objects.select_for_update().filter(id=team_id).values_list('id'))
+        else:
+            Team.objects.filter(id=team_id).update(division=models.F('division'))
 
-    def mechanics(self):
-        """Returns list of the team's mechanics"""
-        return self.persons.filter(type='mechanics')
+    def roster(self):
+        """Load the team's persons once, see Roster
 
-    def adviser(self):
-        """Returns list of the team's adviser"""
-        return self.persons.filter(type='adviser')
+        The persons prefetched with prefetch_related('persons') are used without a query.
 
-    def pers(self):
-        """Returns list of the team's pers"""
-        return self.persons.filter(type='pers')
+        """
+        return Roster(self)
 
     def available_slot(self, person_type):
         """Get available slot for a person type"""
-        return getattr(self, 'max_' + person_type)() - getattr(self, person_type)().count()
+        return self.roster().available_slot(person_type)
 
     def __str__(self):
         return self.name + ' - ' + self.university.name
 
     def is_complete(self):
-        """Check if team data is complete, including person data"""
+        """Check if team data is complete, including person data
+
+        The counts annotated by TeamQuerySet.with_completeness are used if present,
+        otherwise the persons are checked by the team's roster.
+
+        """
         if not self.name and self.arrival_time and self.transport:
             return False
 
-        if not (self.core_member() and self.adviser()):
-            return False
+        if not hasattr(self, 'missing_photo_count'):
+            return self.roster().is_complete()
 
-        for m in self.persons.all():
-            if not m.is_complete():
-                return False
+        if not (self.core_member_count and self.adviser_count):
+            return False
 
-        return True
+        return not self.missing_photo_count
 
     is_complete.boolean = True
     is_complete.short_description = 'Complete'
@@ -256,6 +349,41 @@ class Team(models.Model):
         return None
 
 
+class Roster:
+    """Persons of a team partitioned by type
+
+    The persons are loaded in one query, or taken from the prefetched persons of the team,
+    then counts, slots and completeness are answered without further queries.
+
+    """
+
+    def __init__(self, team):
+        self.team = team
+        self.persons = list(team.persons.all())
+        self.members = {p[0]: [] for p in Person.PERSON_TYPE}
+        for m in self.persons:
+            self.members[m.type].append(m)
+
+    def count(self, person_type):
+        """Number of persons of a type"""
+        return len(self.members[person_type])
+
+    def available_slot(self, person_type):
+        """Get available slot for a person type"""
+        return getattr(self.team, 'max_' + person_type)() - self.count(person_type)
+
+    def is_complete(self):
+        """Check if the team has a core member and an adviser, and every person is complete"""
+        if not (self.members['core_member'] and self.members['adviser']):
+            return False
+
+        for m in self.persons:
+            if not m.is_complete():
+                return False
+
+        return True
+
+
 def person_image_directory(instance, filename):
     """Generate a unique image upload path for each person"""
     salt = hashlib.sha1(str(random.random()).encode('utf8')).hexdigest()[:5]
@@ -268,7 +396,7 @@ class PersonManager(models.Manager):
         """Create a new Person
 
         The Person will only be created if the team member is still below the maximum
-        number of person for each person type.
+        number of person for each person type, see Person.save.
 
         Returns:
             - New Person instance
@@ -277,20 +405,10 @@ class PersonManager(models.Manager):
             - IntegrityError: attempted to create a person over the person type's limit
 
         """
-        team = kwargs['team']
-        person_type = kwargs['type']
+        person = self.model(**kwargs)
+        person.save()
 
-        member_count = getattr(team, person_type)().count()
-        max_member = getattr(team, 'max_' + person_type)()
-
-        if member_count < max_member:
-            person = self.model(**kwargs)
-            person.save()
-
-            return person
-        else:
-            raise IntegrityError('{0} tim {1} sudah penuh.'.format(
-                Person.person_type_display(person_type), team.name))
+        return person
 
 
 class Person(models.Model):
@@ -316,11 +434,50 @@ class Person(models.Model):
     phone = models.CharField(max_length=15)
     email = models.EmailField()
     photo = models.ImageField(upload_to=person_image_directory, blank=True)
+    photo_card = models.ImageField(blank=True, editable=False)
+    photo_thumb = models.ImageField(blank=True, editable=False)
     objects = PersonManager()
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        """Save the person if the team has a free slot for the person type
+
+        The slot is checked and the person saved while the team row is locked, so concurrent
+        saves can not push a team over the maximum number of person of a type. Saves only
+        updating other fields than team and type are not checked.
+
+        Raises:
+            - IntegrityError: the person is added to a type of the team which is already full
+
+        """
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and not {'team', 'team_id', 'type'} & set(update_fields):
+            return super(Person, self).save(*args, **kwargs)
+
+        with transaction.atomic():
+            Team.lock(self.team_id)
+            if not self.has_slot():
+                raise IntegrityError('{0} tim {1} sudah penuh.'.format(
+                    Person.person_type_display(self.type), self.team.name))
+
+            return super(Person, self).save(*args, **kwargs)
+
+    def has_slot(self):
+        """Check if the person fits in the team, must be called while the team is locked"""
+        max_member = getattr(self.team, 'max_' + self.type, None)
+        if max_member is None:
+            return True
+
+        members = Person.objects.filter(team_id=self.team_id, type=self.type)
+        if self.pk is not None:
+            if members.filter(pk=self.pk).exists():
+                return True
+            members = members.exclude(pk=self.pk)
+
+        return members.count() < max_member()
+
     def is_complete(self):
         """Check if person data is complete"""
         if self.photo:
@@ -340,6 +497,144 @@ class Person(models.Model):
 
         return None
 
+    @staticmethod
+    def import_roster(rows, photos=None, dry_run=False):
+        """Add many persons to many teams at once
+
+        Every row is validated in memory by PersonForm, against one query for the teams and
+        one query for the number of members of each type. The persons are only created, with
+        a single bulk insert in one transaction while their teams are locked, when no row has
+        an error. The photo variants, the completeness of the teams and the statistics are
+        updated after the insert, since bulk_create sends no post_save signal.
+
+        Photos are read from the archive one at a time, once to be validated and once to be
+        written to the storage just before the insert. The written photos are deleted if the
+        persons are not created.
+
+        Args:
+            - rows: list of dictionaries with the university name or abbreviation, the
+              division, the PersonForm fields and the name of the photo in photos
+            - photos: ZipFile of the photos, matched by file name
+            - dry_run: validate only, do not create the persons
+
+        Returns:
+            Tuple of the list of valid persons and the list of error messages. The persons
+            are saved if the list of errors is empty and dry_run is False.
+
+        """
+        from django.core.files.base import ContentFile
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from . import photos as derivatives, statistics
+        from .forms import PersonForm
+
+        teams = {}
+        for team in Team.objects.select_related('university'):
+            keys = {team.university.name.lower(), (team.university.abbreviation or '').lower()}
+            for key in keys - {''}:
+                teams.setdefault((key, team.division), []).append(team)
+
+        def member_counts(team_ids=None):
+            counts = Person.objects.values('team_id', 'type').annotate(count=models.Count('id'))
+            if team_ids is not None:
+                counts = counts.filter(team_id__in=team_ids)
+            return {(c['team_id'], c['type']): c['count'] for c in counts}
+
+        counts = member_counts()
+        archive = {}
+        if photos is not None:
+            archive = {name.split('/')[-1]: name for name in photos.namelist()
+                       if not name.endswith('/')}
+
+        persons = []
+        uploads = []
+        errors = []
+        for line, row in enumerate(rows, 1):
+            university = (row.get('university') or '').strip()
+            division = (row.get('division') or '').strip()
+            matches = teams.get((university.lower(), division), [])
+            if not matches:
+                errors.append('Row {0}: no {1} team for {2}.'.format(line, division, university))
+                continue
+            elif len(matches) > 1:
+                errors.append('Row {0}: {1} matches {2} universities.'.format(
+                    line, university, len(matches)))
+                continue
+
+            files = {}
+            photo = (row.get('photo') or '').strip()
+            if photo:
+                if photo not in archive:
+                    errors.append('Row {0}: photo {1} is not in the archive.'.format(
+                        line, photo))
+                    continue
+                files['photo'] = SimpleUploadedFile(photo, photos.read(archive[photo]))
+
+            form = PersonForm({k: (v or '').strip() for k, v in row.items()}, files)
+            if not form.is_valid():
+                errors.append('Row {0}: {1}'.format(line, ' '.join(
+                    '{0}: {1}'.format(field, ' '.join(messages))
+                    for field, messages in form.errors.items())))
+                continue
+
+            person = form.save(commit=False)
+            person.photo = ''
+            person.team = matches[0]
+            max_member = getattr(person.team, 'max_' + person.type, None)
+            key = (person.team.id, person.type)
+            counts[key] = counts.get(key, 0) + 1
+            if max_member is not None and counts[key] > max_member():
+                errors.append('Row {0}: {1} tim {2} sudah penuh.'.format(
+                    line, Person.person_type_display(person.type), person.team.name))
+                continue
+
+            persons.append(person)
+            if photo:
+                uploads.append((person, photo))
+
+        if errors or dry_run:
+            return persons, errors
+
+        created = False
+        try:
+            for person, photo in uploads:
+                person.photo.save(photo, ContentFile(photos.read(archive[photo])), save=False)
+
+            team_ids = sorted(set(p.team_id for p in persons))
+            with transaction.atomic():
+                for team_id in team_ids:
+                    Team.lock(team_id)
+
+                counts = member_counts(team_ids)
+                for person in persons:
+                    key = (person.team_id, person.type)
+                    counts[key] = counts.get(key, 0) + 1
+                    max_member = getattr(person.team, 'max_' + person.type, None)
+                    if max_member is not None and counts[key] == max_member() + 1:
+                        errors.append('{0} tim {1} sudah penuh.'.format(
+                            Person.person_type_display(person.type), person.team.name))
+
+                if errors:
+                    return persons, errors
+
+                Person.objects.bulk_create(persons)
+                University.update_completeness(
+                    University.objects.filter(teams__in=team_ids).distinct())
+
+            created = True
+        finally:
+            if not created:
+                for person, _ in uploads:
+                    if person.photo:
+                        person.photo.delete(save=False)
+
+        statistics.invalidate()
+
+        for person in Person.objects.filter(team_id__in=team_ids).exclude(photo=''):
+            if not derivatives.is_current(person):
+                derivatives.schedule(person)
+
+        return persons, errors
+
 
 class Supporter(models.Model):
     MAX_TICKET = 600
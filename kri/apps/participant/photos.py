@@ -0,0 +1,132 @@
+"""Photo derivatives
+
+Uploaded photos are kept as they are, but the ID card renderer and the attendance monitor
+use small variants with a fixed size, generated once when the photo is saved:
+
+    - photo_card: the 170x228 crop pasted on the ID card
+    - photo_thumb: the thumbnail shown by the attendance monitor
+
+The variants are written in a background thread after the transaction is committed, so the
+upload request does not wait for them. A variant is stored next to the photo under a name
+derived from the photo name, which is how an outdated variant is detected. The
+build_photo_derivatives command generates the variants that are missing or outdated.
+
+"""
+
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from PIL import Image, ImageOps
+
+VARIANTS = (
+    ('photo_card', 'card', (170, 228)),
+    ('photo_thumb', 'thumb', (240, 320)),
+)
+JPEG_QUALITY = 90
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def derivative_name(photo_name, variant):
+    """Storage name of a variant of a photo"""
+    directory, filename = os.path.split(photo_name)
+    return os.path.join(directory, variant, os.path.splitext(filename)[0] + '.jpg')
+
+
+def is_current(person):
+    """Check if the variants of a person's photo match the photo"""
+    for field, variant, _ in VARIANTS:
+        current = getattr(person, field).name or ''
+        expected = derivative_name(person.photo.name, variant) if person.photo else ''
+        if current != expected:
+            return False
+
+    return True
+
+
+def build_derivatives(person):
+    """Write the variants of a person's photo and store them in the person
+
+    Variants of a previous photo are deleted. The person is saved with update_fields, so
+    post_save receivers see the new variants.
+
+    """
+    storage = person.photo.storage
+    names = {}
+
+    if person.photo:
+        person.photo.open('rb')
+        try:
+            image = Image.open(person.photo)
+            image.load()
+        finally:
+            person.photo.close()
+
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        for field, variant, size in VARIANTS:
+            buffer = io.BytesIO()
+            ImageOps.fit(image, size, Image.LANCZOS).save(buffer, 'JPEG', quality=JPEG_QUALITY)
+
+            name = derivative_name(person.photo.name, variant)
+            if storage.exists(name):
+                storage.delete(name)
+            names[field] = storage.save(name, ContentFile(buffer.getvalue()))
+
+    for field, _, _ in VARIANTS:
+        old = getattr(person, field).name
+        if old and old != names.get(field) and storage.exists(old):
+            storage.delete(old)
+        setattr(person, field, names.get(field, ''))
+
+    person.save(update_fields=[field for field, _, _ in VARIANTS])
+
+
+def build_person_derivatives(person_id):
+    """Build the variants of a person, unless they are already current"""
+    from .models import Person
+
+    try:
+        person = Person.objects.get(pk=person_id)
+    except Person.DoesNotExist:
+        return
+
+    if not is_current(person):
+        build_derivatives(person)
+
+
+def _build_in_background(person_id):
+    try:
+        build_person_derivatives(person_id)
+    finally:
+        connection.close()
+
+
+def executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1)
+
+    return _executor
+
+
+def schedule(person):
+    """Build the variants of a person after the current transaction is committed
+
+    The variants are built right away when the PHOTO_DERIVATIVES_ASYNC setting is False.
+
+    """
+    if not getattr(settings, 'PHOTO_DERIVATIVES_ASYNC', True):
+        build_person_derivatives(person.pk)
+        return
+
+    person_id = person.pk
+    transaction.on_commit(lambda: executor().submit(_build_in_background, person_id))
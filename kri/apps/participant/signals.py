@@ -0,0 +1,39 @@
+"""Signal handlers of the participant app"""
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from . import photos, statistics
+from .models import University, Team, Person
+
+
+@receiver(post_save, sender=Person)
+def person_saved(sender, instance, **kwargs):
+    if not photos.is_current(instance):
+        photos.schedule(instance)
+
+
+@receiver(post_save, sender=Person)
+@receiver(post_delete, sender=Person)
+def person_completeness_changed(sender, instance, **kwargs):
+    University.update_completeness(University.objects.filter(teams=instance.team_id))
+
+
+@receiver(post_save, sender=Team)
+@receiver(post_delete, sender=Team)
+def team_completeness_changed(sender, instance, **kwargs):
+    University.update_completeness(University.objects.filter(id=instance.university_id))
+
+
+@receiver(post_save, sender=University)
+def university_completeness_changed(sender, instance, **kwargs):
+    University.update_completeness(University.objects.filter(id=instance.id))
+
+
+@receiver(post_save, sender=Person)
+@receiver(post_delete, sender=Person)
+@receiver(post_save, sender=Team)
+@receiver(post_delete, sender=Team)
+@receiver(post_save, sender=University)
+@receiver(post_delete, sender=University)
+def registration_changed(sender, instance, **kwargs):
+    statistics.invalidate()
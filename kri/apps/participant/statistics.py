@@ -0,0 +1,83 @@
+"""Registration statistics
+
+The number of universities, teams and persons of each division is counted with three
+GROUP BY queries and kept in the default cache for a short time, so the statistics page can
+be refreshed by many organizers at once. The signal handlers drop the cached statistics when
+a university, team or person is saved or deleted.
+
+"""
+
+from django.core.cache import cache
+from django.db.models import Count
+from django.utils import timezone
+from .models import University, Team, Person, count_if
+
+CACHE_KEY = 'participant:statistics'
+CACHE_TIMEOUT = 60
+
+
+def compute():
+    """Count the universities, teams and persons of each division
+
+    Returns:
+        Dictionary with the time of the computation, the totals, and the counts of each
+        division in the order of Team.TEAM_DIVISION
+
+    """
+    divisions = [d[0] for d in Team.TEAM_DIVISION]
+    person_types = [p[0] for p in Person.PERSON_TYPE]
+
+    universities = University.objects.aggregate(
+        universities=Count('id'), complete=count_if(complete=True),
+        **{d: count_if(**{d: True}) for d in divisions if d != 'pers'})
+
+    rows = {d: {
+        'division': d,
+        'name': Team.division_type_display(d),
+        'universities': universities[d] if d != 'pers' else universities['universities'],
+        'teams': 0,
+        'complete': 0,
+        'persons': dict.fromkeys(person_types, 0),
+        'missing_photo': 0,
+    } for d in divisions}
+
+    for team in Team.objects.values('division').annotate(teams=Count('id'),
+                                                         complete=count_if(complete=True)):
+        rows[team['division']]['teams'] = team['teams']
+        rows[team['division']]['complete'] = team['complete']
+
+    for person in Person.objects.values('team__division', 'type').annotate(
+            count=Count('id'), missing_photo=count_if(photo='')):
+        row = rows[person['team__division']]
+        row['persons'][person['type']] = person['count']
+        row['missing_photo'] += person['missing_photo']
+
+    rows = [rows[d] for d in divisions]
+    persons = {t: sum(r['persons'][t] for r in rows) for t in person_types}
+
+    return {
+        'time': timezone.now(),
+        'universities': universities['universities'],
+        'complete_universities': universities['complete'],
+        'teams': sum(r['teams'] for r in rows),
+        'complete_teams': sum(r['complete'] for r in rows),
+        'persons': persons,
+        'total_persons': sum(persons.values()),
+        'missing_photo': sum(r['missing_photo'] for r in rows),
+        'divisions': rows,
+    }
+
+
+def statistics():
+    """Get the statistics, computed only if they are not in the cache"""
+    result = cache.get(CACHE_KEY)
+    if result is None:
+        result = compute()
+        cache.set(CACHE_KEY, result, CACHE_TIMEOUT)
+
+    return result
+
+
+def invalidate():
+    """Drop the cached statistics"""
+    cache.delete(CACHE_KEY)
@@ -10,7 +10,7 @@ def person_form_panel(person, counter):
     """Render PersonForm in template with context"""
     return {
         'form': PersonForm(instance=person),
-        'team_id': person.team.id,
+        'team_id': person.team_id,
         'person_id': person.id,
         'person_type': person.type,
         'person_type_display': Person.person_type_display(person.type),
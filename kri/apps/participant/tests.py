@@ -1,14 +1,26 @@
 """Test cases for participant application"""
 
 import datetime
+import io
+import os
 import random
+import shutil
 import string
+import tempfile
+import threading
+import zipfile
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
+from django.core.files.base import ContentFile
+from django.core.management import call_command
 from django.contrib.auth.models import User
-from django.db import IntegrityError
-from django.test import TestCase
+from django.db import connection, IntegrityError
+from django.core.urlresolvers import reverse
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
-from . import forms, models
+from PIL import Image
+from . import forms, idcard, models, photos, statistics
 
 
 class UniversityTestCase(TestCase):
@@ -105,9 +117,30 @@ class TeamTestCase(TestCase):
 
         team.refresh_from_db()
 
-        self.assertEqual(team.core_member().count(), team.max_core_member())
-        self.assertEqual(team.mechanics().count(), team.max_mechanics())
-        self.assertEqual(team.adviser().count(), team.max_adviser())
+        roster = team.roster()
+        self.assertEqual(roster.count('core_member'), team.max_core_member())
+        self.assertEqual(roster.count('mechanics'), team.max_mechanics())
+        self.assertEqual(roster.count('adviser'), team.max_adviser())
+
+    def test_roster(self):
+        """Test the roster of prefetched teams answers without queries"""
+        team = TeamTestCase.mock_team('KRAI', 'krai', self.university)
+        PersonTestCase.mock_person('core-0', team, 'core_member')
+        PersonTestCase.mock_person('core-1', team, 'core_member')
+        PersonTestCase.mock_person('adviser', team, 'adviser')
+        TeamTestCase.mock_team('KRSTI', 'krsti', self.university)
+
+        teams = list(models.Team.objects.filter(university=self.university).prefetch_related(
+            'persons').order_by('division'))
+        with self.assertNumQueries(0):
+            roster = teams[0].roster()
+            self.assertEqual(roster.count('core_member'), 2)
+            self.assertEqual(roster.count('mechanics'), 0)
+            self.assertEqual(roster.available_slot('core_member'), 1)
+            self.assertEqual(roster.available_slot('adviser'), 0)
+            self.assertEqual([m.name for m in roster.members['adviser']], ['adviser'])
+            self.assertFalse(roster.is_complete())
+            self.assertEqual(teams[1].roster().count('core_member'), 0)
 
 class PersonTestCase(TestCase):
     """Test cases for Person model"""
@@ -173,6 +206,500 @@ class PersonTestCase(TestCase):
         self.assertEqual(error.exception.args[0],
                          'Dosen Pembimbing tim KRPAI sudah penuh.')
 
+    def test_change_type_over_limit(self):
+        """Test changing a person to a full person type"""
+        PersonTestCase.mock_person('adviser', self.team, 'adviser')
+        person = PersonTestCase.mock_person('core', self.team, 'core_member')
+        person.type = 'adviser'
+
+        with self.assertRaises(IntegrityError):
+            person.save()
+
+        person.name = 'John Doe'
+        person.type = 'core_member'
+        person.save()
+        self.assertEqual(self.team.roster().members['core_member'][0].name, 'John Doe')
+
+
+@skipUnlessDBFeature('test_db_allows_multiple_connections')
+class PersonConcurrencyTestCase(TransactionTestCase):
+    THREADS = 8
+
+    def setUp(self):
+        university = UniversityTestCase.mock_university()
+        self.teams = [TeamTestCase.mock_team('KRAI', 'krai', university),
+                      TeamTestCase.mock_team('KRSTI', 'krsti', university)]
+
+    def test_slots_hold(self):
+        """Concurrent additions to teams never exceed the maximum number of person"""
+        barrier = threading.Barrier(self.THREADS)
+        errors = []
+
+        def add(index):
+            try:
+                for team in self.teams:
+                    for person_type in ('core_member', 'mechanics'):
+                        barrier.wait()
+                        try:
+                            PersonTestCase.mock_person('person-{0}'.format(index), team,
+                                                       person_type)
+                        except IntegrityError:
+                            pass
+            except Exception as error:
+                errors.append(error)
+                barrier.abort()
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=add, args=(i,)) for i in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        for team in self.teams:
+            roster = team.roster()
+            self.assertEqual(roster.count('core_member'), team.max_core_member())
+            self.assertEqual(roster.count('mechanics'), team.max_mechanics())
+
+
+class MediaMixin:
+    """Store the uploaded files in a temporary MEDIA_ROOT and make photo derivatives at once"""
+    def setUp(self):
+        super(MediaMixin, self).setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.media_settings = override_settings(MEDIA_ROOT=self.media_root,
+                                                PHOTO_DERIVATIVES_ASYNC=False)
+        self.media_settings.enable()
+
+    def tearDown(self):
+        self.media_settings.disable()
+        shutil.rmtree(self.media_root)
+        super(MediaMixin, self).tearDown()
+
+
+class PhotoTestCase(MediaMixin, TestCase):
+    """Test cases for photo derivatives"""
+    @staticmethod
+    def mock_photo(size=(1200, 1600), color='red'):
+        """Create JPEG content for testing purpose"""
+        buffer = io.BytesIO()
+        Image.new('RGB', size, color).save(buffer, 'JPEG')
+        return ContentFile(buffer.getvalue())
+
+    def setUp(self):
+        super(PhotoTestCase, self).setUp()
+        university = UniversityTestCase.mock_university()
+        team = TeamTestCase.mock_team('KRAI', 'krai', university)
+        self.person = PersonTestCase.mock_person('John Doe', team, 'core_member')
+
+    def test_derivatives_on_save(self):
+        """Test the variants are generated when a photo is saved"""
+        self.person.photo.save('photo.jpg', PhotoTestCase.mock_photo())
+        self.person.refresh_from_db()
+
+        self.assertTrue(photos.is_current(self.person))
+        with Image.open(self.person.photo_card.path) as card:
+            self.assertEqual(card.size, (170, 228))
+        with Image.open(self.person.photo_thumb.path) as thumb:
+            self.assertEqual(thumb.size, (240, 320))
+
+    def test_replace_photo(self):
+        """Test the variants of a replaced photo are deleted"""
+        self.person.photo.save('photo.jpg', PhotoTestCase.mock_photo())
+        self.person.refresh_from_db()
+        old_card = self.person.photo_card.path
+
+        self.person.photo.save('new.jpg', PhotoTestCase.mock_photo(color='blue'))
+        self.person.refresh_from_db()
+
+        self.assertNotEqual(self.person.photo_card.path, old_card)
+        self.assertFalse(os.path.exists(old_card))
+        self.assertTrue(os.path.exists(self.person.photo_card.path))
+
+    def test_remove_photo(self):
+        """Test the variants are deleted with the photo"""
+        self.person.photo.save('photo.jpg', PhotoTestCase.mock_photo())
+        self.person.refresh_from_db()
+        thumb = self.person.photo_thumb.path
+
+        self.person.photo = ''
+        self.person.save()
+        self.person.refresh_from_db()
+
+        self.assertFalse(self.person.photo_thumb)
+        self.assertFalse(os.path.exists(thumb))
+
+
+class CompletenessTestCase(MediaMixin, TestCase):
+    """Test cases for the completeness of universities and teams"""
+    def setUp(self):
+        super(CompletenessTestCase, self).setUp()
+        self.university = UniversityTestCase.mock_university()
+        self.team = TeamTestCase.mock_team('KRAI', 'krai', self.university)
+
+    def mock_member(self, name, person_type):
+        person = PersonTestCase.mock_person(name, self.team, person_type)
+        person.photo.save('photo.jpg', PhotoTestCase.mock_photo(size=(300, 400)))
+        return person
+
+    def test_team_complete(self):
+        """Test the stored flag follows the team's members"""
+        self.mock_member('Core', 'core_member')
+        self.team.refresh_from_db()
+        self.assertFalse(self.team.complete)
+        self.assertFalse(self.team.is_complete())
+
+        adviser = self.mock_member('Adviser', 'adviser')
+        self.team.refresh_from_db()
+        self.assertTrue(self.team.complete)
+        self.assertTrue(self.team.is_complete())
+
+        adviser.photo = ''
+        adviser.save()
+        self.team.refresh_from_db()
+        self.assertFalse(self.team.complete)
+        self.assertFalse(self.team.is_complete())
+
+        adviser.delete()
+        self.mock_member('Adviser', 'adviser')
+        self.team.refresh_from_db()
+        self.assertTrue(self.team.complete)
+
+    def test_university_complete(self):
+        """Test a university is not complete while a division has no team"""
+        self.mock_member('Core', 'core_member')
+        self.mock_member('Adviser', 'adviser')
+        self.university.refresh_from_db()
+
+        self.assertFalse(self.university.complete)
+        self.assertFalse(self.university.is_complete())
+
+    def test_completeness_queries(self):
+        """Test the completeness is computed in a constant number of queries"""
+        self.mock_member('Core', 'core_member')
+        self.mock_member('Adviser', 'adviser')
+        for i in range(3):
+            university = UniversityTestCase.mock_university()
+            team = TeamTestCase.mock_team('KRSTI', 'krsti', university)
+            PersonTestCase.mock_person('Core', team, 'core_member')
+
+        with self.assertNumQueries(2):
+            universities, teams = models.University.completeness(
+                models.University.objects.all())
+
+        self.assertEqual(len(universities), 4)
+        self.assertEqual(len(teams), 4)
+        self.assertTrue(teams[self.team.id])
+        self.assertEqual([t for t in teams.values() if t], [True])
+        for university in models.University.objects.all():
+            self.assertEqual(universities[university.id], university.is_complete())
+            self.assertEqual(universities[university.id], university.complete)
+
+
+class TeamAdminTestCase(TestCase):
+    """Test cases for the team admin"""
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        self.team = TeamTestCase.mock_team('KRAI', 'krai')
+        PersonTestCase.mock_person('John Doe', self.team, 'core_member')
+
+    def changelist_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('admin:participant_team_changelist'))
+        self.assertEqual(response.status_code, 200)
+
+        return len(queries)
+
+    def test_changelist_queries(self):
+        """Test the changelist takes the same number of queries for any number of teams"""
+        queries = self.changelist_queries()
+        for i in range(3):
+            team = TeamTestCase.mock_team('KRSTI', 'krsti')
+            PersonTestCase.mock_person('Core', team, 'core_member')
+
+        self.assertEqual(self.changelist_queries(), queries)
+
+    def test_change_form(self):
+        """Test the change form lists the team's members"""
+        response = self.client.get(reverse('admin:participant_team_change', args=[self.team.id]))
+
+        self.assertContains(response, 'John Doe')
+
+
+class RosterImportTestCase(MediaMixin, TestCase):
+    """Test cases for the roster import"""
+    HEADER = 'university,division,name,type,instance_id,birthday,gender,phone,email,photo\n'
+
+    def setUp(self):
+        super(RosterImportTestCase, self).setUp()
+        self.university = UniversityTestCase.mock_university()
+        self.krai = TeamTestCase.mock_team('KRAI', 'krai', self.university)
+        self.krsti = TeamTestCase.mock_team('KRSTI', 'krsti', self.university)
+
+    def row(self, name, division='krai', person_type='core_member', photo='', **values):
+        row = {
+            'university': self.university.name, 'division': division, 'name': name,
+            'type': person_type, 'instance_id': '123', 'birthday': '17/08/1995',
+            'gender': 'L', 'phone': '081234567890', 'email': 'email@test.com', 'photo': photo,
+        }
+        row.update(values)
+        return row
+
+    @staticmethod
+    def mock_zip(names):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as archive:
+            for name in names:
+                archive.writestr(name, PhotoTestCase.mock_photo((300, 400)).read())
+        buffer.seek(0)
+        return buffer
+
+    def test_import(self):
+        """Persons of many teams are added with their photos"""
+        archive = zipfile.ZipFile(RosterImportTestCase.mock_zip(['roster/john.jpg', 'jane.jpg']))
+        persons, errors = models.Person.import_roster([
+            self.row('John Doe', photo='john.jpg'),
+            self.row('Jane Doe', person_type='adviser', photo='jane.jpg'),
+            self.row('Richard Roe', 'krsti', 'mechanics'),
+        ], archive)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.krai.roster().count('core_member'), 1)
+        self.assertEqual(self.krsti.roster().count('mechanics'), 1)
+        john = models.Person.objects.get(name='John Doe')
+        self.assertTrue(john.photo)
+        self.assertTrue(photos.is_current(john))
+        self.krai.refresh_from_db()
+        self.assertTrue(self.krai.complete)
+
+    def test_import_errors(self):
+        """Every invalid row is reported and nothing is added"""
+        PersonTestCase.mock_person('Adviser', self.krai, 'adviser')
+
+        persons, errors = models.Person.import_roster([
+            self.row('John Doe'),
+            self.row('Jane Doe', 'krpai'),
+            self.row('Richard Roe', person_type='adviser'),
+            self.row('Mary Major', email='invalid'),
+            self.row('John Roe', photo='missing.jpg'),
+        ])
+
+        self.assertEqual(len(errors), 4)
+        self.assertEqual(errors[0], 'Row 2: no krpai team for {0}.'.format(
+            self.university.name))
+        self.assertEqual(errors[1], 'Row 3: Dosen Pembimbing tim KRAI sudah penuh.')
+        self.assertTrue(errors[2].startswith('Row 4: email:'))
+        self.assertEqual(errors[3], 'Row 5: photo missing.jpg is not in the archive.')
+        self.assertEqual(models.Person.objects.count(), 1)
+
+    def test_over_limit_in_file(self):
+        """Rows over the maximum number of person are reported"""
+        rows = [self.row('core-{0}'.format(i)) for i in range(self.krai.max_core_member() + 1)]
+        persons, errors = models.Person.import_roster(rows)
+
+        self.assertEqual(errors, ['Row 4: Tim Inti tim KRAI sudah penuh.'])
+        self.assertEqual(models.Person.objects.count(), 0)
+
+    def test_photo_failure(self):
+        """Photos already written are deleted when the import fails"""
+        class BrokenZipFile(zipfile.ZipFile):
+            reads = []
+
+            def read(self, name, pwd=None):
+                self.reads.append(name)
+                if self.reads.count(name) > 1 and name == 'jane.jpg':
+                    raise OSError('Broken archive')
+                return super(BrokenZipFile, self).read(name, pwd)
+
+        archive = BrokenZipFile(RosterImportTestCase.mock_zip(['john.jpg', 'jane.jpg']))
+        with self.assertRaises(OSError):
+            models.Person.import_roster([
+                self.row('John Doe', photo='john.jpg'),
+                self.row('Jane Doe', person_type='adviser', photo='jane.jpg'),
+            ], archive)
+
+        self.assertEqual(models.Person.objects.count(), 0)
+        self.assertEqual([f for _, _, files in os.walk(self.media_root) for f in files], [])
+
+    def test_dry_run(self):
+        """Dry run only validates"""
+        persons, errors = models.Person.import_roster([self.row('John Doe')], dry_run=True)
+
+        self.assertEqual((len(persons), errors), (1, []))
+        self.assertEqual(models.Person.objects.count(), 0)
+
+    def test_command(self):
+        """Import from a csv file and a zip of photos"""
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'roster.csv')
+        with open(path, 'w') as text_file:
+            text_file.write(self.HEADER)
+            text_file.write('{0},krai,John Doe,core_member,123,17/08/1995,L,0812,a@b.com,'
+                            'john.jpg\n'.format(self.university.abbreviation.lower()))
+        zip_path = os.path.join(directory, 'photos.zip')
+        with open(zip_path, 'wb') as zip_file:
+            zip_file.write(RosterImportTestCase.mock_zip(['john.jpg']).read())
+
+        call_command('import_roster', path, photos=zip_path, stdout=open(os.devnull, 'w'))
+        shutil.rmtree(directory)
+
+        self.assertTrue(models.Person.objects.get().photo)
+
+    def test_admin_upload(self):
+        """Import from the admin upload form"""
+        User.objects.create_superuser('admin', 'admin@test.com', 'password')
+        self.client.login(username='admin', password='password')
+        upload = io.BytesIO((self.HEADER + '{0},krsti,John Doe,core_member,123,17/08/1995,L,'
+                             '0812,a@b.com,\n'.format(self.university.name)).encode('utf-8'))
+        upload.name = 'roster.csv'
+
+        response = self.client.post(reverse('admin:participant_person_import'),
+                                    {'file': upload})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(models.Person.objects.get().team, self.krsti)
+
+
+class StatisticsTestCase(TestCase):
+    """Test cases for the registration statistics"""
+    def setUp(self):
+        cache.clear()
+        university = UniversityTestCase.mock_university()
+        self.team = TeamTestCase.mock_team('KRAI', 'krai', university)
+        TeamTestCase.mock_team('KRSTI', 'krsti', university)
+        PersonTestCase.mock_person('John Doe', self.team, 'core_member')
+        PersonTestCase.mock_person('Jane Doe', self.team, 'adviser')
+
+    def division(self, result, division):
+        return [d for d in result['divisions'] if d['division'] == division][0]
+
+    def test_statistics(self):
+        """Test the counts of each division"""
+        with self.assertNumQueries(3):
+            result = statistics.statistics()
+
+        self.assertEqual((result['universities'], result['teams'], result['total_persons']),
+                         (1, 2, 2))
+        krai = self.division(result, 'krai')
+        self.assertEqual((krai['universities'], krai['teams'], krai['complete']), (1, 1, 0))
+        self.assertEqual(krai['persons']['core_member'], 1)
+        self.assertEqual(krai['missing_photo'], 2)
+        self.assertEqual(self.division(result, 'krpai')['universities'], 0)
+        self.assertEqual(self.division(result, 'pers')['universities'], 1)
+
+    def test_cache(self):
+        """Test the statistics are cached until a person is added"""
+        statistics.statistics()
+        with self.assertNumQueries(0):
+            statistics.statistics()
+
+        PersonTestCase.mock_person('Richard Roe', self.team, 'mechanics')
+        result = statistics.statistics()
+
+        self.assertEqual(self.division(result, 'krai')['persons']['mechanics'], 1)
+
+    def test_endpoint(self):
+        """Test the statistics are only shown to staff"""
+        url = reverse('participant:statistics')
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+        User.objects.create_superuser('admin', 'admin@test.com', 'password')
+        self.client.login(username='admin', password='password')
+        response = self.client.get(url)
+
+        self.assertEqual(response.json()['total_persons'], 2)
+        self.assertContains(self.client.get(reverse('admin:participant_university_statistics')),
+                            'Dosen Pembimbing')
+
+
+class IDCardActionTestCase(MediaMixin, TestCase):
+    """Test cases for the ID card admin actions"""
+    def setUp(self):
+        super(IDCardActionTestCase, self).setUp()
+        university = UniversityTestCase.mock_university()
+        self.team = TeamTestCase.mock_team('KRAI', 'krai', university)
+        self.with_photo = PersonTestCase.mock_person('John Doe', self.team, 'core_member')
+        self.with_photo.photo.save('photo.jpg', PhotoTestCase.mock_photo())
+        self.without_photo = PersonTestCase.mock_person('Jane Doe', self.team, 'core_member')
+
+        User.objects.create_superuser('admin', 'admin@test.com', 'password')
+        self.client.login(username='admin', password='password')
+
+    def download(self, model, ids):
+        response = self.client.post(reverse('admin:participant_{0}_changelist'.format(model)), {
+            'action': 'download_id_cards',
+            '_selected_action': ids,
+        })
+        self.assertEqual(response['Content-Type'], 'application/zip')
+
+        return zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+
+    def test_person_action(self):
+        """Test downloading the cards of selected persons"""
+        archive = self.download('person', [self.with_photo.id, self.without_photo.id])
+
+        self.assertEqual(archive.namelist(),
+                         ['UGM-krai-{0}.png'.format(self.with_photo.id), 'report.csv'])
+        report = archive.read('report.csv').decode('utf-8')
+        self.assertIn('Jane Doe', report)
+        self.assertNotIn('John Doe', report)
+
+    def test_team_action(self):
+        """Test downloading the cards of selected teams"""
+        archive = self.download('team', [self.team.id])
+
+        self.assertEqual(len(archive.namelist()), 2)
+        with Image.open(io.BytesIO(archive.read(archive.namelist()[0]))) as card:
+            self.assertEqual(card.size, (638, 1011))
+
+
+class IDCardPreviewTestCase(MediaMixin, TestCase):
+    """Test cases for the ID card preview"""
+    def setUp(self):
+        super(IDCardPreviewTestCase, self).setUp()
+        cache.clear()
+        self.university = UniversityTestCase.mock_university('manager')
+        self.team = TeamTestCase.mock_team('KRAI', 'krai', self.university)
+        self.person = PersonTestCase.mock_person('John Doe', self.team, 'core_member')
+        self.person.photo.save('photo.jpg', PhotoTestCase.mock_photo())
+        self.url = reverse('participant:person-card', args=[self.person.id])
+
+        self.client.login(username='manager', password='password')
+
+    def test_preview(self):
+        """Test rendering a card with cache headers"""
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertIn('max-age={0}'.format(idcard.BROWSER_MAX_AGE), response['Cache-Control'])
+        with Image.open(io.BytesIO(response.content)) as card:
+            self.assertEqual(card.size, (638, 1011))
+
+        with self.assertNumQueries(3):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_other_university(self):
+        """Test the card of another university is not found, even when its preview is cached"""
+        self.client.get(self.url)
+        UniversityTestCase.mock_university('other')
+        self.client.login(username='other', password='password')
+
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_changed_elsewhere(self):
+        """Test the card changed without signals, as in another process, is rendered again"""
+        etag = self.client.get(self.url)['ETag']
+        models.Team.objects.filter(id=self.team.id).update(name='Robot')
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
 
 class SupporterTestCase(TestCase):
     def test_max_supporter(self):
@@ -294,4 +821,3 @@ class SupporterTestCase(TestCase):
         ticket = models.Supporter.order(form, university.user)
 
         self.assertEqual(models.Supporter.ticket_ordered(university.user), 10)
-
@@ -20,6 +20,9 @@ urlpatterns = [
     url(r'^team/krpai/$', views.krpai, name='krpai'),
 
     url(r'^person/(?P<person_type>[\w-]+)/$', views.person, name='person'),
+    url(r'^person/(?P<person_id>[0-9]+)/card/$', views.person_card, name='person-card'),
+
+    url(r'^statistik/$', views.registration_statistics, name='statistics'),
 
     url(r'^tiket/$', views.supporter, name='supporter'),
     url(r'^tiket/verifikasi/([0-9]+)/$', views.verify_supporter, name='verify-supporter'),
@@ -1,9 +1,14 @@
-from django.http import JsonResponse, Http404
+from django.http import HttpResponse, JsonResponse, Http404
 from django.shortcuts import render, redirect
 from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.views import login as auth_login
 from django.contrib.auth.models import User
+from django.db import IntegrityError
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from . import idcard, statistics
 from .decorators import has_access
 from .forms import RegistrationForm, ManagerForm, TeamForm, PersonForm, SupporterForm
 from .models import Team, Person, University, Manager, Supporter
@@ -48,9 +53,11 @@ def index(request):
     return redirect('kri:index')
 
     teams = {}
+    rosters = {}
     for t in Team.TEAM_DIVISION:
         try:
             teams[t[0]] = request.user.university.team(t[0])
+            rosters[t[0]] = teams[t[0]].roster()
         except Team.DoesNotExist:
             teams[t[0]] = None
 
@@ -58,6 +65,7 @@ def index(request):
         'app': 'participant',
         'has_access': request.user.university.all_access(),
         'teams': teams,
+        'rosters': rosters,
     })
 
 
@@ -126,8 +134,7 @@ def division(request, **kwargs):
             'adviser': [],
         }
         if instance:
-            for m in instance.persons.all():
-                members[m.type].append(m)
+            members = instance.roster().members
 
     return render(request, 'participant/division.html', {
         'app': 'participant',
@@ -208,7 +215,10 @@ def save_person(request, person_type, instance):
         member = form_person.save(commit=False)
         member.team = Team.objects.get(pk=request.POST['team_id'])
         member.type = person_type
-        member.save()
+        try:
+            member.save()
+        except IntegrityError:
+            member = None
     else:
         print(form_person.errors)
 
@@ -218,14 +228,15 @@ def save_person(request, person_type, instance):
 def render_person_form(request, person_type):
     """Render PersonForm with detailed context"""
     team = Team.objects.get(pk=request.GET['team_id'])
-    available_slot = team.available_slot(person_type)
+    roster = team.roster()
+    available_slot = roster.available_slot(person_type)
     if available_slot:
         return render(request, 'participant/person-form-panel.html', {
             'form': PersonForm(),
             'team_id': team.id,
             'person_type': person_type,
             'person_type_display': Person.person_type_display(person_type),
-            'person_type_count': getattr(team, person_type)().count() + 1,
+            'person_type_count': roster.count(person_type) + 1,
         })
     else:
         return JsonResponse({
@@ -234,6 +245,42 @@ def render_person_form(request, person_type):
         })
 
 
+@login_required
+def person_card(request, person_id):
+    """Render a preview of a person's ID card as PNG
+
+    Raises:
+        - Http404: the person does not exist or is not a member of the user's university
+
+    """
+    try:
+        person = idcard.get_person(person_id)
+    except Person.DoesNotExist:
+        raise Http404
+
+    if not request.user.is_staff and person.team.university.user_id != request.user.id:
+        raise Http404
+
+    digest = idcard.card_digest(person)
+    response = get_conditional_response(request, etag=digest)
+    if response is None:
+        response = HttpResponse(idcard.card_png(person, digest), content_type='image/png')
+
+    response['ETag'] = quote_etag(digest)
+    patch_cache_control(response, private=True, max_age=idcard.BROWSER_MAX_AGE)
+
+    return response
+
+
+@staff_member_required
+def registration_statistics(request):
+    """Registration statistics as JSON, see statistics.py"""
+    response = JsonResponse(statistics.statistics())
+    patch_cache_control(response, private=True, max_age=statistics.CACHE_TIMEOUT)
+
+    return response
+
+
 @login_required
 def supporter(request):
     return redirect('kri:index')